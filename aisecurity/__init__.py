@@ -8,6 +8,7 @@ from . import face
 from . import optim
 from . import privacy
 from . import samples
+from . import serving
 from . import utils
 
 # also importable from root
@@ -1,2 +1,7 @@
 from . import loader
 from . import graphs
+from . import reload
+from . import shared
+from . import synthetic
+from . import verification
+from . import visitors
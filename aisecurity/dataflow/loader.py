@@ -15,17 +15,25 @@ import warnings
 import tqdm
 
 from aisecurity.privacy.encryptions import DataEncryption
+from aisecurity.utils import metrics
 from aisecurity.utils.paths import DATABASE_INFO, DATABASE, NAME_KEYS, EMBEDDING_KEYS
 
 
 # DECORATORS
 def print_time(message="Time elapsed"):
     def _timer(func):
+        histogram = metrics.histogram("task_seconds", "Duration of one-off tasks like model loading",
+                                      labels={"task": message}, buckets=(0.01, 0.1, 1., 10., 60., 600.))
+
         @functools.wraps(func)
         def _func(*args, **kwargs):
             start = timer()
             result = func(*args, **kwargs)
-            print("{}: {}s".format(message, round(timer() - start, 4)))
+            elapsed = timer() - start
+
+            histogram.observe(elapsed)
+            if not metrics.QUIET:
+                print("{}: {}s".format(message, round(elapsed, 4)))
             return result
 
         return _func
@@ -45,11 +53,12 @@ def encrypt_to_ignore(encrypt):
 
 
 @print_time("Data dumping time")
-def dump_and_encrypt(data, dump_path, encrypt=None, mode="w+"):
+def dump_and_encrypt(data, dump_path, encrypt=None, mode="w+", name_keys=NAME_KEYS, embedding_keys=EMBEDDING_KEYS):
     ignore = encrypt_to_ignore(encrypt)
     for person, embeddings in data.items():
         data[person] = [embed.tolist() for embed in embeddings]
-    encrypted_data = DataEncryption.encrypt_data(data, ignore=ignore)
+    encrypted_data = DataEncryption.encrypt_data(data, ignore=ignore, name_key_file=name_keys,
+                                                 embeddings_key_file=embedding_keys)
 
     with open(dump_path, mode, encoding="utf-8") as dump_file:
         json.dump(encrypted_data, dump_file, ensure_ascii=False, indent=4)
@@ -0,0 +1,104 @@
+"""
+
+"aisecurity.dataflow.reload"
+
+Background database reloads for a running FaceNet.
+
+"""
+
+import os
+import threading
+from timeit import default_timer as timer
+import warnings
+
+from aisecurity.utils.paths import DATABASE
+
+
+################################ Database watcher ###############################
+class DatabaseWatcher:
+    """Reloads FaceNet's database on a background thread, on request or whenever the database file changes"""
+
+    def __init__(self, facenet, path=DATABASE, interval=2., watch=True):
+        """Initializes DatabaseWatcher and starts the watcher thread
+        :param facenet: FaceNet object
+        :param path: path to data (default: aisecurity.utils.paths.DATABASE)
+        :param interval: seconds between checks of the database file (default: 2.)
+        :param watch: reload when the file changes-- if False, only reload() triggers reloads (default: True)
+        """
+
+        self.facenet = facenet
+        self.path = path
+        self.interval = interval
+        self.watch = watch
+
+        self.stats = {"reloads": 0, "failures": 0, "people": None, "reload_time": None}
+
+        self._signature = self._stat()  # signature of the file that was last loaded
+        self._changed = None  # signature of a change seen on the previous check
+        self._requested = threading.Event()
+        self._stopped = threading.Event()
+
+        self._thread = threading.Thread(target=self._run, name="aisecurity-reload", daemon=True)
+        self._thread.start()
+
+    # PUBLIC
+    def reload(self):
+        """Requests a reload without blocking"""
+        self._requested.set()
+
+    def close(self, timeout=None):
+        """Stops the watcher thread (a reload in progress is finished first)
+        :param timeout: seconds to wait for the watcher thread (default: None, wait forever)
+        """
+
+        self._stopped.set()
+        self._requested.set()
+        self._thread.join(timeout)
+
+    # WATCHER THREAD
+    def _stat(self):
+        try:
+            stat = os.stat(self.path)
+            return stat.st_mtime_ns, stat.st_size
+        except OSError:
+            return None
+
+    def _run(self):
+        while True:
+            self._requested.wait(self.interval)
+            if self._stopped.is_set():
+                return
+
+            if self._requested.is_set():
+                self._requested.clear()
+                self._reload()
+
+            elif self.watch:
+                signature = self._stat()
+                if signature is None or signature == self._signature:
+                    self._changed = None
+                elif signature == self._changed:
+                    # unchanged for a whole interval, so the writer is done with the file
+                    self._reload()
+                else:
+                    self._changed = signature
+
+    def _reload(self):
+        signature = self._stat()
+        start = timer()
+
+        try:
+            people = self.facenet.reload_data(self.path)
+        except Exception as error:
+            # the old database stays in use until the file changes again
+            self.stats["failures"] += 1
+            warnings.warn("database reload from {} failed: {}".format(self.path, error))
+            return
+        finally:
+            self._signature, self._changed = signature, None
+
+        self.stats["reloads"] += 1
+        self.stats["people"] = people
+        self.stats["reload_time"] = timer() - start
+
+        print("[DEBUG] Database reloaded ({} people) in {}s".format(people, round(self.stats["reload_time"], 4)))
@@ -0,0 +1,330 @@
+"""
+
+"aisecurity.dataflow.shared"
+
+Read-only embedding gallery in memory-mapped files, shared by every recognition process on a machine.
+
+"""
+
+import contextlib
+import fcntl
+import json
+import os
+
+import numpy as np
+
+from aisecurity.utils.paths import CONFIG_HOME
+
+
+################################ Setup and helpers ###############################
+
+# GLOBALS
+DEFAULT_DIR = "/dev/shm/aisecurity" if os.path.isdir("/dev/shm") else CONFIG_HOME + "/gallery"
+
+KEEP_GENERATIONS = 2  # current and previous: processes still attached to older generations keep their mappings
+
+
+# FILES
+def _paths(directory, generation):
+    prefix = os.path.join(directory, "gallery.{}".format(generation))
+    return {"embeds": prefix + ".embeds.npy", "labels": prefix + ".labels.npy", "sqnorms": prefix + ".sqnorms.npy",
+            "table": prefix + ".json"}
+
+
+def current_generation(directory=DEFAULT_DIR):
+    """Generation number of the latest publish (cheap enough to check every frame)
+    :param directory: gallery directory (default: DEFAULT_DIR)
+    :returns: generation number, None if nothing has been published
+    """
+
+    try:
+        with open(os.path.join(directory, "current.json"), encoding="utf-8") as file:
+            return json.load(file)["generation"]
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def _replace(path, write):
+    # write to a temporary file and rename so that readers never see a partial file
+    with open(path + ".tmp", "wb") as file:
+        write(file)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(path + ".tmp", path)
+
+
+@contextlib.contextmanager
+def _publish_lock(directory):
+    # serializes publishers across processes; readers never take the lock
+    with open(os.path.join(directory, ".lock"), "w") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def _write_generation(directory, data, config):
+    generation = current_generation(directory)
+    generation = 0 if generation is None else generation + 1
+
+    classes = sorted(data)
+    labels, embeds = [], []
+    for label, name in enumerate(classes):
+        for embed in data[name]:
+            labels.append(label)
+            embeds.append(np.asarray(embed, dtype=np.float32).reshape(-1))
+
+    assert embeds, "gallery must contain at least one embedding"
+
+    embeds = np.stack(embeds)
+    labels = np.array(labels, dtype=np.int32)
+    sqnorms = np.einsum("ij,ij->i", embeds, embeds)
+
+    paths = _paths(directory, generation)
+    _replace(paths["embeds"], lambda file: np.save(file, embeds))
+    _replace(paths["labels"], lambda file: np.save(file, labels))
+    _replace(paths["sqnorms"], lambda file: np.save(file, sqnorms))
+    _replace(paths["table"], lambda file: file.write(json.dumps({"classes": classes, "config": config}).encode()))
+
+    # the pointer is swapped last, so readers see either the old or the new generation, never a mix
+    pointer = json.dumps({"generation": generation}).encode()
+    _replace(os.path.join(directory, "current.json"), lambda file: file.write(pointer))
+
+    for old in range(generation - KEEP_GENERATIONS, -1, -1):
+        old_paths = _paths(directory, old)
+        if not os.path.exists(old_paths["table"]):
+            break
+        for path in old_paths.values():
+            os.unlink(path)  # mappings in attached processes stay valid after unlink
+
+    return generation
+
+
+def publish(data, directory=DEFAULT_DIR, config=None):
+    """Publishes a gallery as a new generation
+    :param data: gallery in form {name: [embedding, ...], ...}
+    :param directory: gallery directory (default: DEFAULT_DIR, in /dev/shm if available)
+    :param config: data config dict, ex: {"metric": "cosine+l2_normalize"} (default: None)
+    :returns: new generation number
+    """
+
+    os.makedirs(directory, exist_ok=True)
+    with _publish_lock(directory):
+        return _write_generation(directory, data, config)
+
+
+################################ Shared gallery ###############################
+class SharedGallery:
+    """Zero-copy view of the current published gallery generation"""
+
+    def __init__(self, directory=DEFAULT_DIR):
+        """Initializes SharedGallery (call attach() before use)
+        :param directory: gallery directory (default: DEFAULT_DIR)
+        """
+
+        self.directory = directory
+
+        self.generation = None
+        self.embeds = None  # read-only float32 memmap with shape (num_embeds, embed_dim)
+        self.labels = None  # read-only int32 memmap, index into self.classes for every row
+        self.sqnorms = None  # read-only float32 memmap of squared row norms
+        self.classes = None  # sorted names
+        self.config = None
+
+        self._data = None
+
+    def __len__(self):
+        return len(self.embeds) if self.embeds is not None else 0
+
+    # ATTACHMENT
+    def attach(self):
+        """Maps the current generation
+        :returns: self
+        """
+
+        generation = current_generation(self.directory)
+        assert generation is not None, "no gallery published in {}".format(self.directory)
+
+        paths = _paths(self.directory, generation)
+        with open(paths["table"], encoding="utf-8") as file:
+            table = json.load(file)
+
+        # everything is opened before anything is replaced, so a failed attach keeps the previous generation whole
+        embeds = np.load(paths["embeds"], mmap_mode="r")
+        labels = np.load(paths["labels"], mmap_mode="r")
+        sqnorms = np.load(paths["sqnorms"], mmap_mode="r")
+
+        self.embeds, self.labels, self.sqnorms = embeds, labels, sqnorms
+        self.classes = table["classes"]
+        self.config = table["config"]
+        self.generation = generation
+        self._data = None
+
+        return self
+
+    def refresh(self):
+        """Attaches a newer generation if one has been published-- safe to call on the frame path: if the generation
+        is unlinked by later publishes before it could be opened, the current mapping is kept until the next call
+        :returns: whether or not a new generation was attached
+        """
+
+        generation = current_generation(self.directory)
+        if generation is None or generation == self.generation:
+            return False
+
+        try:
+            self.attach()
+        except OSError:
+            return False
+        return True
+
+    def update(self, updates):
+        """Publishes a new generation with embeddings added to existing entries
+        :param updates: new embeddings in form {name: [embedding, ...], ...}
+        :returns: new generation number
+        """
+
+        with _publish_lock(self.directory):
+            self.refresh()
+
+            data = {name: list(embeds) for name, embeds in self.data.items()}
+            for name, embeds in updates.items():
+                data.setdefault(name, []).extend(embeds)
+
+            generation = _write_generation(self.directory, data, self.config)
+
+        self.attach()
+        return generation
+
+    # RETRIEVERS
+    @property
+    def data(self):
+        """Property for gallery as a dict (values are views into the mapping, not copies)
+        :returns: {name: embeddings, ...}
+        """
+
+        if self._data is None:
+            # rows are grouped by name, so every entry is a single (num_embeds, embed_dim) view
+            bounds = np.searchsorted(self.labels, np.arange(len(self.classes) + 1))
+            self._data = {name: self.embeds[bounds[idx]:bounds[idx + 1]] for idx, name in enumerate(self.classes)}
+
+        return self._data
+
+    @property
+    def names(self):
+        """Property for row names (ex: FaceNet.expanded_names)
+        :returns: list with the name of every row
+        """
+
+        return [self.classes[label] for label in self.labels]
+
+
+class GalleryKNN:
+    """Brute-force K-NN classifier on a SharedGallery, a drop-in for a fitted sklearn KNeighborsClassifier"""
+
+    def __init__(self, gallery, n_neighbors=None):
+        """Initializes GalleryKNN
+        :param gallery: attached SharedGallery
+        :param n_neighbors: number of neighbors (default: None, embeddings per person like FaceNet._train_knn)
+        """
+
+        # arrays are captured so that a later gallery.refresh() can't mix generations within a prediction
+        self.embeds, self.labels, self.sqnorms, self.classes = gallery.embeds, gallery.labels, gallery.sqnorms, \
+            gallery.classes
+        self.n_neighbors = n_neighbors if n_neighbors else max(len(self.embeds) // len(self.classes), 1)
+
+    def predict(self, embeds):
+        """Majority label of the nearest neighbors (ties go to the first name, like sklearn)
+        :param embeds: embeddings with shape (batch_size, embed_dim)
+        :returns: array of names
+        """
+
+        embeds = np.asarray(embeds, dtype=np.float32).reshape(-1, self.embeds.shape[1])
+        k = min(self.n_neighbors, len(self.embeds))
+
+        # squared euclidean distance without materializing (num_embeds, embed_dim) differences
+        sq_dists = self.sqnorms - 2. * np.dot(embeds, self.embeds.T)
+
+        predictions = []
+        for row in sq_dists:
+            nearest = np.argpartition(row, k - 1)[:k]
+            votes = np.bincount(self.labels[nearest], minlength=len(self.classes))
+            predictions.append(self.classes[int(np.argmax(votes))])
+
+        return np.array(predictions)
+
+
+################################ Publish and memory benchmark ###############################
+if __name__ == "__main__":
+    import argparse
+    import time
+
+    from sklearn import neighbors
+
+
+    def pss_kib(pid):
+        # proportional set size: shared pages are split between the processes mapping them
+        with open("/proc/{}/smaps_rollup".format(pid)) as file:
+            for line in file:
+                if line.startswith("Pss:"):
+                    return int(line.split()[1])
+
+    def worker(mode, directory, data, ready):
+        if mode == "shared":
+            gallery = SharedGallery(directory).attach()
+            knn = GalleryKNN(gallery)
+            query = gallery.embeds[0]
+        else:
+            # private copy of the database, like FaceNet._train_knn
+            names = [name for name, embeds in data.items() for __ in embeds]
+            embeds = [embed.copy() for values in data.values() for embed in values]
+            knn = neighbors.KNeighborsClassifier(n_neighbors=len(names) // len(data)).fit(embeds, names)
+            query = embeds[0]
+
+        knn.predict(query.reshape(1, -1))
+        os.write(ready, b"1")
+        time.sleep(60)
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--publish", help="publish the encrypted database instead of benchmarking",
+                        action="store_true")
+    parser.add_argument("--directory", help="gallery directory", type=str, default=DEFAULT_DIR)
+    parser.add_argument("--people", help="benchmark gallery size (people)", type=int, default=5000)
+    parser.add_argument("--embeds_per_person", help="benchmark embeddings per person", type=int, default=10)
+    args = parser.parse_args()
+
+    if args.publish:
+        from aisecurity.dataflow.loader import retrieve_embeds
+        from aisecurity.utils.paths import DATABASE_INFO
+
+        print("Published generation {}".format(publish(retrieve_embeds(), args.directory, config=DATABASE_INFO)))
+
+    else:
+        rng = np.random.RandomState(0)
+        bench_data = {"person_{}".format(idx): list(rng.randn(args.embeds_per_person, 128).astype(np.float32))
+                      for idx in range(args.people)}
+        bench_dir = args.directory + "_bench"
+        publish(bench_data, bench_dir)
+
+        for bench_mode in ("private", "shared"):
+            for num_workers in (1, 4):
+                read_fd, write_fd = os.pipe()
+                pids = []
+                for __ in range(num_workers):
+                    pid = os.fork()
+                    if pid == 0:
+                        worker(bench_mode, bench_dir, bench_data, write_fd)
+                        os._exit(0)
+                    pids.append(pid)
+
+                for __ in pids:
+                    os.read(read_fd, 1)
+                total = sum(pss_kib(pid) for pid in pids)
+
+                for pid in pids:
+                    os.kill(pid, 9)
+                    os.waitpid(pid, 0)
+
+                print("{} gallery, {} worker(s): {} MiB total PSS".format(bench_mode, num_workers,
+                                                                          round(total / 1024., 1)))
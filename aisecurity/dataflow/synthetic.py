@@ -0,0 +1,410 @@
+"""
+
+"aisecurity.dataflow.synthetic"
+
+Synthetic identity galleries and query streams for scaling tests.
+
+"""
+
+import gc
+import json
+import os
+import shutil
+import tempfile
+from timeit import default_timer as timer
+
+import numpy as np
+
+from aisecurity.dataflow import shared
+from aisecurity.dataflow.loader import dump_and_encrypt, retrieve_embeds
+from aisecurity.utils.distance import DistMetric
+
+
+################################ Setup and helpers ###############################
+
+# GLOBALS
+ALPHA = 0.75  # FaceNet.ALPHA-- not imported so that generating galleries doesn't load tensorflow
+
+EMBED_DIM = 128
+
+
+# HELPERS
+def _l2_normalize(x):
+    return x / np.linalg.norm(x, axis=-1, keepdims=True)
+
+
+def _rss_mb():
+    # resident set size of this process, None where /proc isn't available
+    try:
+        with open("/proc/self/statm") as file:
+            return int(file.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2. ** 20
+    except (OSError, ValueError):
+        return None
+
+
+################################ Synthetic identities ###############################
+class SyntheticIdentities:
+    """Clustered identity embeddings calibrated so that genuine and impostor distances under a DistMetric look like
+    FaceNet's: identities sit around a few "demographic" centroids, and embeddings of one identity scatter around its
+    center by an amount chosen so that genuine distances land at genuine_ratio * alpha"""
+
+    def __init__(self, num_people, embed_dim=EMBED_DIM, metric="euclidean+l2_normalize", alpha=ALPHA,
+                 genuine_ratio=0.7, num_clusters=16, identity_spread=1.5, quality_spread=0.25, seed=0):
+        """Initializes SyntheticIdentities and calibrates the per-identity spread
+        :param num_people: number of identities
+        :param embed_dim: embedding dimension (default: 128)
+        :param metric: DistMetric str constructor, as in the database config (default: "euclidean+l2_normalize")
+        :param alpha: recognition threshold (default: 0.75, FaceNet.ALPHA)
+        :param genuine_ratio: median genuine distance as a fraction of alpha (default: 0.7)
+        :param num_clusters: number of centroids that identities are clustered around (default: 16)
+        :param identity_spread: distance of identities from their centroid, relative to the centroid norm--
+                                smaller means more lookalikes (default: 1.5)
+        :param quality_spread: log-normal sigma of per-sample noise, like pose and lighting varying between frames--
+                               0. makes every sample equally far from its center (default: 0.25)
+        :param seed: random seed-- same seed, same identities, gallery, and queries (default: 0)
+        """
+
+        self.num_people = num_people
+        self.embed_dim = embed_dim
+        self.metric = metric
+        self.alpha = alpha
+        self.identity_spread = identity_spread
+        self.quality_spread = quality_spread
+        self.seed = seed
+
+        rng = np.random.RandomState(seed)
+        self._centroids = _l2_normalize(rng.randn(num_clusters, embed_dim))
+        self.centers = self._new_centers(num_people, rng)
+        self.names = ["synthetic_{:07d}".format(idx) for idx in range(num_people)]
+
+        # statistics for normalizations like subtract_mean come from the centers, not from a particular gallery
+        self.dist_metric = DistMetric(metric, data=self.centers, axis=0)
+
+        self.spread = None
+        self.stats = {}
+        self._calibrate(genuine_ratio * alpha, np.random.RandomState(seed + 1))
+
+    # GENERATION
+    def _new_centers(self, num, rng):
+        centroids = self._centroids[rng.randint(len(self._centroids), size=num)]
+        noise = rng.randn(num, self.embed_dim) * self.identity_spread / np.sqrt(self.embed_dim)
+        return _l2_normalize(centroids + noise).astype(np.float32)
+
+    def _sample(self, centers, rng, spread=None):
+        # FaceNet embeddings are l2-normalized by the model, so samples are too (whatever the metric)
+        spread = self.spread if spread is None else spread
+        noise = rng.randn(*centers.shape) * spread / np.sqrt(self.embed_dim)
+        noise *= rng.lognormal(0., self.quality_spread, size=(len(centers), 1))
+        return _l2_normalize(centers + noise).astype(np.float32)
+
+    def _distances(self, a, b):
+        return np.array([self.dist_metric.distance(x.reshape(1, -1), y.reshape(1, -1)) for x, y in zip(a, b)])
+
+    def _calibrate(self, target, rng, num_pairs=256, iterations=30):
+        # genuine distance grows monotonically with spread, so bisect on spread (in log space) until the median
+        # distance between two samples of one identity hits the target
+        centers = self.centers[rng.randint(self.num_people, size=num_pairs)]
+        noise_rng_state = rng.get_state()
+
+        def median_genuine(spread):
+            rng.set_state(noise_rng_state)  # same noise for every candidate spread
+            return np.median(self._distances(self._sample(centers, rng, spread), self._sample(centers, rng, spread)))
+
+        low, high = np.log(1e-4), np.log(1e2)
+        for __ in range(iterations):
+            mid = (low + high) / 2.
+            if median_genuine(np.exp(mid)) < target:
+                low = mid
+            else:
+                high = mid
+        self.spread = float(np.exp((low + high) / 2.))
+
+        others = self.centers[rng.randint(self.num_people, size=num_pairs)]
+        genuine = self._distances(self._sample(centers, rng), self._sample(centers, rng))
+        impostor = self._distances(self._sample(centers, rng), self._sample(others, rng))
+
+        self.stats = {
+            "spread": self.spread,
+            "genuine_median": float(np.median(genuine)),
+            "impostor_median": float(np.median(impostor)),
+            "genuine_rejected": float(np.mean(genuine > self.alpha)),  # expected false reject rate
+            "impostor_accepted": float(np.mean(impostor <= self.alpha))  # expected false accept rate (1 vs 1)
+        }
+
+    # PUBLIC
+    def gallery(self, embeds_per_person=5, chunk_size=10000):
+        """Enrollment embeddings for every identity
+        :param embeds_per_person: embeddings per identity (default: 5)
+        :param chunk_size: identities generated at once, bounds peak memory for large galleries (default: 10000)
+        :returns: {name: [embedding, ...], ...} like FaceNet.data
+        """
+
+        rng = np.random.RandomState(self.seed + 2)
+
+        data = {}
+        for start in range(0, self.num_people, chunk_size):
+            centers = self.centers[start:start + chunk_size]
+            samples = self._sample(np.repeat(centers, embeds_per_person, axis=0), rng)
+            for idx, name in enumerate(self.names[start:start + chunk_size]):
+                data[name] = list(samples[idx * embeds_per_person:(idx + 1) * embeds_per_person])
+
+        return data
+
+    def queries(self, num_queries, unknown_rate=0.1, frames_per_visit=1, seed=None):
+        """Query stream with ground truth: people walk up and stay for a few frames, some of them unknown
+        :param num_queries: number of query embeddings
+        :param unknown_rate: fraction of visits by identities that aren't in the gallery (default: 0.1)
+        :param frames_per_visit: consecutive queries from the same visit, like frames from a camera (default: 1)
+        :param seed: random seed (default: None, derived from the identities' seed)
+        :returns: float32 array with shape (num_queries, embed_dim), list of true names (None for unknown)
+        """
+
+        rng = np.random.RandomState(self.seed + 3 if seed is None else seed)
+        num_visits = -(-num_queries // frames_per_visit)
+
+        unknown = rng.rand(num_visits) < unknown_rate
+        people = rng.randint(self.num_people, size=num_visits)
+        strangers = self._new_centers(int(unknown.sum()), rng)
+
+        centers = self.centers[people]
+        centers[unknown] = strangers
+
+        embeds = self._sample(np.repeat(centers, frames_per_visit, axis=0), rng)[:num_queries]
+        truth = [None if is_unknown else self.names[person] for person, is_unknown in zip(people, unknown)]
+        truth = [name for name in truth for __ in range(frames_per_visit)][:num_queries]
+
+        return embeds, truth
+
+    def write(self, path, embeds_per_person=5, encrypt=(), name_keys=None, embedding_keys=None):
+        """Writes a gallery in the database format, with a database info file next to it
+        :param path: path to the database json (ex: ~/.aisecurity/database/synthetic.json)
+        :param embeds_per_person: embeddings per identity-- must be 1 if embeddings are encrypted (default: 5)
+        :param encrypt: "names", "embeddings", both, or "all" (default: (), plain)
+        :param name_keys: name key file (default: None, <path without .json>_name_keys.txt-- never the real keys)
+        :param embedding_keys: embedding key file (default: None, <path without .json>_embedding_keys.txt)
+        :returns: database info dict, ex: {"metric": "euclidean+l2_normalize", "encrypted": ["names"]}
+        """
+
+        encrypt = ["names", "embeddings"] if encrypt == "all" else list(encrypt)
+
+        prefix = os.path.splitext(path)[0]
+        name_keys = name_keys if name_keys else prefix + "_name_keys.txt"
+        embedding_keys = embedding_keys if embedding_keys else prefix + "_embedding_keys.txt"
+
+        data = self.gallery(embeds_per_person)
+        if "embeddings" in encrypt:
+            # DataEncryption packs one flat vector per person
+            assert embeds_per_person == 1, "encrypted embeddings support one embedding per person"
+            data = {name: embeds[0] for name, embeds in data.items()}
+
+        dump_and_encrypt(data, path, encrypt=encrypt, name_keys=name_keys, embedding_keys=embedding_keys)
+
+        info = {"metric": self.metric, "encrypted": encrypt}
+        with open(prefix + "_info.json", "w", encoding="utf-8") as file:
+            json.dump(info, file, indent=4)
+
+        return info
+
+
+################################ Scaling sweep ###############################
+def scaling_sweep(sizes=(1000, 10000, 100000), embeds_per_person=5, metric="euclidean+l2_normalize", num_queries=200,
+                  encrypt=(), seed=0, verbose=True):
+    """Measures database write/load, K-NN training, search latency, and memory as the gallery grows
+    :param sizes: gallery sizes in embeddings (default: (1000, 10000, 100000))
+    :param embeds_per_person: embeddings per identity (default: 5)
+    :param metric: DistMetric str constructor (default: "euclidean+l2_normalize")
+    :param num_queries: timed queries per size (default: 200)
+    :param encrypt: encrypted database fields (default: (), plain)
+    :param seed: random seed (default: 0)
+    :param verbose: print results as sizes finish (default: True)
+    :returns: list of dicts, one per size
+    """
+
+    from aisecurity.facenet import FaceNet  # loads tensorflow, so only when sweeping
+
+    embeds_per_person = 1 if "embeddings" in encrypt or encrypt == "all" else embeds_per_person
+
+    results = []
+    tmp_dir = tempfile.mkdtemp()
+
+    try:
+        for size in sorted(sizes):
+            gc.collect()
+
+            identities = SyntheticIdentities(max(size // embeds_per_person, 1), metric=metric, seed=seed)
+            queries, truth = identities.queries(num_queries)
+            dist_metric = identities.dist_metric
+
+            path = os.path.join(tmp_dir, "synthetic_{}.json".format(size))
+            prefix = os.path.splitext(path)[0]
+
+            start = timer()
+            info = identities.write(path, embeds_per_person, encrypt=encrypt)
+            dump_time = timer() - start
+
+            # everything FaceNet does between reading the file and being ready to recognize
+            rss = _rss_mb()
+            start = timer()
+            data = retrieve_embeds(path, encrypted=info["encrypted"], name_keys=prefix + "_name_keys.txt",
+                                   embedding_keys=prefix + "_embedding_keys.txt")
+            data = {name: [np.array(embed).reshape(-1, ) for embed in np.reshape(embeds, (-1, identities.embed_dim))]
+                    for name, embeds in data.items()}
+            load_time = timer() - start
+
+            start = timer()
+            index = FaceNet._build_index(data)
+            index_time = timer() - start
+            index_mb = _rss_mb() - rss if rss is not None else None
+
+            # same search as FaceNet._analyze_embeds: K-NN, then distance to the first row of the best match
+            search_times, correct, false_accepts, false_rejects = [], 0, 0, 0
+            for embed, true_name in zip(queries, truth):
+                embed = embed.reshape(1, -1)
+
+                start = timer()
+                best_match = index["knn"].predict(embed)[0]
+                dist = dist_metric.distance(embed, index["embeds"][index["rows"][best_match]])
+                search_times.append(timer() - start)
+
+                is_recognized = dist <= identities.alpha
+                if true_name is None:
+                    false_accepts += is_recognized
+                    correct += not is_recognized
+                elif is_recognized:
+                    correct += best_match == true_name
+                    false_accepts += best_match != true_name
+                else:
+                    false_rejects += 1
+
+            # shared gallery: memory-mapped, no fitting
+            gallery_dir = os.path.join(tmp_dir, "gallery_{}".format(size))
+            start = timer()
+            shared.publish(data, gallery_dir, config=info)
+            knn = shared.GalleryKNN(shared.SharedGallery(gallery_dir).attach())
+            publish_time = timer() - start
+
+            gallery_times = []
+            for embed in queries:
+                start = timer()
+                knn.predict(embed.reshape(1, -1))
+                gallery_times.append(timer() - start)
+
+            result = {
+                "embeds": size,
+                "people": identities.num_people,
+                "dump_s": dump_time,
+                "file_mb": os.path.getsize(path) / 2. ** 20,
+                "load_s": load_time,
+                "index_s": index_time,
+                "index_mb": index_mb,
+                "raw_mb": size * identities.embed_dim * 4 / 2. ** 20,
+                "search_p50_ms": 1000. * float(np.percentile(search_times, 50)),
+                "search_p95_ms": 1000. * float(np.percentile(search_times, 95)),
+                "publish_s": publish_time,
+                "gallery_search_p50_ms": 1000. * float(np.percentile(gallery_times, 50)),
+                "gallery_search_p95_ms": 1000. * float(np.percentile(gallery_times, 95)),
+                "accuracy": float(correct) / len(truth),
+                "false_accepts": int(false_accepts),
+                "false_rejects": int(false_rejects)
+            }
+            results.append(result)
+
+            if verbose:
+                print("{} embeds: load {}s, index {}s ({} MiB), search {} ms p50, accuracy {}".format(
+                    size, round(load_time, 3), round(index_time, 3),
+                    round(index_mb, 1) if index_mb is not None else None, round(result["search_p50_ms"], 3),
+                    round(result["accuracy"], 3)
+                ))
+
+            del data, index, knn
+            shutil.rmtree(gallery_dir, ignore_errors=True)
+            for file_path in (path, prefix + "_info.json", prefix + "_name_keys.txt", prefix + "_embedding_keys.txt"):
+                if os.path.exists(file_path):
+                    os.unlink(file_path)
+
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    return results
+
+
+def plot_sweep(results, path=None):
+    """Plots latency and memory curves from scaling_sweep
+    :param results: scaling_sweep() result
+    :param path: save the figure here instead of showing it (default: None)
+    """
+
+    import matplotlib.pyplot as plt
+
+    sizes = [result["embeds"] for result in results]
+    fig, (latency_ax, time_ax, memory_ax) = plt.subplots(1, 3, figsize=(16, 5))
+
+    for key, label in (("search_p50_ms", "K-NN search p50"), ("search_p95_ms", "K-NN search p95"),
+                       ("gallery_search_p50_ms", "shared gallery p50")):
+        latency_ax.plot(sizes, [result[key] for result in results], marker="o", label=label)
+    latency_ax.set(xscale="log", yscale="log", xlabel="gallery size (embeddings)", ylabel="ms per query",
+                   title="Search latency")
+
+    for key, label in (("dump_s", "write"), ("load_s", "load"), ("index_s", "K-NN training"),
+                       ("publish_s", "shared gallery publish")):
+        time_ax.plot(sizes, [result[key] for result in results], marker="o", label=label)
+    time_ax.set(xscale="log", yscale="log", xlabel="gallery size (embeddings)", ylabel="s", title="Database setup")
+
+    for key, label in (("index_mb", "load + index (RSS)"), ("raw_mb", "raw float32 embeddings"),
+                       ("file_mb", "database file")):
+        memory_ax.plot(sizes, [result[key] for result in results], marker="o", label=label)
+    memory_ax.set(xscale="log", yscale="log", xlabel="gallery size (embeddings)", ylabel="MiB", title="Memory")
+
+    for ax in (latency_ax, time_ax, memory_ax):
+        ax.legend()
+        ax.grid(True, which="both", alpha=0.3)
+
+    fig.tight_layout()
+    if path:
+        fig.savefig(path)
+        plt.close(fig)
+    else:
+        plt.show()
+
+
+################################ Generator and scaling sweep ###############################
+if __name__ == "__main__":
+    import argparse
+
+
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="command")
+
+    write_parser = subparsers.add_parser("write", help="write a synthetic database")
+    write_parser.add_argument("path", help="path to the database json", type=str)
+    write_parser.add_argument("--people", help="number of identities", type=int, default=10000)
+    write_parser.add_argument("--embeds_per_person", help="embeddings per identity", type=int, default=5)
+    write_parser.add_argument("--metric", help="DistMetric constructor", type=str, default="euclidean+l2_normalize")
+    write_parser.add_argument("--encrypt", help="encrypted fields", type=str, nargs="*", default=[])
+    write_parser.add_argument("--seed", help="random seed", type=int, default=0)
+
+    sweep_parser = subparsers.add_parser("sweep", help="sweep gallery size")
+    sweep_parser.add_argument("--sizes", help="gallery sizes in embeddings", type=int, nargs="+",
+                              default=[1000, 10000, 100000])
+    sweep_parser.add_argument("--embeds_per_person", help="embeddings per identity", type=int, default=5)
+    sweep_parser.add_argument("--metric", help="DistMetric constructor", type=str, default="euclidean+l2_normalize")
+    sweep_parser.add_argument("--encrypt", help="encrypted fields", type=str, nargs="*", default=[])
+    sweep_parser.add_argument("--queries", help="timed queries per size", type=int, default=200)
+    sweep_parser.add_argument("--output", help="write results as JSON to this path", type=str, default=None)
+    sweep_parser.add_argument("--plot", help="save the plot to this path (default: show it)", type=str, default=None)
+    args = parser.parse_args()
+
+    if args.command == "write":
+        synthetic = SyntheticIdentities(args.people, metric=args.metric, seed=args.seed)
+        print("Calibration: {}".format(synthetic.stats))
+        print("Database info: {}".format(synthetic.write(args.path, args.embeds_per_person, encrypt=args.encrypt)))
+
+    elif args.command == "sweep":
+        sweep = scaling_sweep(args.sizes, args.embeds_per_person, args.metric, args.queries, encrypt=args.encrypt)
+        if args.output:
+            with open(args.output, "w", encoding="utf-8") as file:
+                json.dump(sweep, file, indent=4)
+        plot_sweep(sweep, args.plot)
+
+    else:
+        parser.print_help()
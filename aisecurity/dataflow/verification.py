@@ -0,0 +1,301 @@
+"""
+
+"aisecurity.dataflow.verification"
+
+Asynchronous identity verification (console, websocket, or HTTP) with batched gallery updates.
+
+"""
+
+import collections
+import http.server
+import json
+import queue
+import socketserver
+import threading
+from timeit import default_timer as timer
+import uuid
+import warnings
+
+
+################################ Verification queue ###############################
+class VerificationQueue:
+    """Verification requests that are answered asynchronously and turned into batched gallery updates"""
+
+    def __init__(self, max_pending=32, timeout=120., min_interval=1.):
+        """Initializes VerificationQueue
+        :param max_pending: maximum number of unanswered requests-- oldest are discarded beyond this (default: 32)
+        :param timeout: seconds before an unanswered request is discarded (default: 120.)
+        :param min_interval: minimum seconds between batches of gallery updates (default: 1.)
+        """
+
+        self.max_pending = max_pending
+        self.timeout = timeout
+        self.min_interval = min_interval
+
+        self.sources = []
+        self.stats = {"submitted": 0, "answered": 0, "expired": 0, "discarded": 0, "updates": 0, "batches": 0}
+
+        self._lock = threading.Lock()
+        self._pending = collections.OrderedDict()  # request_id: request dict, oldest first
+        self._answers = []  # (name, embedding) updates waiting for the next batch
+        self._last_batch = -min_interval
+
+    # REQUESTS
+    def add_source(self, source):
+        """Adds an answer source
+        :param source: object with notify(request), called from the caller's thread for every new request
+        """
+
+        self.sources.append(source)
+
+    def submit(self, best_match, embedding, recognized=True):
+        """Adds a verification request without blocking
+        :param best_match: best match from database
+        :param embedding: embedding vector
+        :param recognized: whether best_match was recognized-- if not, it is only the nearest match (default: True)
+        :returns: request_id
+        """
+
+        request = {"request_id": uuid.uuid4().hex, "best_match": best_match, "recognized": recognized,
+                   "embedding": embedding, "time": timer()}
+
+        with self._lock:
+            self._pending[request["request_id"]] = request
+            self.stats["submitted"] += 1
+
+            while len(self._pending) > self.max_pending:
+                self._pending.popitem(last=False)
+                self.stats["discarded"] += 1
+
+        for source in self.sources:
+            source.notify(request)
+
+        return request["request_id"]
+
+    def pending(self):
+        """Unanswered requests
+        :returns: list of {"request_id", "best_match", "recognized"} dicts, oldest first
+        """
+
+        with self._lock:
+            return [{"request_id": request_id, "best_match": request["best_match"], "recognized": request["recognized"]}
+                    for request_id, request in self._pending.items()]
+
+    def answer(self, request_id, name=None):
+        """Answers a request (thread-safe, first answer wins)
+        :param request_id: request id
+        :param name: correct name, or None if best_match was correct-- for unrecognized faces, None means nobody in
+                     the database and nothing is updated (default: None)
+        :returns: whether or not the request was still pending
+        """
+
+        with self._lock:
+            request = self._pending.pop(request_id, None)
+            if request is None:
+                return False
+
+            if name or request["recognized"]:
+                self._answers.append((name if name else request["best_match"], request["embedding"]))
+            self.stats["answered"] += 1
+
+        return True
+
+    # UPDATES
+    def drain(self, force=False):
+        """Collects answered requests as gallery updates, at most once every min_interval seconds
+        :param force: ignore min_interval (default: False)
+        :returns: {name: [embedding, ...]} (empty if there is nothing to apply yet)
+        """
+
+        now = timer()
+        if not force and now - self._last_batch < self.min_interval:
+            return {}
+
+        with self._lock:
+            for request_id in [request_id for request_id, request in self._pending.items()
+                               if now - request["time"] > self.timeout]:
+                del self._pending[request_id]
+                self.stats["expired"] += 1
+
+            answers, self._answers = self._answers, []
+
+        updates = {}
+        for name, embedding in answers:
+            updates.setdefault(name, []).append(embedding)
+
+        if updates:
+            self._last_batch = now
+            self.stats["updates"] += len(answers)
+            self.stats["batches"] += 1
+
+        return updates
+
+    def close(self):
+        for source in self.sources:
+            if hasattr(source, "close"):
+                source.close()
+
+
+################################ Answer sources ###############################
+
+# CONSOLE
+class ConsoleVerifier:
+    """Prompts for answers at the console from a background thread"""
+
+    def __init__(self, verifications):
+        self.verifications = verifications
+        self.requests = queue.Queue()
+
+        self._thread = threading.Thread(target=self._run, name="aisecurity-verify-console", daemon=True)
+        self._thread.start()
+
+    def notify(self, request):
+        self.requests.put(request)
+
+    def _run(self):
+        while True:
+            request = self.requests.get()
+            if request is None:
+                break
+
+            best_match = request["best_match"]
+            if not request["recognized"]:
+                name = input("Unknown face (closest: {}). Who are you? (empty if not in the database) ".format(
+                    best_match.replace("_", " ").title())).lower().replace(" ", "_")
+            elif input("Are you {}? ".format(best_match.replace("_", " ").title())).lower()[:1] in ("", "y"):
+                name = None
+            else:
+                name = input("Who are you? ").lower().replace(" ", "_")
+
+            if not self.verifications.answer(request["request_id"], name):
+                print("[DEBUG] Verification for {} expired".format(best_match))
+
+    def close(self):
+        self.requests.put(None)
+
+
+# WEBSOCKET
+class WebsocketVerifier:
+    """Sends requests over the websocket-- an empty answer means best_match was correct, otherwise it is the name.
+    Unknown faces are only announced: websocket answers can't be told apart reliably (servers may not echo request
+    ids), so they are never enrolled from-- the console or HTTP endpoint answers them"""
+
+    def __init__(self, verifications, client):
+        """Initializes WebsocketVerifier
+        :param verifications: VerificationQueue
+        :param client: connection.AsyncClient
+        """
+
+        self.verifications = verifications
+        self.client = client
+
+    def notify(self, request):
+        if not request["recognized"]:
+            # fire-and-forget, tagged so that the server never mistakes it for a recognition of the nearest match
+            self.client.send({"unknown": True, "nearest": request["best_match"]})
+            return
+
+        response = self.client.request({"best_match": request["best_match"]}, kind="best_match")
+        response.add_done_callback(lambda future: self._answer(request["request_id"], future))
+
+    def _answer(self, request_id, future):
+        try:
+            answer = future.result()
+        except (TimeoutError, ConnectionError):
+            return
+
+        self.verifications.answer(request_id, answer.get("name") if isinstance(answer, dict) else answer)
+
+
+# HTTP
+class _ThreadingHTTPServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+
+class HTTPVerifier:
+    """Local HTTP endpoint: GET /pending lists requests, POST /answer {"request_id": ..., "name": ...} answers one"""
+
+    def __init__(self, verifications, host="127.0.0.1", port=8090):
+        """Initializes HTTPVerifier and starts serving
+        :param verifications: VerificationQueue
+        :param host: host to bind to (default: "127.0.0.1", local only)
+        :param port: port to bind to (default: 8090)
+        """
+
+        self.verifications = verifications
+
+        handler = type("VerificationHandler", (_VerificationHandler,), {"verifications": verifications})
+        self.server = _ThreadingHTTPServer((host, port), handler)
+
+        self._thread = threading.Thread(target=self.server.serve_forever, name="aisecurity-verify-http", daemon=True)
+        self._thread.start()
+
+    def notify(self, request):
+        # requests are polled from GET /pending
+        pass
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class _VerificationHandler(http.server.BaseHTTPRequestHandler):
+    verifications = None
+
+    def _reply(self, code, body):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path == "/pending":
+            self._reply(200, self.verifications.pending())
+        else:
+            self._reply(404, {"error": "not found"})
+
+    def do_POST(self):
+        if self.path != "/answer":
+            self._reply(404, {"error": "not found"})
+            return
+
+        try:
+            body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))).decode("utf-8"))
+            answered = self.verifications.answer(body["request_id"], body.get("name"))
+        except (ValueError, KeyError, TypeError) as error:
+            self._reply(400, {"error": str(error)})
+            return
+
+        self._reply(200 if answered else 404, {"answered": answered})
+
+    def log_message(self, format, *args):
+        # keep the console free for recognition output
+        pass
+
+
+# INIT
+def init(client=None, http_port=None, console=None, **kwargs):
+    """Creates a VerificationQueue with answer sources
+    :param client: connection.AsyncClient to send requests over-- unknown faces are only answered by the console or
+                   HTTP endpoint (default: None)
+    :param http_port: port for the local HTTP endpoint (default: None, no endpoint)
+    :param console: prompt at the console (default: None, only if there is no websocket client)
+    :param kwargs: VerificationQueue kwargs
+    :returns: VerificationQueue
+    """
+
+    verifications = VerificationQueue(**kwargs)
+
+    if client:
+        verifications.add_source(WebsocketVerifier(verifications, client))
+    if console or (console is None and not client):
+        verifications.add_source(ConsoleVerifier(verifications))
+    if http_port:
+        try:
+            verifications.add_source(HTTPVerifier(verifications, port=http_port))
+        except OSError as error:
+            warnings.warn("verification endpoint not started: {}".format(error))
+
+    return verifications
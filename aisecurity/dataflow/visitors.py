@@ -0,0 +1,137 @@
+"""
+
+"aisecurity.dataflow.visitors"
+
+Bounded visitor gallery with online clustering and TTL/LRU eviction.
+
+"""
+
+from timeit import default_timer as timer
+
+import numpy as np
+
+
+################################ Visitor store ###############################
+class VisitorStore:
+    """Fixed-capacity store of visitor centroids, searched separately from the static gallery"""
+
+    def __init__(self, merge_threshold, max_visitors=64, ttl=3600., distance=None, clock=timer):
+        """Initializes VisitorStore
+        :param merge_threshold: embeddings within this distance of a visitor are merged into that visitor
+        :param max_visitors: maximum number of visitors-- least recently seen is evicted beyond this (default: 64)
+        :param ttl: seconds after which an unseen visitor is evicted (default: 3600.)
+        :param distance: callable(a, b) used to confirm the nearest visitor, ex: a DistMetric distance
+                         (default: None, Euclidean distance)
+        :param clock: callable returning seconds-- pass a simulated clock for testing (default: timeit.default_timer)
+        """
+
+        self.merge_threshold = merge_threshold
+        self.max_visitors = max_visitors
+        self.ttl = ttl
+        self.distance = distance if distance else lambda a, b: np.linalg.norm(a - b)
+        self.clock = clock
+
+        # slot arrays, allocated with the first embedding
+        self.centroids = None
+        self.counts = np.zeros(max_visitors, dtype=np.int64)
+        self.last_seen = np.full(max_visitors, -np.inf)
+        self.names = [None] * max_visitors
+
+        self.slots = {}  # name: slot
+        self.num_created = 0
+        self.stats = {"created": 0, "merged": 0, "expired": 0, "evicted": 0}
+
+    def __len__(self):
+        return len(self.slots)
+
+    # EVICTION
+    def _free(self, slot):
+        del self.slots[self.names[slot]]
+        self.names[slot] = None
+        self.counts[slot] = 0
+        self.last_seen[slot] = -np.inf
+
+    def expire(self, now=None):
+        """Evicts visitors that haven't been seen for ttl seconds
+        :param now: current clock() (default: None, self.clock())
+        """
+
+        now = now if now is not None else self.clock()
+
+        for slot in np.flatnonzero((self.counts > 0) & (now - self.last_seen > self.ttl)):
+            self._free(slot)
+            self.stats["expired"] += 1
+
+    # SEARCH
+    def nearest(self, embedding, now=None):
+        """Nearest visitor that hasn't expired (the candidate is chosen by Euclidean distance, like K-NN on the static
+        gallery)-- expired visitors are skipped here and evicted by the next add()
+        :param embedding: normalized embedding
+        :param now: current clock() (default: None, self.clock())
+        :returns: name, distance (None, None if there are no visitors)
+        """
+
+        if not self.slots:
+            return None, None
+
+        now = now if now is not None else self.clock()
+        embedding = np.asarray(embedding).reshape(-1)
+
+        sq_dists = np.einsum("ij,ij->i", self.centroids - embedding, self.centroids - embedding)
+        sq_dists[(self.counts == 0) | (now - self.last_seen > self.ttl)] = np.inf
+        slot = int(np.argmin(sq_dists))
+
+        if np.isinf(sq_dists[slot]):
+            return None, None
+
+        return self.names[slot], self.distance(embedding, self.centroids[slot])
+
+    def touch(self, name):
+        """Marks a visitor as seen
+        :param name: visitor name
+        """
+
+        self.last_seen[self.slots[name]] = self.clock()
+
+    # UPDATES
+    def add(self, embedding):
+        """Merges an unknown embedding into the nearest visitor, or creates a new visitor
+        :param embedding: normalized embedding
+        :returns: visitor name, whether or not the visitor was created
+        """
+
+        now = self.clock()
+        embedding = np.asarray(embedding, dtype=np.float64).reshape(-1)
+
+        self.expire(now)
+
+        name, dist = self.nearest(embedding, now)
+        if name is not None and dist <= self.merge_threshold:
+            slot = self.slots[name]
+            self.counts[slot] += 1
+            self.centroids[slot] += (embedding - self.centroids[slot]) / self.counts[slot]  # running mean
+            self.last_seen[slot] = now
+            self.stats["merged"] += 1
+            return name, False
+
+        if self.centroids is None:
+            self.centroids = np.zeros((self.max_visitors, len(embedding)))
+
+        if len(self.slots) < self.max_visitors:
+            slot = self.names.index(None)
+        else:
+            slot = int(np.argmin(self.last_seen))
+            self._free(slot)
+            self.stats["evicted"] += 1
+
+        self.num_created += 1
+        name = "visitor_{}".format(self.num_created)
+
+        self.names[slot] = name
+        self.slots[name] = slot
+        self.centroids[slot] = embedding
+        self.counts[slot] = 1
+        self.last_seen[slot] = now
+        self.stats["created"] += 1
+
+        return name, True
@@ -1,2 +1,7 @@
+from . import buffer
 from . import connection
 from . import log
+from . import pool
+from . import query
+from . import snapshots
+from . import writer
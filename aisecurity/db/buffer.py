@@ -0,0 +1,205 @@
+"""
+
+"aisecurity.db.buffer"
+
+Local SQLite store-and-forward buffer for offline logging.
+
+"""
+
+import json
+import sqlite3
+import threading
+import warnings
+
+
+################################ Local buffer ###############################
+class LocalBuffer:
+    """Durable SQLite (WAL) event buffer that forwards events to a remote sink in batches when it is reachable--
+    events that the remote keeps rejecting are moved to a dead-letter table so that they don't block the rest"""
+
+    SCHEMA = [
+        "CREATE TABLE IF NOT EXISTS events (seq INTEGER PRIMARY KEY AUTOINCREMENT, event_id TEXT UNIQUE, "
+        "table_name TEXT, data TEXT);",
+        "CREATE TABLE IF NOT EXISTS dead_letter (seq INTEGER PRIMARY KEY, event_id TEXT, table_name TEXT, data TEXT, "
+        "error TEXT);"
+    ]
+
+    def __init__(self, path, connect, sink=None, max_backlog=100000, batch_size=500, interval=1., backoff=1.,
+                 max_backoff=60., transient_errors=(OSError,), max_attempts=3):
+        """Initializes LocalBuffer and starts the forwarder thread
+        :param path: path to buffer database file
+        :param connect: callable that returns a sink (object with write(events)), raising if the remote is down
+        :param sink: already-connected sink, if any (default: None)
+        :param max_backlog: maximum number of buffered events-- oldest events are evicted beyond this (default: 100000)
+        :param batch_size: maximum events per forwarded batch (default: 500)
+        :param interval: seconds between forwarding passes when idle (default: 1.)
+        :param backoff: initial delay in seconds after a failed connect or write, doubled each time (default: 1.)
+        :param max_backoff: maximum delay in seconds (default: 60.)
+        :param transient_errors: sink errors that mean the remote is unreachable-- anything else is blamed on the
+                                 events themselves (ex: IntegrityError, schema mismatch) (default: (OSError,))
+        :param max_attempts: rejections of an event before it is moved to the dead-letter table (default: 3)
+        """
+
+        self.path = path
+        self.connect = connect
+        self.max_backlog = max_backlog
+        self.batch_size = batch_size
+        self.interval = interval
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.transient_errors = tuple(transient_errors)
+        self.max_attempts = max_attempts
+
+        self.sink = sink
+        self.stats = {"buffered": 0, "forwarded": 0, "evicted": 0, "failures": 0, "rejected": 0, "dead_lettered": 0}
+
+        self._attempts = {}  # seq: rejections so far
+
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL;")
+        self._db.execute("PRAGMA synchronous=NORMAL;")
+        for cmd in self.SCHEMA:
+            self._db.execute(cmd)
+        self._db.commit()
+
+        self.backlog = self._db.execute("SELECT COUNT(*) FROM events;").fetchone()[0]
+
+        self._closing = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="aisecurity-db-forwarder", daemon=True)
+        self._thread.start()
+
+    # BUFFERING
+    def put(self, table, data):
+        """Durably buffers an event (data must contain a unique "event_id")
+        :param table: table name ("Activity" or "Unknown")
+        :param data: dict of column: value
+        """
+
+        with self._lock:
+            cursor = self._db.execute(
+                "INSERT OR IGNORE INTO events (event_id, table_name, data) VALUES (?, ?, ?);",
+                (data["event_id"], table, json.dumps(data))
+            )
+            self.backlog += cursor.rowcount
+            self.stats["buffered"] += cursor.rowcount  # 0 if event_id was already buffered
+
+            if self.backlog > self.max_backlog:
+                evicted = self._db.execute(
+                    "DELETE FROM events WHERE seq IN (SELECT seq FROM events ORDER BY seq LIMIT ?);",
+                    (self.backlog - self.max_backlog,)
+                ).rowcount
+                self.backlog -= evicted
+                self.stats["evicted"] += evicted
+
+            self._db.commit()
+
+    # FORWARDING
+    def _oldest(self):
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT seq, table_name, data FROM events ORDER BY seq LIMIT ?;", (self.batch_size,)
+            ).fetchall()
+        return rows
+
+    def _remove(self, seqs):
+        with self._lock:
+            removed = self._db.executemany("DELETE FROM events WHERE seq = ?;", [(seq,) for seq in seqs]).rowcount
+            self._db.commit()
+            self.backlog -= removed
+        for seq in seqs:
+            self._attempts.pop(seq, None)
+        return removed
+
+    def _dead_letter(self, row, error):
+        seq, table, data = row
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO dead_letter (seq, event_id, table_name, data, error) VALUES (?, ?, ?, ?, ?);",
+                (seq, json.loads(data).get("event_id"), table, data, repr(error))
+            )
+            self._db.commit()
+        self._remove([seq])
+
+        self.stats["dead_lettered"] += 1
+        warnings.warn("log event {} rejected {} times, moved to dead_letter: {}".format(seq, self.max_attempts, error))
+
+    @staticmethod
+    def _events(rows):
+        return [{"table": table, "data": json.loads(data)} for __, table, data in rows]
+
+    def _forward_each(self, rows):
+        # a batch was rejected: write its events one at a time so that only the bad ones are held back
+        forwarded = []
+        try:
+            for row in rows:
+                try:
+                    self.sink.write(self._events([row]))
+                    forwarded.append(row[0])
+                except self.transient_errors:
+                    raise
+                except Exception as error:
+                    self.stats["rejected"] += 1
+                    self._attempts[row[0]] = self._attempts.get(row[0], 0) + 1
+                    if self._attempts[row[0]] >= self.max_attempts:
+                        self._dead_letter(row, error)
+        finally:
+            self.stats["forwarded"] += self._remove(forwarded)
+
+        return len(forwarded)
+
+    def forward(self):
+        """Forwards one batch to the remote sink (idempotent: events are only deleted after a successful write)
+        :returns: number of events forwarded
+        """
+
+        rows = self._oldest()
+        if not rows:
+            return 0
+
+        if self.sink is None:
+            self.sink = self.connect()
+
+        try:
+            self.sink.write(self._events(rows))
+        except self.transient_errors:
+            raise
+        except Exception:
+            return self._forward_each(rows)
+
+        self.stats["forwarded"] += self._remove([seq for seq, __, __ in rows])
+
+        return len(rows)
+
+    def _run(self):
+        delay = self.backoff
+
+        while True:
+            try:
+                forwarded = self.forward()
+                delay = self.backoff
+            except Exception as error:
+                # connect() failed or the sink raised one of transient_errors-- a connected sink is kept rather than
+                # reconnected, since its pool already replaces lost connections (and a new pool per retry would leak
+                # the old one's connections)
+                self.stats["failures"] += 1
+                if self.stats["failures"] == 1:
+                    warnings.warn("remote log database unreachable, buffering locally: {}".format(error))
+
+                if self._closing.wait(delay):
+                    break
+                delay = min(2. * delay, self.max_backoff)
+                continue
+
+            if forwarded == 0 and self._closing.is_set():
+                break
+            elif forwarded < self.batch_size:
+                self._closing.wait(self.interval)
+
+    def close(self, timeout=None):
+        """Stops the forwarder after a final forwarding pass-- unforwarded events stay on disk
+        :param timeout: seconds to wait for the forwarder (default: None, wait forever)
+        """
+
+        self._closing.set()
+        self._thread.join(timeout)
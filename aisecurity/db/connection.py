@@ -6,82 +6,328 @@ Handles connection to websocket.
 
 """
 
-import functools
-import gc
+import asyncio
+import collections
+import concurrent.futures
 import json
+import threading
+import uuid
+import warnings
 
-import websocket
+import websockets
 
 
 ################################ Setup and helpers ###############################
 
 # GLOBALS
-FAIL_THRESHOLD = 3
-
 SOCKET = None
-SOCKET_ADDRESS = None
 
-RECV = None
 
+################################ Websocket ###############################
+class AsyncClient:
+    """Websocket client that runs an asyncio loop in a background thread so that callers never block on the network"""
+
+    def __init__(self, address, hello=None, max_queue=256, backoff=0.5, max_backoff=30., request_timeout=10.,
+                 on_message=None, ordered_kind=None):
+        """Initializes AsyncClient and starts connecting in the background
+        :param address: websocket address (ex: "ws://localhost:8000/v1/nano")
+        :param hello: message sent on every (re)connect (default: None)
+        :param max_queue: maximum number of unsent messages-- new messages are dropped when full (default: 256)
+        :param backoff: initial reconnect delay in seconds, doubled after each failed attempt (default: 0.5)
+        :param max_backoff: maximum reconnect delay in seconds (default: 30.)
+        :param request_timeout: seconds before an unanswered request fails with TimeoutError (default: 10.)
+        :param on_message: callable(message) called from the client thread for messages that aren't responses
+                           (default: None)
+        :param ordered_kind: request kind that the server answers in order without echoing "request_id" (ex:
+                             "best_match" for servers written for the old blocking client)-- an answer without
+                             "request_id" resolves the oldest pending request of this kind, so such a server must not
+                             push messages of its own (default: None, answers are only matched by "request_id")
+        """
+
+        self.address = address
+        self.hello = hello
+        self.max_queue = max_queue
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.request_timeout = request_timeout
+        self.on_message = on_message
+        self.ordered_kind = ordered_kind
+
+        self.connected = threading.Event()
+        self.stats = {"requested": 0, "sent": 0, "coalesced": 0, "dropped": 0, "received": 0, "connects": 0,
+                      "timeouts": 0}
+
+        # only touched from the loop thread
+        self._pending = collections.OrderedDict()  # coalesce key: message, oldest first
+        self._requests = collections.OrderedDict()  # request_id: concurrent.futures.Future, oldest first
+        self._ordered = collections.OrderedDict()  # request_ids of kind ordered_kind, oldest first
+        self._closing = False
+
+        self.loop = asyncio.new_event_loop()
+        self._wakeup, self._stop = None, None  # asyncio.Events, created in the loop thread
+        self._thread = threading.Thread(target=self._run, name="aisecurity-websocket", daemon=True)
+        self._thread.start()
+
+    # PUBLIC (thread-safe)
+    def send(self, message, coalesce=None):
+        """Queues a message without blocking
+        :param message: JSON-serializable dict
+        :param coalesce: key for messages that only matter in their latest version (ex: "lcd")-- a queued message
+                         with the same key is replaced instead of sent (default: None, never coalesced)
+        """
+
+        self.loop.call_soon_threadsafe(self._enqueue, coalesce if coalesce else uuid.uuid4().hex, message)
+
+    def request(self, message, timeout=None, kind=None):
+        """Sends a message and returns a future for the response with the same "request_id"
+        :param message: JSON-serializable dict
+        :param timeout: seconds before the future fails with TimeoutError (default: None, self.request_timeout)
+        :param kind: request kind (ex: "best_match")-- requests of kind self.ordered_kind can also be answered without
+                     "request_id" (default: None)
+        :returns: concurrent.futures.Future resolved with the response dict
+        """
+
+        request_id = uuid.uuid4().hex
+        future = concurrent.futures.Future()
+
+        self.loop.call_soon_threadsafe(self._register, request_id, future, timeout or self.request_timeout, kind)
+        self.loop.call_soon_threadsafe(self._enqueue, request_id, {"request_id": request_id, **message})
+
+        return future
 
-# DECORATORS
-def check_fail(func):
-    @functools.wraps(func)
-    def _func(*args, **kwargs):
-        failures = 0
-        while failures < FAIL_THRESHOLD:
+    def close(self, timeout=None):
+        """Sends queued messages if connected and stops the client
+        :param timeout: seconds to wait for the client thread (default: None, wait forever)
+        """
+
+        try:
+            self.loop.call_soon_threadsafe(self._close)
+        except RuntimeError:
+            pass  # already closed: the loop is closed once the client thread exits
+        self._thread.join(timeout)
+
+    # QUEUEING (loop thread)
+    def _enqueue(self, key, message):
+        if key in self._pending:
+            self.stats["coalesced"] += 1
+        elif len(self._pending) >= self.max_queue:
+            self.stats["dropped"] += 1
+            self._fail(key, ConnectionError("websocket send queue full"))
+            return
+
+        self._pending[key] = message
+        self._wakeup.set()
+
+    def _register(self, request_id, future, timeout, kind):
+        self._requests[request_id] = future
+        if kind is not None and kind == self.ordered_kind:
+            self._ordered[request_id] = None
+        self.stats["requested"] += 1
+        self.loop.call_later(timeout, self._expire, request_id)
+
+    def _expire(self, request_id):
+        if request_id in self._requests:
+            self.stats["timeouts"] += 1
+            self._pending.pop(request_id, None)
+            self._fail(request_id, TimeoutError("no response to websocket request"))
+
+    def _fail(self, request_id, error):
+        self._ordered.pop(request_id, None)
+        future = self._requests.pop(request_id, None)
+        if future and not future.done():
+            future.set_exception(error)
+
+    def _close(self):
+        self._closing = True
+        self._wakeup.set()
+        self._stop.set()
+
+    # CONNECTION (loop thread)
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        self._wakeup, self._stop = asyncio.Event(), asyncio.Event()
+        self.loop.run_until_complete(self._main())
+
+        for request_id in list(self._requests):
+            self._fail(request_id, ConnectionError("websocket client closed"))
+        self.loop.close()
+
+    async def _main(self):
+        delay = self.backoff
+        warn = True
+
+        while not self._closing:
             try:
-                return func(*args, **kwargs)
-            except Exception as e:
-                print("[ERROR] {} ({})".format(e, failures))
-                _connect(SOCKET_ADDRESS)
-                failures += 1
+                async with websockets.connect(self.address) as ws:
+                    self.connected.set()
+                    self.stats["connects"] += 1
+                    delay, warn = self.backoff, True
 
-        print("[ERROR] fail threshold passed".format(func))
-        return False
+                    if self.hello:
+                        await ws.send(json.dumps(self.hello))
 
-    return _func
+                    sender = asyncio.ensure_future(self._sender(ws))
+                    receiver = asyncio.ensure_future(self._receiver(ws))
+                    done, __ = await asyncio.wait([sender, receiver], return_when=asyncio.FIRST_COMPLETED)
 
+                    for task in (sender, receiver):
+                        task.cancel()
+                    for task in done:
+                        task.result()  # re-raises connection errors
 
-################################ Websocket ###############################
+            except (OSError, asyncio.TimeoutError, websockets.exceptions.WebSocketException) as error:
+                if warn:
+                    # once per outage, not once per reconnect attempt
+                    warnings.warn("websocket connection to {} failed, retrying: {}".format(self.address, error))
+                    warn = False
 
-# CONNECT TO WEBSOCKET
-def _connect(socket):
-    global SOCKET, SOCKET_ADDRESS
+            self.connected.clear()
 
-    try:
-        gc.collect()
-        websocket.enableTrace(True)
+            if not self._closing:
+                # sleep for delay, but wake up early if the client is closed
+                try:
+                    await asyncio.wait_for(self._stop.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                delay = min(2. * delay, self.max_backoff)
 
-        SOCKET_ADDRESS = socket
-        SOCKET = websocket.create_connection(socket)
-        send(id="1")
+    async def _sender(self, ws):
+        while True:
+            while self._pending:
+                key, message = next(iter(self._pending.items()))
+                await ws.send(json.dumps(message))
 
-        return True
+                # only dequeue after a successful send so that the message is retried after a reconnect
+                if self._pending.get(key) is message:
+                    del self._pending[key]
+                self.stats["sent"] += 1
 
-    except Exception:
-        return False
+            if self._closing:
+                return
 
+            self._wakeup.clear()
+            await self._wakeup.wait()
 
-# DECORATED FUNCS
-@check_fail
-def init(socket):
-    if not _connect(socket):
-        raise ConnectionError("websocket connection failed")
-    else:
+    async def _receiver(self, ws):
+        async for raw in ws:
+            self.stats["received"] += 1
+            message = json.loads(raw)
+
+            request_id = message.get("request_id") if isinstance(message, dict) else None
+            if request_id is None and self._ordered:
+                # servers that don't echo request ids answer requests of ordered_kind in order-- never requests of
+                # other kinds
+                request_id = next(iter(self._ordered))
+
+            self._ordered.pop(request_id, None)
+            future = self._requests.pop(request_id, None)
+            if future:
+                if not future.done():
+                    future.set_result(message)
+            elif self.on_message:
+                self.on_message(message)
+
+
+# MODULE-LEVEL CLIENT
+def init(socket, wait=5.):
+    global SOCKET
+
+    close()
+
+    # the server answers best_match in order, like it did for the old blocking client
+    SOCKET = AsyncClient(socket, hello={"id": "1"}, ordered_kind="best_match")
+    if SOCKET.connected.wait(wait):
         print("[DEBUG] Connected to server")
+    else:
+        warnings.warn("websocket not connected after {}s, connecting in the background".format(wait))
+
+
+def send(coalesce=None, **kwargs):
+    SOCKET.send(kwargs, coalesce=coalesce)
+
+
+def request(kind=None, **kwargs):
+    return SOCKET.request(kwargs, kind=kind)
+
+
+def close(timeout=None):
+    global SOCKET
+
+    if SOCKET:
+        SOCKET.close(timeout)
+        SOCKET = None
+
+
+################################ Local stand-in server ###############################
+if __name__ == "__main__":
+    import time
+
+
+    RECEIVED = []
+
+    async def stand_in(ws, *args):
+        # answers best_match requests with request_id and an empty name (= correct), records everything else
+        async for raw in ws:
+            message = json.loads(raw)
+            RECEIVED.append(message)
+            if "best_match" in message:
+                await asyncio.sleep(0.05)
+                await ws.send(json.dumps({"request_id": message["request_id"], "name": None}))
+
+    def serve(port, stop):
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+
+        async def main():
+            async with websockets.serve(stand_in, "localhost", port):
+                while not stop.is_set():
+                    await asyncio.sleep(0.01)
+
+        loop.run_until_complete(main())
+        loop.close()
+
+    def start_server(port):
+        stop = threading.Event()
+        thread = threading.Thread(target=serve, args=(port, stop), daemon=True)
+        thread.start()
+        return stop, thread
+
+
+    PORT = 8765
+    server_stop, server_thread = start_server(PORT)
+    time.sleep(0.2)
+
+    client = AsyncClient("ws://localhost:{}".format(PORT), hello={"id": "1"}, backoff=0.05, max_backoff=0.2)
+    assert client.connected.wait(2.), "client did not connect"
 
+    # requests never block the caller and are correlated by request_id
+    start = time.time()
+    futures = [client.request({"best_match": "person_{}".format(idx)}, kind="best_match") for idx in range(10)]
+    print("10 requests queued in {}ms".format(round(1000. * (time.time() - start), 3)))
+    assert all(future.result(timeout=2.)["name"] is None for future in futures)
 
-@check_fail
-def send(**kwargs):
-    global SOCKET, RECV
+    # coalescing: a burst of lcd updates collapses to (at most) a few sends, ending with the latest state
+    for idx in range(100):
+        client.send({"lcd": "tick {}".format(idx)}, coalesce="lcd")
+    time.sleep(0.2)
+    lcd_messages = [message["lcd"] for message in RECEIVED if "lcd" in message]
+    print("100 lcd updates -> {} sent, last: '{}'".format(len(lcd_messages), lcd_messages[-1]))
+    assert lcd_messages[-1] == "tick 99"
 
-    SOCKET.send(json.dumps(kwargs))
-    print("[DEBUG] Sending via websocket...")
+    # reconnect with backoff: messages sent while the server is down are delivered once it is back
+    server_stop.set()
+    server_thread.join()
+    time.sleep(0.3)
+    assert not client.connected.is_set(), "client should have noticed the server going down"
 
+    client.send({"lcd": "sent while down"}, coalesce="lcd")
+    server_stop, server_thread = start_server(PORT)
+    assert client.connected.wait(2.), "client did not reconnect"
+    time.sleep(0.2)
+    assert RECEIVED[-1] == {"lcd": "sent while down"} and {"id": "1"} in RECEIVED[-2:], RECEIVED[-2:]
 
-@check_fail
-def receive():
-    global RECV
+    client.close()
+    server_stop.set()
+    server_thread.join()
 
-    RECV = json.loads(SOCKET.recv())
+    print("stats: {}".format(client.stats))
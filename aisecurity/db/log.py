@@ -2,12 +2,18 @@
 
 "aisecurity.db.log"
 
-MySQL and Firebase database handling.
+MySQL, SQLite, and Firebase database handling.
 
 """
 
+import atexit
+import collections
+import hashlib
 import json
+import os
+import sqlite3
 import time
+import uuid
 from timeit import default_timer as timer
 import warnings
 
@@ -15,6 +21,10 @@ import mysql.connector
 import pyrebase
 from termcolor import cprint
 
+from aisecurity.db.buffer import LocalBuffer
+from aisecurity.db.pool import ConnectionPool, load_script
+from aisecurity.db.snapshots import SnapshotWriter
+from aisecurity.db.writer import AsyncWriter, FirebaseSink, SQLSink, SQLiteSink
 from aisecurity.utils.paths import CONFIG_HOME, CONFIG
 
 
@@ -29,210 +39,398 @@ THRESHOLDS = {
 
 MODE = None
 
-DATABASE = None
-CURSOR = None
-FIREBASE = None
+POOL_SIZE = 2
 
-NUM_RECOGNIZED, NUM_UNKNOWN = 0, 0
-LAST_LOGGED, UNK_LAST_LOGGED = None, None
-LOG, DISTS = {"current": {}, "logged": {}}, []
+# errors that mean a remote database is unreachable-- anything else means it rejected the events themselves
+TRANSIENT_ERRORS = {
+    "mysql": (mysql.connector.errors.OperationalError, mysql.connector.errors.InterfaceError, OSError),
+    "firebase": (OSError,),  # requests' connection errors are OSErrors
+    "sqlite": (sqlite3.OperationalError, OSError)
+}
 
+EXIT_TIMEOUT = 5.  # seconds that interpreter shutdown waits for queued log events
 
-# LOGGING INIT AND HELPERS
-def init(logging, flush=False, thresholds=None):
-    global NUM_RECOGNIZED, NUM_UNKNOWN, LAST_LOGGED, UNK_LAST_LOGGED, LOG, DISTS, THRESHOLDS
-    global MODE, DATABASE, CURSOR, FIREBASE
+DATABASE = None
 
-    MODE = logging
+SINK = None
+WRITER = None
+BUFFER = None
+SNAPSHOTS = None
 
-    LAST_LOGGED, UNK_LAST_LOGGED = timer(), timer()
+AGGREGATOR = None
 
+
+# LOGGING INIT AND HELPERS
+def mysql_pool():
+    return ConnectionPool(
+        lambda: mysql.connector.connect(
+            host="localhost",
+            user=CONFIG["mysql_user"],
+            passwd=CONFIG["mysql_password"],
+            database="LOG"
+        ),
+        size=POOL_SIZE,
+        placeholder="%s",
+        cursor_kwargs={"prepared": True},  # server-side prepared inserts
+        reconnect_errors=(mysql.connector.errors.OperationalError, mysql.connector.errors.InterfaceError),
+        ping=lambda conn: conn.ping(reconnect=True, attempts=3, delay=1)
+    )
+
+
+def outdated_tables(database):
+    # LOG tables without event_id and ts (ex: created with an older drop.sql) or still being migrated
+    columns = {}
+    for table, column in database.query(
+            "SELECT TABLE_NAME, COLUMN_NAME FROM information_schema.COLUMNS WHERE TABLE_SCHEMA = DATABASE();",
+            prepared=False):
+        columns.setdefault(str(table), set()).add(str(column))
+
+    return [table for table in ("Activity", "Unknown")
+            if not {"event_id", "ts"} <= columns.get(table, set()) or table + "_old" in columns]
+
+
+def connect(logging, flush=False):
+    # returns (database, sink) for a remote logging backend, raising if it is unreachable
     if logging == "mysql":
-        try:
-            DATABASE = mysql.connector.connect(
-                host="localhost",
-                user=CONFIG["mysql_user"],
-                passwd=CONFIG["mysql_password"],
-                database="LOG"
-            )
-            CURSOR = DATABASE.cursor()
-
-            CURSOR.execute("USE LOG;")
-            DATABASE.commit()
-
-            if flush:
-                instructions = open(CONFIG_HOME + "/bin/drop.sql", encoding="utf-8")
-                for cmd in instructions:
-                    if not cmd.startswith(" ") and not cmd.startswith("*/") and not cmd.startswith("/*"):
-                        CURSOR.execute(cmd)
-                        DATABASE.commit()
-
-        except (mysql.connector.errors.DatabaseError, mysql.connector.errors.InterfaceError):
-            MODE = "<no database>"
-            warnings.warn("MySQL database credentials missing or incorrect")
+        database = mysql_pool()
+
+        if flush:
+            database.execute_script(load_script(CONFIG_HOME + "/bin/drop.sql"))
+            database.clear()  # pooled connections were opened on the dropped database
+        else:
+            outdated = outdated_tables(database)
+            if outdated:
+                database.clear()  # connect() is retried by the buffer until the database is migrated
+            assert not outdated, "LOG tables {} use an old schema-- run aisecurity.db.log.migrate() to upgrade " \
+                                 "them".format(", ".join(outdated))
+
+        return database, SQLSink(database, insert="INSERT IGNORE")
 
     elif logging == "firebase":
-        try:
-            FIREBASE = pyrebase.initialize_app(
-                json.load(open(CONFIG_HOME + "/logging/firebase.json", encoding="utf-8"))
-            )
-            DATABASE = FIREBASE.database()
+        firebase = pyrebase.initialize_app(json.load(open(CONFIG_HOME + "/logging/firebase.json", encoding="utf-8")))
+        return firebase.database(), FirebaseSink(firebase.database())
 
-        except (FileNotFoundError, json.JSONDecodeError):
-            MODE = "<no database>"
-            warnings.warn(CONFIG_HOME + "/logging/firebase.json and a key file are needed to use firebase")
+    elif logging == "sqlite":
+        # local stand-in for mysql
+        os.makedirs(CONFIG_HOME + "/logging", exist_ok=True)
+        database = ConnectionPool(
+            lambda: sqlite3.connect(CONFIG_HOME + "/logging/log.db", check_same_thread=False),
+            size=POOL_SIZE,
+            placeholder="?",
+            reconnect_errors=(sqlite3.OperationalError,)
+        )
+        if flush:
+            database.execute_script(["DROP TABLE IF EXISTS {};".format(table)
+                                     for table in ("Activity", "Unknown", "People")])
 
-    else:
-        MODE = "<no database>"
+        return database, SQLiteSink(database)
+
+    raise ValueError("{} not a supported logging option".format(logging))
+
+
+def init(logging, flush=False, thresholds=None, async_writes=True, store_and_forward=False, snapshots=False,
+         writer_kwargs=None, buffer_kwargs=None, snapshot_kwargs=None):
+    global THRESHOLDS, MODE, DATABASE, SINK, WRITER, BUFFER, SNAPSHOTS, AGGREGATOR
+
+    close()
+
+    MODE = logging
+    DATABASE, SINK = None, None
+
+    try:
+        DATABASE, SINK = connect(logging, flush=flush)
+
+    except (mysql.connector.errors.DatabaseError, mysql.connector.errors.InterfaceError):
+        warnings.warn("MySQL database credentials missing or incorrect")
+
+    except (FileNotFoundError, json.JSONDecodeError):
+        warnings.warn(CONFIG_HOME + "/logging/firebase.json and a key file are needed to use firebase")
+
+    except ValueError:
         warnings.warn("{} not a supported logging option. No logging will occur".format(logging))
+        logging = None
+
+    except AssertionError as error:
+        # outdated schema: with store_and_forward, events are buffered until the database is migrated
+        warnings.warn(str(error))
+
+    if store_and_forward and logging:
+        # events always hit the local buffer first and are forwarded once the remote backend is reachable
+        os.makedirs(CONFIG_HOME + "/logging", exist_ok=True)
+        BUFFER = LocalBuffer(
+            CONFIG_HOME + "/logging/buffer.db",
+            connect=lambda: connect(logging)[1],
+            sink=SINK,
+            **{"transient_errors": TRANSIENT_ERRORS[logging], **(buffer_kwargs or {})}
+        )
+    elif SINK and async_writes:
+        WRITER = AsyncWriter(SINK, **(writer_kwargs or {}))
+    elif not SINK:
+        MODE = "<no database>"
+
+    if snapshots:
+        SNAPSHOTS = SnapshotWriter(CONFIG_HOME + "/logging/unknown", **(snapshot_kwargs or {}))
 
     if thresholds:
         THRESHOLDS = {**THRESHOLDS, **thresholds}
 
+    AGGREGATOR = RecognitionAggregator()
 
-def get_now(seconds):
-    date_and_time = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(seconds))
-    return date_and_time.split(" ")
 
+def migrate():
+    # one-off migration of an existing LOG database (separate date and time columns) to the schema in drop.sql--
+    # init() refuses outdated databases, so this doesn't need it (and init() has to be called again afterwards).
+    # Not atomic: DDL commits implicitly on MySQL, so nothing is retried and every step is idempotent instead-- if
+    # the migration fails halfway (ex: lost connection), running migrate() again finishes it
+    database = mysql_pool()
 
-def get_id(name):
-    # will be filled in later
-    if "visitor" in name.lower():
-        return "V0000"
-    else:
-        return "00000"
+    try:
+        outdated = outdated_tables(database)
+        if not outdated:
+            return
 
+        # tables already renamed by an earlier, interrupted migration are skipped
+        tables = {str(table) for table, in database.query("SHOW TABLES;", prepared=False)}
+        renames = ["{0} TO {0}_old".format(table) for table in outdated
+                   if table in tables and table + "_old" not in tables]
+        if renames:
+            database.execute_script(["RENAME TABLE {};".format(", ".join(renames))])
 
-def get_percent_diff(item, log):
-    try:
-        return 1. - (len(log[item]) / len([i for n in log.values() for i in n]))
-    except KeyError:
-        return 1.
+        database.execute_script(load_script(CONFIG_HOME + "/bin/migrate.sql"))
 
+    finally:
+        database.clear()
 
-def update(is_recognized, best_match):
-    global LOG, NUM_RECOGNIZED, NUM_UNKNOWN
 
-    update_progress = False
-    now = timer()
-    cooled = cooldown_ok(LAST_LOGGED, best_match)
+def close(timeout=None):
+    global WRITER, BUFFER, SNAPSHOTS
 
-    if len(DISTS) >= THRESHOLDS["num_recognized"] + THRESHOLDS["num_unknown"]:
-        flush_current(mode="unknown+known", flush_times=False)
-        flushed = True
-    else:
-        flushed = False
+    # snapshots first: their callbacks write log rows
+    if SNAPSHOTS:
+        SNAPSHOTS.close(timeout)
+        SNAPSHOTS = None
 
-    if is_recognized and cooled:
-        if best_match not in LOG["current"]:
-            LOG["current"][best_match] = [now]
-        else:
-            LOG["current"][best_match].append(now)
+    if WRITER:
+        WRITER.close(timeout)
+        WRITER = None
 
-        percent_diff_ok = get_percent_diff(best_match, LOG["current"]) <= THRESHOLDS["percent_diff"]
+    if BUFFER:
+        BUFFER.close(timeout)
+        BUFFER = None
 
-        if percent_diff_ok or flushed:
-            NUM_RECOGNIZED += 1
-            NUM_UNKNOWN = 0
 
-            if percent_diff_ok and not flushed:
-                update_progress = True
+@atexit.register
+def _close_at_exit():
+    close(timeout=EXIT_TIMEOUT)
 
-    elif not is_recognized:
-        NUM_UNKNOWN += 1
-        if NUM_UNKNOWN >= THRESHOLDS["num_unknown"]:
-            NUM_RECOGNIZED = 0
 
-    update_recognized = NUM_RECOGNIZED >= THRESHOLDS["num_recognized"] and cooled \
-                        and get_percent_diff(best_match, LOG["current"]) <= THRESHOLDS["percent_diff"]
-    update_unrecognized = NUM_UNKNOWN >= THRESHOLDS["num_unknown"] and cooldown_ok(UNK_LAST_LOGGED)
+def write(table, data):
+    # database writes go through the local buffer or background writer if they exist so that slow or unreachable
+    # databases don't stall the camera. event_id makes retried and forwarded writes idempotent
+    data = {"event_id": uuid.uuid4().hex, **data}
 
-    if update_recognized:
-        LOG["logged"][log_person()] = now
-    elif update_unrecognized:
-        log_unknown()
+    if BUFFER:
+        BUFFER.put(table, data)
+    elif WRITER:
+        WRITER.put(table, data)
+    elif SINK:
+        SINK.write([{"table": table, "data": data}])
 
-    return update_progress, update_recognized, update_unrecognized
 
+def get_timestamp(seconds):
+    # seconds is a timer() reading, which has an arbitrary epoch-- convert it to wall-clock time first
+    wall_time = time.time() - (timer() - seconds)
+    return "{}.{:03d}".format(
+        time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(wall_time)), int(wall_time % 1. * 1000.)
+    )
 
-def cooldown_ok(elapsed, best_match=None):
-    try:
-        last_student = max(LOG["logged"], key=lambda person: LOG["logged"][person])
-        if best_match == last_student:
-            return timer() - elapsed > THRESHOLDS["cooldown"]
-        else:
-            return True
 
-    except ValueError:
+def get_display_name(name):
+    return name.replace("_", " ").title()
+
+
+def get_id(name):
+    # stable id derived from the logged name: "P" (person) or "V" (visitor) + 15 hex chars of its sha1, which
+    # migrate.sql can compute in SQL for rows that only have a name
+    prefix = "V" if "visitor" in name.lower() else "P"
+    return prefix + hashlib.sha1(get_display_name(name).encode("utf-8")).hexdigest()[:15]
+
+
+################################ Aggregation ###############################
+class RecognitionAggregator:
+    """Per-camera vote aggregation that decides when a recognized or unknown person is logged"""
+
+    def __init__(self, thresholds=None, clock=timer, on_log=None):
+        """Initializes RecognitionAggregator
+        :param thresholds: overrides for log.THRESHOLDS (default: None)
+        :param clock: callable returning seconds-- pass a simulated clock for testing (default: timeit.default_timer)
+        :param on_log: callable(name, seconds, snapshot) called when someone is logged, with name None for unknown
+                       activity (default: None, write to the log database)
+        """
+
+        self.thresholds = {**THRESHOLDS, **(thresholds or {})}
+        self.clock = clock
+        self.on_log = on_log if on_log else log_activity
+
+        # ring buffer of recent (best_match, is_recognized, dist) votes-- aggregation restarts when it fills up
+        self.votes = collections.deque(maxlen=self.thresholds["num_recognized"] + self.thresholds["num_unknown"])
+
+        self.counts, self.time_sums = {}, {}
+        self.total = 0
+        self.leader = None
+
+        self.num_recognized, self.num_unknown = 0, 0
+        self.snapshot = None
+
+        self.last_person = None
+        self.last_logged, self.unk_last_logged = self.clock(), self.clock()
+
+    # HELPERS
+    def percent_diff(self, name):
+        count = self.counts.get(name, 0)
+        return 1. - count / self.total if count else 1.
+
+    def cooldown_ok(self, best_match):
+        # only the most recently logged person has to wait out the cooldown
+        if best_match is not None and best_match == self.last_person:
+            return self.clock() - self.last_logged > self.thresholds["cooldown"]
         return True
 
+    # VOTING
+    def update(self, is_recognized, best_match, dist=None, snapshot=None):
+        """Adds a vote from the current frame and logs activity if enough votes agree
+        :param is_recognized: whether or not best_match is within the recognition threshold
+        :param best_match: best match from database
+        :param dist: distance between best match and current frame (default: None)
+        :param snapshot: BGR face crop from the current frame, saved with unknown activity (default: None)
+        :returns: update_progress, update_recognized, update_unrecognized
+        """
 
-# LOGGING FUNCTIONS
-def log_person():
-    student_name = max(LOG["current"], key=lambda person: len(LOG["current"][person]))
-    times = LOG["current"][student_name]
-    now = get_now(sum(times) / len(times))
-
-    if MODE == "mysql":
-        add = "INSERT INTO Activity (id, name, date, time) VALUES ({}, '{}', '{}', '{}');".format(
-            get_id(student_name), student_name.replace("_", " ").title(), *now)
-        CURSOR.execute(add)
-        DATABASE.commit()
-
-    elif MODE == "firebase":
-        data = {
-            "id": get_id(student_name),
-            "name": student_name.replace("_", " ").title(),
-            "date": now[0],
-            "time": now[1]
-        }
-        DATABASE.child("known").child(*get_now(timer())).set(data)
-
-    flush_current(mode="known")
+        update_progress = False
+        now = self.clock()
+        cooled = self.cooldown_ok(best_match)
 
-    cprint("Regular activity ({}) logged with {}".format(student_name, MODE), color="green", attrs=["bold"])
+        flushed = len(self.votes) == self.votes.maxlen
+        if flushed:
+            self.flush(mode="unknown+known", flush_times=False)
 
-    return student_name
+        if is_recognized and cooled:
+            self.counts[best_match] = self.counts.get(best_match, 0) + 1
+            self.time_sums[best_match] = self.time_sums.get(best_match, 0.) + now
+            self.total += 1
+            if self.leader is None or self.counts[best_match] > self.counts[self.leader]:
+                self.leader = best_match
 
+            percent_diff_ok = self.percent_diff(best_match) <= self.thresholds["percent_diff"]
 
-def log_unknown():
-    now = get_now(timer())
+            if percent_diff_ok or flushed:
+                self.num_recognized += 1
+                self.num_unknown = 0
 
-    path_to_img = "<DEPRECATED>"
+                if percent_diff_ok and not flushed:
+                    update_progress = True
 
-    if MODE == "mysql":
-        add = "INSERT INTO Unknown (path_to_img, date, time) VALUES ('{}', '{}', '{}');".format(
-            path_to_img, *now)
-        CURSOR.execute(add)
-        DATABASE.commit()
+        elif not is_recognized:
+            if snapshot is not None:
+                # the frame will be drawn on and reused, so the most recent unknown face has to be copied
+                self.snapshot = snapshot.copy()
 
-    elif MODE == "firebase":
-        data = {
-            "path_to_img": path_to_img,
-            "date": now[0],
-            "time": now[1]
-        }
-        DATABASE.child("unknown").child(*get_now(timer())).set(data)
+            self.num_unknown += 1
+            if self.num_unknown >= self.thresholds["num_unknown"]:
+                self.num_recognized = 0
 
-    flush_current(mode="unknown")
+        update_recognized = self.num_recognized >= self.thresholds["num_recognized"] and cooled \
+                            and self.percent_diff(best_match) <= self.thresholds["percent_diff"]
+        update_unrecognized = self.num_unknown >= self.thresholds["num_unknown"]
 
-    cprint("Unknown activity logged with {}".format(MODE), color="red", attrs=["bold"])
+        if update_recognized:
+            self.log_person(now)
+        elif update_unrecognized:
+            self.log_unknown(now)
+
+        self.votes.append((best_match, is_recognized, dist))
+
+        return update_progress, update_recognized, update_unrecognized
+
+    def log_person(self, now):
+        name = self.leader
+        self.on_log(name, self.time_sums[name] / self.counts[name], None)
+
+        self.flush(mode="known")
+        self.last_person = name
+
+        return name
+
+    def log_unknown(self, now):
+        self.on_log(None, now, self.snapshot)
+        self.flush(mode="unknown")
+
+    def flush(self, mode="known", flush_times=True):
+        """Clears votes
+        :param mode: "known", "unknown", or "known+unknown" (default: "known")
+        :param flush_times: reset last logged times (default: True)
+        """
+
+        if "known" in mode:
+            self.votes.clear()
+            self.counts, self.time_sums = {}, {}
+            self.total = 0
+            self.leader = None
+            self.num_recognized = 0
+
+            if flush_times:
+                self.last_logged = self.clock()
+
+        if "unknown" in mode:
+            self.votes.clear()
+            self.num_unknown = 0
+            self.snapshot = None
+
+            if flush_times:
+                self.unk_last_logged = self.clock()
+
+
+# DEFAULT AGGREGATOR
+def update(is_recognized, best_match, dist=None):
+    return AGGREGATOR.update(is_recognized, best_match, dist)
 
 
 def flush_current(mode="known", flush_times=True):
-    global LOG, NUM_RECOGNIZED, NUM_UNKNOWN, DISTS, LAST_LOGGED, UNK_LAST_LOGGED
+    AGGREGATOR.flush(mode=mode, flush_times=flush_times)
+
+
+# LOGGING FUNCTIONS
+def log_activity(name, seconds, snapshot=None):
+    # seconds is a timer() reading; name is None for unknown activity
+    if name is None:
+        log_unknown(seconds, snapshot)
+    else:
+        log_person(name, seconds)
+
+
+def log_person(student_name, seconds):
+    write("Activity", {
+        "ts": get_timestamp(seconds),
+        "id": get_id(student_name),
+        "name": get_display_name(student_name)
+    })
+
+    cprint("Regular activity ({}) logged with {}".format(student_name, MODE), color="green", attrs=["bold"])
+
 
-    if "known" in mode:
-        DISTS = []
-        LOG["current"] = {}
-        NUM_RECOGNIZED = 0
+def log_unknown(seconds, snapshot=None):
+    ts = get_timestamp(seconds)
 
-        if flush_times:
-            LAST_LOGGED = timer()
+    def write_unknown(path_to_img):
+        write("Unknown", {
+            "ts": ts,
+            "path_to_img": path_to_img
+        })
 
-    if "unknown" in mode:
-        DISTS = []
-        NUM_UNKNOWN = 0
+    if SNAPSHOTS and snapshot is not None:
+        # the row is written once the snapshot is on disk so that path_to_img always points to a real file
+        SNAPSHOTS.put(snapshot, callback=write_unknown)
+    else:
+        write_unknown(None)
 
-        if flush_times:
-            UNK_LAST_LOGGED = timer()
+    cprint("Unknown activity logged with {}".format(MODE), color="red", attrs=["bold"])
@@ -0,0 +1,189 @@
+"""
+
+"aisecurity.db.pool"
+
+Pooled SQL connections with automatic reconnect.
+
+"""
+
+import queue
+import threading
+
+
+################################ Helpers ###############################
+def load_script(path):
+    # same filtering rules as the original line-by-line drop.sql replay: comment lines are skipped
+    statements = []
+    with open(path, encoding="utf-8") as script:
+        for cmd in script:
+            if cmd.strip() and not cmd.startswith(" ") and not cmd.startswith("*/") and not cmd.startswith("/*"):
+                statements.append(cmd.strip())
+    return statements
+
+
+################################ Connection pool ###############################
+class ConnectionPool:
+    """Pool of DB-API connections (MySQL or SQLite) that reconnects when a connection is lost"""
+
+    def __init__(self, connect, size=4, placeholder="%s", cursor_kwargs=None, reconnect_errors=(),
+                 ping=None, reconnect_attempts=3):
+        """Initializes ConnectionPool and opens the first connection (raises if the database is unreachable)
+        :param connect: callable that returns a new DB-API connection
+        :param size: maximum number of open connections (default: 4)
+        :param placeholder: parameter placeholder used by the driver ("%s" for MySQL, "?" for SQLite) (default: "%s")
+        :param cursor_kwargs: kwargs for connection.cursor(), ex: {"prepared": True} for MySQL (default: None)
+        :param reconnect_errors: exceptions that mean a connection is dead and should be replaced (default: ())
+        :param ping: callable(connection) that checks/revives a connection before use (default: None)
+        :param reconnect_attempts: retries with a fresh connection after a reconnect error (default: 3)
+        """
+
+        self.connect = connect
+        self.size = size
+        self.placeholder = placeholder
+        self.cursor_kwargs = cursor_kwargs or {}
+        self.reconnect_errors = tuple(reconnect_errors)
+        self.ping = ping
+        self.reconnect_attempts = reconnect_attempts
+
+        self.stats = {"connects": 0, "reconnects": 0, "transactions": 0, "scripts": 0}
+
+        self._idle = queue.LifoQueue()
+        self._open = 0
+        self._lock = threading.Lock()
+
+        self._release(self._acquire())
+
+    # CONNECTION MANAGEMENT
+    def _acquire(self):
+        try:
+            conn = self._idle.get_nowait()
+        except queue.Empty:
+            with self._lock:
+                can_open = self._open < self.size
+                if can_open:
+                    self._open += 1
+
+            if not can_open:
+                conn = self._idle.get()
+            else:
+                try:
+                    conn = self.connect()
+                    self.stats["connects"] += 1
+                except Exception:
+                    with self._lock:
+                        self._open -= 1
+                    raise
+
+        return conn
+
+    def _release(self, conn):
+        self._idle.put(conn)
+
+    def _discard(self, conn):
+        with self._lock:
+            self._open -= 1
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def clear(self):
+        """Closes all idle connections (ex: after the database was dropped and recreated)"""
+        while True:
+            try:
+                self._discard(self._idle.get_nowait())
+            except queue.Empty:
+                break
+
+    # EXECUTION
+    def _run(self, func, prepared):
+        for attempt in range(self.reconnect_attempts + 1):
+            conn = self._acquire()
+            try:
+                if self.ping:
+                    self.ping(conn)
+
+                cursor = conn.cursor(**(self.cursor_kwargs if prepared else {}))
+                result = func(cursor)
+                conn.commit()
+                cursor.close()
+
+            except self.reconnect_errors:
+                self._discard(conn)
+                if attempt == self.reconnect_attempts:
+                    raise
+                self.stats["reconnects"] += 1
+
+            except Exception:
+                try:
+                    conn.rollback()
+                finally:
+                    self._release(conn)
+                raise
+
+            else:
+                self._release(conn)
+                self.stats["transactions"] += 1
+                return result
+
+    def transaction(self, statements, prepared=True):
+        """Runs statements in a single transaction, retrying with a new connection if the connection was lost-- DML
+        only: DDL (CREATE, DROP, RENAME, ...) commits implicitly on MySQL, so use execute_script for schema changes
+        :param statements: list of (cmd, rows) where rows is None (execute) or a list of param tuples (executemany)
+        :param prepared: use self.cursor_kwargs (ex: server-side prepared statements) (default: True)
+        """
+
+        def execute(cursor):
+            for cmd, rows in statements:
+                if rows is None:
+                    cursor.execute(cmd)
+                else:
+                    cursor.executemany(cmd, rows)
+
+        self._run(execute, prepared)
+
+    def execute_script(self, statements, prepared=False):
+        """Runs schema statements one by one, committing after each, and never retries them: DDL can't be rolled back
+        on MySQL, so a script that fails halfway leaves the statements before the failure applied
+        :param statements: list of SQL statements
+        :param prepared: use self.cursor_kwargs (ex: server-side prepared statements) (default: False)
+        """
+
+        conn = self._acquire()
+        try:
+            if self.ping:
+                self.ping(conn)
+
+            cursor = conn.cursor(**(self.cursor_kwargs if prepared else {}))
+            for cmd in statements:
+                cursor.execute(cmd)
+                conn.commit()
+            cursor.close()
+
+        except self.reconnect_errors:
+            self._discard(conn)
+            raise
+
+        except Exception:
+            try:
+                conn.rollback()
+            finally:
+                self._release(conn)
+            raise
+
+        self._release(conn)
+        self.stats["scripts"] += 1
+
+    def query(self, cmd, params=(), prepared=True):
+        """Runs a query, retrying with a new connection if the connection was lost
+        :param cmd: SQL query using self.placeholder for parameters
+        :param params: query parameters (default: ())
+        :param prepared: use self.cursor_kwargs (ex: server-side prepared statements) (default: True)
+        :returns: list of result rows
+        """
+
+        def fetch(cursor):
+            cursor.execute(cmd, tuple(params))
+            return cursor.fetchall()
+
+        return self._run(fetch, prepared)
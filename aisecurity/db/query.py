@@ -0,0 +1,188 @@
+"""
+
+"aisecurity.db.query"
+
+Indexed time-range, per-person, and rollup queries on the log database.
+
+"""
+
+import datetime
+
+
+# CONSTANTS
+TABLES = ("Activity", "Unknown")
+
+PERIODS = {
+    # length of the "YYYY-MM-DD HH" / "YYYY-MM-DD" prefix of a timestamp
+    "hour": 13,
+    "day": 10
+}
+
+
+# HELPERS
+def to_timestamp(value):
+    # accepts datetime.datetime, datetime.date, or an already-formatted "YYYY-MM-DD[ HH:MM:SS[.fff]]" string
+    if isinstance(value, datetime.datetime):
+        return value.strftime("%Y-%m-%d %H:%M:%S.%f")[:-3]
+    elif isinstance(value, datetime.date):
+        return value.strftime("%Y-%m-%d")
+    return value
+
+
+def _check_table(table):
+    # table names can't be passed as parameters, so they are checked against a whitelist instead
+    assert table in TABLES, "table must be one of {}".format(TABLES)
+
+
+################################ Queries ###############################
+def time_range(pool, start, end, table="Activity", limit=None):
+    """Events in [start, end), ordered by timestamp (uses the ts index)
+    :param pool: ConnectionPool for the log database (ex: aisecurity.db.log.DATABASE)
+    :param start: start of range (datetime or timestamp string)
+    :param end: end of range, exclusive (datetime or timestamp string)
+    :param table: "Activity" or "Unknown" (default: "Activity")
+    :param limit: maximum number of rows (default: None)
+    :returns: list of rows
+    """
+
+    _check_table(table)
+
+    cmd = "SELECT * FROM {} WHERE ts >= {p} AND ts < {p} ORDER BY ts".format(table, p=pool.placeholder)
+    params = [to_timestamp(start), to_timestamp(end)]
+    if limit is not None:
+        cmd += " LIMIT {}".format(pool.placeholder)
+        params.append(int(limit))
+
+    return pool.query(cmd + ";", params)
+
+
+def person_history(pool, person_id, start=None, end=None):
+    """Activity of one person, ordered by timestamp (uses the (id, ts) index)
+    :param pool: ConnectionPool for the log database
+    :param person_id: id of person (aisecurity.db.log.get_id(name))
+    :param start: start of range (default: None, no lower bound)
+    :param end: end of range, exclusive (default: None, no upper bound)
+    :returns: list of rows
+    """
+
+    cmd = "SELECT * FROM Activity WHERE id = {}".format(pool.placeholder)
+    params = [person_id]
+
+    if start is not None:
+        cmd += " AND ts >= {}".format(pool.placeholder)
+        params.append(to_timestamp(start))
+    if end is not None:
+        cmd += " AND ts < {}".format(pool.placeholder)
+        params.append(to_timestamp(end))
+
+    return pool.query(cmd + " ORDER BY ts;", params)
+
+
+def rollup(pool, start, end, period="hour", table="Activity", person_id=None):
+    """Event counts per hour or day in [start, end) (the range is resolved with the ts or (id, ts) index)
+    :param pool: ConnectionPool for the log database
+    :param start: start of range (datetime or timestamp string)
+    :param end: end of range, exclusive (datetime or timestamp string)
+    :param period: "hour" or "day" (default: "hour")
+    :param table: "Activity" or "Unknown" (default: "Activity")
+    :param person_id: only count this person's activity (default: None)
+    :returns: list of (period, count) rows, where period is "YYYY-MM-DD HH" or "YYYY-MM-DD"
+    """
+
+    _check_table(table)
+    assert period in PERIODS, "period must be one of {}".format(tuple(PERIODS))
+    assert person_id is None or table == "Activity", "person_id is only supported for Activity"
+
+    bucket = "SUBSTR(ts, 1, {})".format(PERIODS[period])
+
+    cmd = "SELECT {bucket}, COUNT(*) FROM {table} WHERE ".format(bucket=bucket, table=table)
+    params = []
+    if person_id is not None:
+        cmd += "id = {} AND ".format(pool.placeholder)
+        params.append(person_id)
+    cmd += "ts >= {p} AND ts < {p} GROUP BY {bucket} ORDER BY {bucket};".format(p=pool.placeholder, bucket=bucket)
+    params.extend([to_timestamp(start), to_timestamp(end)])
+
+    return pool.query(cmd, params)
+
+
+################################ Benchmark ###############################
+if __name__ == "__main__":
+    import argparse
+    import os
+    import random
+    import sqlite3
+    import tempfile
+    from timeit import default_timer as timer
+
+    from aisecurity.db.pool import ConnectionPool
+    from aisecurity.db.writer import SQLiteSink
+
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", help="number of synthetic Activity rows", type=int, default=2000000)
+    parser.add_argument("--people", help="number of distinct people", type=int, default=1000)
+    parser.add_argument("--days", help="number of days spanned by the rows", type=int, default=365)
+    parser.add_argument("--repeats", help="runs per query", type=int, default=5)
+    args = parser.parse_args()
+
+    random.seed(0)
+
+    path = os.path.join(tempfile.mkdtemp(), "benchmark.db")
+    pool = ConnectionPool(lambda: sqlite3.connect(path, check_same_thread=False), size=1, placeholder="?")
+    SQLiteSink(pool)
+
+    # OLD SCHEMA (no keys or indexes, separate date and time columns)
+    pool.execute_script(["CREATE TABLE Activity_old (id VARCHAR(5), name VARCHAR(200), date DATE, time TIME);"])
+
+    print("Generating {} rows...".format(args.rows))
+
+    origin = datetime.datetime(2020, 1, 1)
+    people = ["{:05d}".format(person) for person in range(args.people)]
+    pool.transaction([("INSERT INTO People (id, name) VALUES (?, ?);", [(person, person) for person in people])])
+
+    chunk = 100000
+    for offset in range(0, args.rows, chunk):
+        new, old = [], []
+        for idx in range(offset, min(offset + chunk, args.rows)):
+            person = random.choice(people)
+            ts = origin + datetime.timedelta(seconds=random.random() * args.days * 86400.)
+            ts_str = to_timestamp(ts)
+            new.append(("{:032x}".format(idx), ts_str, person, person))
+            old.append((person, person, ts_str[:10], ts_str[11:19]))
+
+        pool.transaction([
+            ("INSERT INTO Activity (event_id, ts, id, name) VALUES (?, ?, ?, ?);", new),
+            ("INSERT INTO Activity_old (id, name, date, time) VALUES (?, ?, ?, ?);", old)
+        ])
+
+    pool.query("ANALYZE;")
+
+    def benchmark(name, func):
+        start = timer()
+        for __ in range(args.repeats):
+            result = func()
+        print("{}: {}ms ({} rows)".format(name, round(1000. * (timer() - start) / args.repeats, 2), len(result)))
+
+    day = origin + datetime.timedelta(days=args.days // 2)
+    day_str, next_day_str = to_timestamp(day.date()), to_timestamp((day + datetime.timedelta(days=1)).date())
+    week_end = day + datetime.timedelta(days=7)
+
+    print("\nTime range (one day)")
+    benchmark("  old (date = ?)", lambda: pool.query("SELECT * FROM Activity_old WHERE date = ? ORDER BY time;",
+                                                      [day_str]))
+    benchmark("  new (ts index)", lambda: time_range(pool, day_str, next_day_str))
+
+    print("\nPerson history")
+    benchmark("  old (id = ?)", lambda: pool.query("SELECT * FROM Activity_old WHERE id = ? ORDER BY date, time;",
+                                                    [people[0]]))
+    benchmark("  new ((id, ts) index)", lambda: person_history(pool, people[0]))
+
+    print("\nHourly rollup (one week)")
+    benchmark("  old (date range)", lambda: pool.query(
+        "SELECT date, SUBSTR(time, 1, 2), COUNT(*) FROM Activity_old WHERE date >= ? AND date < ? "
+        "GROUP BY date, SUBSTR(time, 1, 2);", [day_str, to_timestamp(week_end.date())]
+    ))
+    benchmark("  new (ts index)", lambda: rollup(pool, day, week_end, period="hour"))
+
+    os.remove(path)
@@ -0,0 +1,164 @@
+"""
+
+"aisecurity.db.snapshots"
+
+Asynchronous face snapshot writer for unknown activity.
+
+"""
+
+import collections
+import hashlib
+import os
+import queue
+import threading
+import time
+import warnings
+
+import cv2
+
+
+################################ Snapshot writer ###############################
+class SnapshotWriter:
+    """Encodes face crops to JPEG in a worker thread and stores them with content-hash names under a disk quota"""
+
+    def __init__(self, directory, quota=256 * 1024 ** 2, max_age=30 * 86400., quality=90, max_queue=64):
+        """Initializes SnapshotWriter and starts the worker thread
+        :param directory: directory to store snapshots in (created if it doesn't exist)
+        :param quota: maximum total size of snapshots in bytes-- oldest are evicted beyond this (default: 256 MiB)
+        :param max_age: snapshots older than this many seconds are evicted (default: 30 days)
+        :param quality: JPEG quality, from 0 to 100 (default: 90)
+        :param max_queue: maximum number of queued snapshots-- new snapshots are dropped when full (default: 64)
+        """
+
+        self.directory = directory
+        self.quota = quota
+        self.max_age = max_age
+        self.quality = quality
+
+        os.makedirs(directory, exist_ok=True)
+
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.stats = {"queued": 0, "written": 0, "duplicates": 0, "dropped": 0, "failed": 0, "evicted": 0}
+
+        # path: (mtime, size), oldest first
+        self.files = collections.OrderedDict()
+        self.usage = 0
+        self._scan()
+        self.evict()
+
+        self._thread = threading.Thread(target=self._run, name="aisecurity-db-snapshots", daemon=True)
+        self._thread.start()
+
+    # DISK USAGE
+    def _scan(self):
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.is_file() and entry.name.endswith(".jpg"):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, entry.path, stat.st_size))
+
+        for mtime, path, size in sorted(entries):
+            self.files[path] = (mtime, size)
+            self.usage += size
+
+    def evict(self, now=None):
+        """Removes snapshots older than max_age, then the oldest snapshots until usage is within quota
+        :param now: current time.time() (default: None, time.time())
+        """
+
+        now = now if now is not None else time.time()
+
+        while self.files:
+            path, (mtime, size) = next(iter(self.files.items()))
+            if now - mtime <= self.max_age and self.usage <= self.quota:
+                break
+
+            self.files.popitem(last=False)
+            self.usage -= size
+            self.stats["evicted"] += 1
+
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    # WRITING
+    def put(self, img, callback=None):
+        """Queues a face crop without blocking (img must not be modified afterwards)
+        :param img: BGR uint8 face crop
+        :param callback: callable(path) called from the worker thread once the file is written, with path None if
+                         the snapshot was dropped or could not be written (default: None)
+        :returns: whether or not the snapshot was queued
+        """
+
+        try:
+            self.queue.put_nowait((img, callback))
+            self.stats["queued"] += 1
+            return True
+        except queue.Full:
+            self.stats["dropped"] += 1
+            if callback:
+                callback(None)
+            return False
+
+    def write(self, img):
+        """Encodes and stores a face crop
+        :param img: BGR uint8 face crop
+        :returns: path to snapshot
+        """
+
+        success, encoded = cv2.imencode(".jpg", img, [cv2.IMWRITE_JPEG_QUALITY, self.quality])
+        assert success, "JPEG encoding failed"
+
+        data = encoded.tobytes()
+        path = os.path.join(self.directory, hashlib.sha1(data).hexdigest() + ".jpg")
+        now = time.time()
+
+        if path in self.files:
+            # identical snapshot: refresh its age instead of storing it twice
+            os.utime(path, (now, now))
+            self.files.move_to_end(path)
+            self.files[path] = (now, self.files[path][1])
+            self.stats["duplicates"] += 1
+
+        else:
+            # write-then-rename so that a crash never leaves a truncated snapshot behind a logged path
+            tmp_path = path + ".tmp"
+            with open(tmp_path, "wb") as snapshot:
+                snapshot.write(data)
+            os.replace(tmp_path, path)
+
+            self.files[path] = (now, len(data))
+            self.usage += len(data)
+            self.stats["written"] += 1
+
+        self.evict(now)
+        return path
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+
+            img, callback = item
+            try:
+                path = self.write(img)
+            except Exception as error:
+                warnings.warn("failed to write snapshot: {}".format(error))
+                self.stats["failed"] += 1
+                path = None
+
+            if callback:
+                try:
+                    callback(path)
+                except Exception as error:
+                    warnings.warn("snapshot callback failed: {}".format(error))
+
+    def close(self, timeout=None):
+        """Writes queued snapshots and stops the worker thread
+        :param timeout: seconds to wait for the queue to drain (default: None, wait forever)
+        """
+
+        self.queue.put(None)
+        self._thread.join(timeout)
@@ -0,0 +1,217 @@
+"""
+
+"aisecurity.db.writer"
+
+Asynchronous batched database writer.
+
+"""
+
+import queue
+import threading
+import time
+import warnings
+
+
+################################ Sinks ###############################
+
+# FIREBASE PATHS
+FIREBASE_PATHS = {
+    "Activity": "known",
+    "Unknown": "unknown"
+}
+
+# IDENTITY TABLE (rows that must exist before a child row is inserted because of a foreign key)
+PARENTS = {
+    "Activity": ("People", ("id", "name"))
+}
+
+
+# SINKS
+class SQLSink:
+    """Writes batches of events through a ConnectionPool (MySQL or SQLite) with executemany"""
+
+    def __init__(self, pool, insert="INSERT IGNORE"):
+        # insert="INSERT IGNORE" (MySQL) or "INSERT OR IGNORE" (SQLite) makes writes idempotent on event_id
+        self.pool = pool
+        self.insert = insert
+
+    def write(self, events):
+        parents, tables = {}, {}
+        for event in events:
+            if event["table"] in PARENTS:
+                parent, parent_columns = PARENTS[event["table"]]
+                parent_row = tuple(event["data"][col] for col in parent_columns)
+                parents.setdefault((parent, parent_columns), set()).add(parent_row)
+
+            columns = tuple(event["data"])
+            tables.setdefault((event["table"], columns), []).append(tuple(event["data"][col] for col in columns))
+
+        tables = {**{key: sorted(rows) for key, rows in parents.items()}, **tables}
+
+        statements = []
+        for (table, columns), rows in tables.items():
+            cmd = "{} INTO {} ({}) VALUES ({});".format(
+                self.insert, table, ", ".join(columns), ", ".join([self.pool.placeholder] * len(columns)))
+            statements.append((cmd, rows))
+
+        self.pool.transaction(statements)
+
+
+class SQLiteSink(SQLSink):
+    """SQLite stand-in for the MySQL log database"""
+
+    SCHEMA = [
+        # same layout as bin/drop.sql
+        "CREATE TABLE IF NOT EXISTS People (id VARCHAR(16) PRIMARY KEY, name VARCHAR(200));",
+        "CREATE TABLE IF NOT EXISTS Activity (event_id CHAR(32) PRIMARY KEY, ts DATETIME NOT NULL, "
+        "id VARCHAR(16) NOT NULL REFERENCES People (id), name VARCHAR(200));",
+        "CREATE INDEX IF NOT EXISTS idx_activity_ts ON Activity (ts);",
+        "CREATE INDEX IF NOT EXISTS idx_activity_id_ts ON Activity (id, ts);",
+        "CREATE TABLE IF NOT EXISTS Unknown (event_id CHAR(32) PRIMARY KEY, ts DATETIME NOT NULL, "
+        "path_to_img VARCHAR(200));",
+        "CREATE INDEX IF NOT EXISTS idx_unknown_ts ON Unknown (ts);"
+    ]
+
+    def __init__(self, pool):
+        super().__init__(pool, insert="INSERT OR IGNORE")
+        self.pool.execute_script(self.SCHEMA)
+
+
+class FirebaseSink:
+    """Writes batches of events to Firebase with a single multi-path update"""
+
+    def __init__(self, database):
+        self.database = database
+
+    def write(self, events):
+        updates = {}
+        for event in events:
+            date, time_of_day = event["data"]["ts"].split(" ")
+            path = "/".join([FIREBASE_PATHS[event["table"]], date, time_of_day.replace(".", ",")])
+            updates[path] = event["data"]
+
+        self.database.update(updates)
+
+
+################################ Writer ###############################
+class AsyncWriter:
+    """Background writer with a bounded queue, size/time-triggered batch flushes, and retry with backoff"""
+
+    def __init__(self, sink, max_queue=1024, batch_size=64, flush_interval=1., max_retries=5, backoff=0.5,
+                 max_backoff=30.):
+        """Initializes and starts AsyncWriter
+        :param sink: object with a write(events) method
+        :param max_queue: maximum number of queued events-- new events are dropped when full (default: 1024)
+        :param batch_size: flush when this many events are queued (default: 64)
+        :param flush_interval: flush at least this often in seconds (default: 1.)
+        :param max_retries: retries per batch before it is dropped (default: 5)
+        :param backoff: initial retry delay in seconds, doubled on each retry (default: 0.5)
+        :param max_backoff: maximum retry delay in seconds (default: 30.)
+        """
+
+        self.sink = sink
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.stats = {"queued": 0, "written": 0, "dropped": 0, "failed": 0, "retries": 0, "batches": 0}
+
+        self._closing = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="aisecurity-db-writer", daemon=True)
+        self._thread.start()
+
+    def put(self, table, data):
+        """Queues an event without blocking
+        :param table: table name ("Activity" or "Unknown")
+        :param data: dict of column: value
+        :returns: whether or not the event was queued
+        """
+
+        try:
+            self.queue.put_nowait({"table": table, "data": data})
+            self.stats["queued"] += 1
+            return True
+        except queue.Full:
+            self.stats["dropped"] += 1
+            return False
+
+    def _next_batch(self):
+        batch = []
+        deadline = time.monotonic() + self.flush_interval
+
+        while len(batch) < self.batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0.:
+                break
+
+            try:
+                event = self.queue.get(timeout=timeout) if not self._closing.is_set() else self.queue.get_nowait()
+            except queue.Empty:
+                if self._closing.is_set():
+                    break
+                continue
+
+            if event is None:  # wake-up from close(): flush what is there instead of waiting out flush_interval
+                break
+            batch.append(event)
+
+        return batch
+
+    def _run(self):
+        while not (self._closing.is_set() and self.queue.empty()):
+            batch = self._next_batch()
+            if batch:
+                self._flush(batch)
+
+    def _drain(self):
+        events = 0
+        while True:
+            try:
+                events += self.queue.get_nowait() is not None
+            except queue.Empty:
+                return events
+
+    def _flush(self, batch):
+        for attempt in range(self.max_retries + 1):
+            try:
+                self.sink.write(batch)
+                self.stats["written"] += len(batch)
+                self.stats["batches"] += 1
+                return True
+
+            except Exception as error:
+                if self._closing.is_set():
+                    # shutting down: no backoff, and the rest of the queue isn't tried against a failing sink
+                    dropped = len(batch) + self._drain()
+                    warnings.warn("dropping {} log events on close: {}".format(dropped, error))
+                    self.stats["failed"] += dropped
+                    return False
+
+                if attempt == self.max_retries:
+                    warnings.warn("dropping {} log events after {} retries: {}".format(len(batch), attempt, error))
+                else:
+                    self.stats["retries"] += 1
+                    self._closing.wait(min(self.backoff * 2 ** attempt, self.max_backoff))  # close() cuts it short
+
+        self.stats["failed"] += len(batch)
+        return False
+
+    def close(self, timeout=None):
+        """Drains the queue and stops the writer thread-- once closing, a failed write drops what is left instead of
+        backing off
+        :param timeout: seconds to wait for the queue to drain (default: None, wait until every batch was tried)
+        """
+
+        self._closing.set()
+        try:
+            self.queue.put_nowait(None)
+        except queue.Full:
+            pass  # the writer thread isn't waiting on an empty queue
+        self._thread.join(timeout)
+
+        if self._thread.is_alive():
+            warnings.warn("log writer did not finish within {}s, {} queued events were not written".format(
+                timeout, self.queue.qsize()))
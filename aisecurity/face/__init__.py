@@ -1,2 +1,4 @@
+from . import alignment
 from . import detection
 from . import preprocessing
+from . import quality
@@ -0,0 +1,64 @@
+"""
+
+"aisecurity.face.alignment"
+
+Landmark-based face alignment using MTCNN keypoints.
+
+"""
+
+import cv2
+import numpy as np
+
+
+# GLOBALS
+KEYPOINTS = ("left_eye", "right_eye", "nose", "mouth_left", "mouth_right")
+
+TEMPLATE = np.array([
+    # canonical 5-point template (https://github.com/deepinsight/insightface), normalized to [0, 1]
+    [38.2946, 51.6963],
+    [73.5318, 51.5014],
+    [56.0252, 71.7366],
+    [41.5493, 92.3655],
+    [70.7299, 92.2041]
+], dtype=np.float64) / 112.
+
+_TEMPLATES = {}
+
+
+# TEMPLATE
+def get_template(img_shape, padding=0.2):
+    # padding shrinks the template towards the center so the aligned crop keeps some context (like MTCNN's margin)
+    key = (tuple(img_shape), padding)
+    if key not in _TEMPLATES:
+        height, width = img_shape
+        _TEMPLATES[key] = ((TEMPLATE - 0.5) * (1. - padding) + 0.5) * np.array([width, height])
+    return _TEMPLATES[key]
+
+
+# TRANSFORMS
+def similarity_transform(src, dst):
+    # least-squares similarity transform (rotation, uniform scale, translation) from src to dst points
+    # reference: Umeyama, "Least-squares estimation of transformation parameters between two point patterns"
+    src_mean, dst_mean = np.mean(src, axis=0), np.mean(dst, axis=0)
+    src_centered, dst_centered = src - src_mean, dst - dst_mean
+
+    u, s, vt = np.linalg.svd(dst_centered.T @ src_centered / len(src))
+
+    reflection = np.ones(2)
+    if np.linalg.det(u) * np.linalg.det(vt) < 0:
+        reflection[-1] = -1.
+
+    rotation = u @ np.diag(reflection) @ vt
+    scale = np.sum(s * reflection) / np.sum(np.var(src_centered, axis=0))
+    translation = dst_mean - scale * rotation @ src_mean
+
+    return np.hstack([scale * rotation, translation.reshape(2, 1)])
+
+
+def get_landmarks(keypoints):
+    return np.array([keypoints[keypoint] for keypoint in KEYPOINTS], dtype=np.float64)
+
+
+def align_face(img, keypoints, img_shape, dst=None, padding=0.2):
+    matrix = similarity_transform(get_landmarks(keypoints), get_template(img_shape, padding))
+    return cv2.warpAffine(img, matrix, tuple(img_shape)[::-1], dst=dst, flags=cv2.INTER_LINEAR)
@@ -6,6 +6,8 @@ Haarcascade or MTCNN face detection.
 
 """
 
+import threading
+
 import cv2
 from mtcnn import MTCNN as MTCNNBackend
 
@@ -18,6 +20,10 @@ HAARCASCADE = None
 
 PARAMS = {}
 
+# neither detector is thread-safe, but decoding and cropping around them can run in a thread pool
+_MTCNN_LOCK = threading.Lock()
+_HAARCASCADE_LOCK = threading.Lock()
+
 
 # FUNCS
 def detector_init(min_face_size=20, filepath=CONFIG_HOME+"/models/haarcascade_frontalface_default.xml", **kwargs):
@@ -30,6 +36,14 @@ def detector_init(min_face_size=20, filepath=CONFIG_HOME+"/models/haarcascade_fr
     PARAMS.update(kwargs)
 
 
+def set_min_face_size(min_face_size):
+    # avoids re-initializing MTCNN when the frame scale changes
+    PARAMS["min_face_size"] = min_face_size
+
+    if MTCNN:
+        MTCNN.min_face_size = int(round(min_face_size))
+
+
 def detect_faces(img, alpha, mode="mtcnn"):
     assert mode in ("both", "mtcnn", "haarcascade"), "supported modes are 'both', 'mtcnn', 'haarcascade')"
     assert MTCNN and HAARCASCADE, "call detector_init() before using detect_faces()"
@@ -37,11 +51,13 @@ def detect_faces(img, alpha, mode="mtcnn"):
     result = []
 
     if mode == "mtcnn" or mode == "both":
-        result = MTCNN.detect_faces(img)
+        with _MTCNN_LOCK:
+            result = MTCNN.detect_faces(img)
 
     if mode == "haarcascade" or (mode == "both" and (not result or result[0]["confidence"] < alpha)):
         min_face_size = int(round(PARAMS["min_face_size"]))
-        faces = HAARCASCADE.detectMultiScale(img, scaleFactor=1.1, minSize=(min_face_size, min_face_size))
+        with _HAARCASCADE_LOCK:
+            faces = HAARCASCADE.detectMultiScale(img, scaleFactor=1.1, minSize=(min_face_size, min_face_size))
 
         for (x, y, width, height) in faces:
             result.append({
@@ -6,61 +6,143 @@ Preprocessing for FaceNet.
 
 """
 
+import threading
 from timeit import default_timer as timer
 
 import cv2
 import numpy as np
 
+from aisecurity.face.alignment import align_face
 from aisecurity.face.detection import detect_faces
+from aisecurity.utils import metrics
 
 
 # GLOBALS
 IMG_SHAPE = (160, 160)
 
+_LOCAL = threading.local()  # buffers are per thread so that detection can run in a thread pool
+_ROTATION_MATRICES = {}
+
+_FACES = {result: metrics.counter("faces_total", "Face detection results", labels={"result": result})
+          for result in ("detected", "low_confidence", "none")}
+_DETECTION_TIME = {
+    detector: metrics.histogram("detection_seconds", "Face detection and cropping time per frame",
+                                labels={"detector": detector})
+    for detector in ("mtcnn", "haarcascade", "both")  # detection.detect_faces modes
+}
+
 
 def set_img_shape(img_shape):
     global IMG_SHAPE
 
     IMG_SHAPE = tuple(img_shape)
 
+    _get_buffers().clear()
+    _ROTATION_MATRICES.clear()
+
+
+# BUFFER MANAGEMENT
+def _get_buffers():
+    if not hasattr(_LOCAL, "buffers"):
+        _LOCAL.buffers = {}
+    return _LOCAL.buffers
+
+
+def get_buffer(name, shape, dtype=np.float32):
+    # buffers are reused across frames and only reallocated if shape or dtype changes
+    buffers = _get_buffers()
+    buffer = buffers.get(name)
+    if buffer is None or buffer.shape != tuple(shape) or buffer.dtype != dtype:
+        buffer = np.empty(shape, dtype=dtype)
+        buffers[name] = buffer
+    return buffer
+
+
+def get_batch_buffer(batch_size):
+    # batch buffer only grows, so the returned view is valid until the next call to crop_face
+    buffers = _get_buffers()
+    batch = buffers.get("batch")
+    if batch is None or len(batch) < batch_size or batch.shape[1:] != (*IMG_SHAPE, 3):
+        batch = np.empty((batch_size, *IMG_SHAPE, 3), dtype=np.float32)
+        buffers["batch"] = batch
+    return batch[:batch_size]
+
+
+def _rotation_matrix(angle):
+    if angle not in _ROTATION_MATRICES:
+        # https://stackoverflow.com/questions/9041681/opencv-python-rotate-image-by-x-degrees-around-specific-point
+        center = (IMG_SHAPE[1] / 2., IMG_SHAPE[0] / 2.)
+        _ROTATION_MATRICES[angle] = cv2.getRotationMatrix2D(center, angle, 1.)
+    return _ROTATION_MATRICES[angle]
+
 
 # IMAGE PROCESSING
-def normalize(imgs, mode="per_image"):
+def to_rgb(img):
+    # converts into a reusable frame buffer instead of handing opencv a negative-stride view
+    return cv2.cvtColor(img, cv2.COLOR_BGR2RGB, dst=get_buffer("frame", img.shape, img.dtype))
+
+
+def normalize(imgs, mode="per_image", out=None):
+    # pass out=imgs to standardize a float32 batch in place
+    if out is None:
+        out = np.empty(imgs.shape, dtype=np.float32)
+    if out is not imgs:
+        np.copyto(out, imgs, casting="unsafe")
+
     if mode == "per_image":
         # linearly scales x to have mean of 0, variance of 1
-        std_adj = np.maximum(np.std(imgs, axis=(1, 2, 3), keepdims=True), 1. / np.sqrt(imgs.size / len(imgs)))
-        normalized = (imgs - np.mean(imgs, axis=(1, 2, 3), keepdims=True)) / std_adj
+        pixels = out[0].size if len(out) else 1
+        np.subtract(out, np.mean(out, axis=(1, 2, 3), keepdims=True, dtype=np.float32), out=out)
+
+        std = np.sqrt(np.einsum("ijkl,ijkl->i", out, out) / pixels)
+        std_adj = np.maximum(std, 1. / np.sqrt(pixels)).reshape(-1, 1, 1, 1)
+        np.divide(out, std_adj, out=out)
     elif mode == "fixed":
         # scales x to [-1, 1]
-        normalized = (imgs - 127.5) / 128.
+        np.subtract(out, 127.5, out=out)
+        np.divide(out, 128., out=out)
     else:
         raise ValueError("only 'per_image' and 'fixed' standardization supported")
 
-    return normalized
+    return out
 
 
-def crop_face(img, margin, detector="mtcnn", alpha=0.9, rotations=None):
-    def crop_and_rotate(img, face_coords, rotation_angle):
+def write_crops(img, face_coords, margin, rotations, out, keypoints=None):
+    # if keypoints are given, the face is warped onto the canonical landmark template instead of box-cropped
+    resized = get_buffer("resized", (*IMG_SHAPE, 3), img.dtype)
+
+    if keypoints:
+        align_face(img, keypoints, IMG_SHAPE, dst=resized)
+    else:
         x, y, width, height = face_coords
-        img = img[y - margin // 2:y + height + margin // 2, x - margin // 2:x + width + margin // 2, :]
+        img = img[max(y - margin // 2, 0):y + height + margin // 2, max(x - margin // 2, 0):x + width + margin // 2, :]
+        cv2.resize(img, IMG_SHAPE[::-1], dst=resized)
 
-        resized = cv2.resize(img, IMG_SHAPE)
+    upright = get_buffer("upright", (*IMG_SHAPE, 3))
+    np.copyto(upright, resized, casting="unsafe")
+
+    for idx, rotation_angle in enumerate(rotations):
         if rotation_angle == 0:
-            return resized
+            np.copyto(out[idx], upright)
         elif rotation_angle == -1:
-            return cv2.flip(resized, 1)
+            cv2.flip(upright, 1, dst=out[idx])
         else:
-            # https://stackoverflow.com/questions/9041681/opencv-python-rotate-image-by-x-degrees-around-specific-point
-            rotation_matrix = cv2.getRotationMatrix2D(tuple(np.array(resized.shape[1::-1]) / 2), rotation_angle, 1.)
-            return cv2.warpAffine(resized, rotation_matrix, resized.shape[1::-1], flags=cv2.INTER_LINEAR)
+            cv2.warpAffine(upright, _rotation_matrix(rotation_angle), IMG_SHAPE[::-1], dst=out[idx],
+                           flags=cv2.INTER_LINEAR)
+
+    return out
+
 
+def crop_face(img, margin, detector="mtcnn", alpha=0.9, rotations=None, bgr=False, align=False):
+    # returns a view of this thread's float32 batch buffer-- copy it if it needs to outlive the next call
+    # align=True uses MTCNN keypoints when available (haarcascade detections fall back to box crops)
     start = timer()
-    resized_faces, face = [], None
+    resized_faces, face = np.empty((0,), dtype=np.float32), None
 
-    if rotations is None:
-        rotations = [0.]
-    elif 0. not in rotations:
-        rotations.append(0.)
+    rotations = [0.] + sorted(set(rotations or []) - {0.})  # upright face is always first
+
+    if bgr:
+        img = to_rgb(img)
 
     if detector:
         result = detect_faces(img, mode=detector, alpha=alpha)
@@ -69,12 +151,71 @@ def crop_face(img, margin, detector="mtcnn", alpha=0.9, rotations=None):
             face = max(result, key=lambda person: person["confidence"])
 
             if face["confidence"] >= alpha:
-                resized_faces = [crop_and_rotate(img, face["box"], angle) for angle in sorted(rotations)]
-                print("Detection time ({}): \033[1m{} ms\033[0m".format(detector, round(1000. * (timer() - start), 2)))
+                keypoints = face["keypoints"] if align else None
+                batch = get_batch_buffer(len(rotations))
+                resized_faces = write_crops(img, face["box"], margin, rotations, batch, keypoints=keypoints)
+                _FACES["detected"].inc()
+                if not metrics.QUIET:
+                    print("Detection time ({}): \033[1m{} ms\033[0m".format(detector,
+                                                                          round(1000. * (timer() - start), 2)))
             else:
-                print("{}% face detection confidence is too low".format(round(face["confidence"] * 100, 2)))
+                _FACES["low_confidence"].inc()
+                if not metrics.QUIET:
+                    print("{}% face detection confidence is too low".format(round(face["confidence"] * 100, 2)))
 
         else:
-            print("No face detected")
+            _FACES["none"].inc()
+            if not metrics.QUIET:
+                print("No face detected")
+
+        # every detection is timed, found a face or not
+        _DETECTION_TIME[detector].observe(timer() - start)
+
+    return resized_faces, face
+
+
+if __name__ == "__main__":
+    import tracemalloc
+
+    def legacy_preprocess(img, face_coords, margin, rotations):
+        x, y, width, height = face_coords
+        img = img[:, :, ::-1][y - margin // 2:y + height + margin // 2, x - margin // 2:x + width + margin // 2, :]
+
+        resized_faces = []
+        for rotation_angle in rotations:
+            resized = cv2.resize(img, IMG_SHAPE)
+            if rotation_angle == 0:
+                resized_faces.append(resized)
+            elif rotation_angle == -1:
+                resized_faces.append(cv2.flip(resized, 1))
+            else:
+                matrix = cv2.getRotationMatrix2D(tuple(np.array(resized.shape[1::-1]) / 2), rotation_angle, 1.)
+                resized_faces.append(cv2.warpAffine(resized, matrix, resized.shape[1::-1], flags=cv2.INTER_LINEAR))
+
+        imgs = np.array(resized_faces)
+        std_adj = np.maximum(np.std(imgs, axis=(1, 2, 3), keepdims=True), 1. / np.sqrt(imgs.size / len(imgs)))
+        return (imgs - np.mean(imgs, axis=(1, 2, 3), keepdims=True)) / std_adj
+
+    def buffered_preprocess(img, face_coords, margin, rotations):
+        batch = write_crops(to_rgb(img), face_coords, margin, rotations, get_batch_buffer(len(rotations)))
+        return normalize(batch, out=batch)
+
+    frame = np.random.randint(0, 256, (360, 640, 3), dtype=np.uint8)
+    box, test_rotations, trials = (200, 80, 180, 200), [-15., -1, 0., 15.], 500
+
+    for func in (legacy_preprocess, buffered_preprocess):
+        func(frame, box, 10, test_rotations)  # warm-up (fills buffers for the buffered path)
+
+        tracemalloc.start()
+        start = timer()
+        for _ in range(trials):
+            func(frame, box, 10, test_rotations)
+        elapsed = timer() - start
+        __, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        print("{}: {} ms/frame, {} KiB peak allocation".format(
+            func.__name__, round(1000. * elapsed / trials, 4), round(peak / 1024., 2)))
 
-    return np.array(resized_faces), face
+    max_diff = np.max(np.abs(legacy_preprocess(frame, box, 10, [0.]) - buffered_preprocess(frame, box, 10, [0.])))
+    print("Max difference between paths (upright): {}".format(max_diff))
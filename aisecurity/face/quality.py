@@ -0,0 +1,170 @@
+"""
+
+"aisecurity.face.quality"
+
+Face quality gate (sharpness, size, brightness, yaw) applied before embedding.
+
+"""
+
+import numpy as np
+
+
+# GLOBALS
+THRESHOLDS = {
+    "sharpness": 20.,  # minimum variance of the Laplacian of the grayscale crop
+    "min_size": 40,  # minimum side length of the detected face box (pixels)
+    "min_brightness": 40.,  # minimum mean grayscale value
+    "max_brightness": 220.,  # maximum mean grayscale value
+    "max_yaw": 0.35,  # maximum |nose offset from eye midpoint| / eye distance
+}
+
+MODES = (None, "skip", "defer")
+
+_GRAY_WEIGHTS = np.array([0.299, 0.587, 0.114], dtype=np.float32)  # RGB crops
+
+
+# INIT
+def init(mode="skip", thresholds=None, max_deferred=None):
+    # configures the default gate used by gate()-- pipelines with more than one camera should use a QualityGate each
+    global THRESHOLDS
+
+    assert mode in MODES, "supported quality gate modes are None, 'skip', and 'defer'"
+
+    POLICY["mode"] = mode
+    if max_deferred is not None:
+        POLICY["max_deferred"] = max_deferred
+    if thresholds:
+        THRESHOLDS = {**THRESHOLDS, **thresholds}
+
+    reset()
+
+
+def reset():
+    DEFAULT.reset()
+
+
+def deferred_frame_num():
+    return DEFAULT.deferred_frame_num()
+
+
+# SCORING
+def score_faces(imgs, boxes=None, keypoints=None):
+    # imgs: RGB crops with shape (batch_size, h, w, 3); boxes: (batch_size, 4); keypoints: list of MTCNN dicts
+    gray = np.dot(imgs, _GRAY_WEIGHTS)
+
+    laplacian = gray[:, :-2, 1:-1] + gray[:, 2:, 1:-1] + gray[:, 1:-1, :-2] + gray[:, 1:-1, 2:] \
+                - 4. * gray[:, 1:-1, 1:-1]
+
+    scores = {
+        "sharpness": np.var(laplacian, axis=(1, 2)),
+        "brightness": np.mean(gray, axis=(1, 2)),
+        "size": np.full(len(imgs), np.inf),
+        "yaw": np.zeros(len(imgs))
+    }
+
+    if boxes is not None:
+        boxes = np.asarray(boxes, dtype=np.float32).reshape(-1, 4)
+        scores["size"] = np.minimum(boxes[:, 2], boxes[:, 3])
+
+    if keypoints is not None and all(keypoints):
+        left_eye, right_eye, nose = (
+            np.array([points[name] for points in keypoints], dtype=np.float32)
+            for name in ("left_eye", "right_eye", "nose")
+        )
+        eye_dist = np.maximum(np.linalg.norm(right_eye - left_eye, axis=-1), 1.)
+        scores["yaw"] = np.abs(nose[:, 0] - (left_eye[:, 0] + right_eye[:, 0]) / 2.) / eye_dist
+
+    return scores
+
+
+def get_rejections(scores, thresholds=None):
+    thresholds = thresholds if thresholds else THRESHOLDS
+    return {
+        "sharpness": scores["sharpness"] < thresholds["sharpness"],
+        "size": scores["size"] < thresholds["min_size"],
+        "brightness": (scores["brightness"] < thresholds["min_brightness"]) |
+                      (scores["brightness"] > thresholds["max_brightness"]),
+        "yaw": scores["yaw"] > thresholds["max_yaw"]
+    }
+
+
+# GATE
+class QualityGate:
+    """Skips or defers low-quality faces-- deferral spans consecutive frames, so every camera (or session) needs its
+    own gate"""
+
+    def __init__(self, mode="skip", thresholds=None, max_deferred=5):
+        """Initializes QualityGate
+        :param mode: None (gate disabled), "skip", or "defer" (default: "skip")
+        :param thresholds: overrides for quality.THRESHOLDS (default: None)
+        :param max_deferred: "defer" only: consecutive rejections before the best rejected face is embedded anyway
+                             (default: 5)
+        """
+
+        assert mode in MODES, "supported quality gate modes are None, 'skip', and 'defer'"
+
+        self.policy = {"mode": mode, "max_deferred": max_deferred}
+        self.thresholds = thresholds
+
+        self.rejections = {"accepted": 0, "sharpness": 0, "size": 0, "brightness": 0, "yaw": 0, "released": 0}
+        self._deferred = {}
+        self.reset()
+
+    def reset(self):
+        for reason in self.rejections:
+            self.rejections[reason] = 0
+        self._clear_deferred()
+
+    def _clear_deferred(self):
+        self._deferred.update(faces=None, face=None, sharpness=-np.inf, frames=0, frame_num=None)
+
+    def deferred_frame_num(self):
+        # frame number of the best deferred face so far, None if nothing is deferred
+        return self._deferred["frame_num"]
+
+    def gate(self, cropped_faces, face, frame_num=None):
+        # scores upright crop (cropped_faces[0]); returns (faces, face) to embed or (None, None) if skipped/deferred--
+        # a released deferred face keeps the box and keypoints of the frame it was captured in, and
+        # face["frame_num"] says which frame that was
+        if self.policy["mode"] is None:
+            return cropped_faces, face
+
+        keypoints = [face["keypoints"]] if face["keypoints"] else None
+        scores = score_faces(cropped_faces[:1], boxes=[face["box"]], keypoints=keypoints)
+        thresholds = {**THRESHOLDS, **self.thresholds} if self.thresholds else None
+
+        rejected = False
+        for reason, mask in get_rejections(scores, thresholds).items():
+            if mask[0]:
+                self.rejections[reason] += 1
+                rejected = True
+
+        if not rejected:
+            self.rejections["accepted"] += 1
+            self._clear_deferred()
+            return cropped_faces, face
+
+        if self.policy["mode"] == "defer":
+            self._deferred["frames"] += 1
+
+            if scores["sharpness"][0] > self._deferred["sharpness"]:
+                # cropped_faces is a view into a reused buffer, so deferred faces have to be copied
+                self._deferred.update(faces=cropped_faces.copy(), face={**face, "frame_num": frame_num},
+                                      sharpness=scores["sharpness"][0], frame_num=frame_num)
+
+            if self._deferred["frames"] >= self.policy["max_deferred"]:
+                deferred_faces, deferred_face = self._deferred["faces"], self._deferred["face"]
+                self.rejections["released"] += 1
+                self._clear_deferred()
+                return deferred_faces, deferred_face
+
+        return None, None
+
+
+# DEFAULT GATE
+DEFAULT = QualityGate(mode=None)
+POLICY, REJECTIONS = DEFAULT.policy, DEFAULT.rejections  # aliases, configured by init()
+
+
+def gate(cropped_faces, face, frame_num=None):
+    return DEFAULT.gate(cropped_faces, face, frame_num=frame_num)
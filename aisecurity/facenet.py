@@ -10,6 +10,7 @@ Reference paper: https://arxiv.org/pdf/1503.03832.pdf
 
 import json
 import os
+import threading
 import time
 from timeit import default_timer as timer
 import warnings
@@ -22,17 +23,34 @@ from sklearn import neighbors
 import tensorflow as tf
 from termcolor import cprint
 
+from aisecurity.dataflow import shared, verification
+from aisecurity.dataflow.reload import DatabaseWatcher
+from aisecurity.dataflow.shared import GalleryKNN
+from aisecurity.dataflow.visitors import VisitorStore
 from aisecurity.dataflow.loader import print_time, retrieve_embeds
 from aisecurity.db import log, connection
 from aisecurity.optim import engine
-from aisecurity.utils import lcd
+from aisecurity.utils import lcd, metrics
+from aisecurity.utils.capture import ThreadedCapture
 from aisecurity.utils.distance import DistMetric
 from aisecurity.utils.paths import DATABASE, DATABASE_INFO, DEFAULT_MODEL, CONFIG_HOME
-from aisecurity.utils.visuals import get_video_cap, add_graphics
-from aisecurity.face.detection import detector_init
+from aisecurity.utils.visuals import get_video_cap, Renderer
+from aisecurity.face import quality
+from aisecurity.face.detection import detector_init, set_min_face_size
 from aisecurity.face.preprocessing import set_img_shape, normalize, crop_face, IMG_SHAPE
 
 
+# METRICS
+_EMBEDDING_TIME = metrics.histogram("embedding_seconds", "Normalization and embedding time per batch")
+_EMBEDS = metrics.counter("embeddings_total", "Embedded faces, rotations included")
+_SEARCH_TIME = metrics.histogram("search_seconds", "K-NN search and distance time per batch")
+_RECOGNITION_TIME = metrics.histogram("recognition_seconds", "Detection, embedding, and search time per frame")
+_DISTANCES = metrics.histogram("best_match_distance", "Distance to the best match",
+                               buckets=(0.25, 0.5, 0.6, 0.7, 0.75, 0.8, 0.9, 1., 1.25, 1.5))
+_FRAMES = {result: metrics.counter("frames_total", "Recognition results per frame", labels={"result": result})
+           for result in ("recognized", "unrecognized", "no_face", "capture_failed")}
+
+
 ################################ FaceNet ###############################
 class FaceNet:
     """Class implementation of FaceNet"""
@@ -48,7 +66,7 @@ class FaceNet:
     # INITS
     @print_time("Model load time")
     def __init__(self, model_path=DEFAULT_MODEL, data_path=DATABASE, sess=None, input_name=None, output_name=None,
-                 input_shape=None):
+                 input_shape=None, gallery=None):
         """Initializes FaceNet object
         :param model_path: path to model (default: aisecurity.utils.paths.DEFAULT_MODEL)
         :param data_path: path to data(default: aisecurity.utils.paths.DATABASE)
@@ -56,6 +74,7 @@ class FaceNet:
         :param input_name: name of input tensor-- only required if using TF/TRT non-default model (default: None)
         :param output_name: name of output tensor-- only required if using TF/TRT non-default model (default: None)
         :param input_shape: input shape-- only required if using TF/TRT non-default model (default: None)
+        :param gallery: SharedGallery to attach instead of loading data_path (default: None)
         """
 
         assert os.path.exists(model_path), "{} not found".format(model_path)
@@ -76,9 +95,22 @@ class FaceNet:
                 self.img_norm = self.MODELS[model]["img_norm"]
 
         self._db = {}
-        self._knn = None
-
-        if data_path:
+        self._index = {"names": [], "embeds": [], "rows": {}, "knn": None}  # replaced as a whole, never mutated
+        self._data_lock = threading.RLock()  # serializes updates and reloads
+        self.gallery = None  # SharedGallery, if attached
+
+        self.tta_stats = {"frames": 0, "triggered": 0, "embeds": 0}
+        self.timings = {"detection": 0., "embedding": 0.}  # per-call stage latencies (seconds) of last recognize
+
+        self.verifications = None  # VerificationQueue, set up by real_time_recognize if data_mutable
+        self.visitors = None  # VisitorStore, set up by real_time_recognize if dynamic_log
+        self.capture_stats = None  # dropped frames and capture-to-result latency of the last real_time_recognize
+        self.render_stats = None  # rendered/skipped frames and per-frame render time of the last real_time_recognize
+        self.quality_stats = None  # quality gate rejections of the last real_time_recognize
+
+        if gallery:
+            self.attach_gallery(gallery)
+        elif data_path:
             self.set_data(retrieve_embeds(data_path), config=DATABASE_INFO)
         else:
             warnings.warn("data not set. Set it manually with set_data to use FaceNet")
@@ -206,16 +238,48 @@ class FaceNet:
         person, embeddings = self._screen_data(person, embeddings)
         embeddings = [np.array(embed).reshape(-1, ) for embed in embeddings]
 
-        if not self.data:
-            self._db = {}
+        with self._data_lock:
+            if self.gallery:
+                # shared galleries are read-only: updates are published as a new generation
+                self.gallery.update({person: embeddings})
+                self._use_gallery()
+                return
 
-        if person in self.data:
-            self._db[person].extend(embeddings)
-        else:
-            self._db[person] = embeddings
+            if not self.data:
+                self._db = {}
 
-        if train_knn:
-            self._train_knn()
+            if person in self.data:
+                self._db[person].extend(embeddings)
+            else:
+                self._db[person] = embeddings
+
+            if train_knn:
+                self._train_knn()
+
+    def apply_updates(self, updates):
+        """Adds embeddings to existing entries with a single K-NN retrain
+        :param updates: new embeddings in form {name: [embedding, ...], ...}
+        """
+
+        accepted = {}
+        for person, embeddings in updates.items():
+            if person in self.data:
+                accepted[person] = [np.array(embed).reshape(-1, ) for embed in embeddings]
+                cprint("Static entry for '{}' updated".format(person), color="blue", attrs=["bold"])
+            else:
+                cprint("'{}' is not in database".format(person), attrs=["bold"])
+
+        if not accepted:
+            return
+
+        with self._data_lock:
+            if self.gallery:
+                self.gallery.update(accepted)
+                self._use_gallery()
+            else:
+                for person, embeddings in accepted.items():
+                    self.update_data(person, embeddings, train_knn=False)
+                self._train_knn()
 
     def set_data(self, data, config=None):
         """Sets data property
@@ -223,18 +287,81 @@ class FaceNet:
         :param config: data config dict with the entry "metric": <DistMetric str constructor> (default: None)
         """
 
-        self._db = None
+        with self._data_lock:
+            self._db = None
+            self.gallery = None
 
-        if data:
-            for person, embed in data.items():
-                self.update_data(person, embed, train_knn=False)
-            self._train_knn()
+            if data:
+                for person, embed in data.items():
+                    self.update_data(person, embed, train_knn=False)
+                self._train_knn()
 
+        if data:
             if config is None:
                 warnings.warn("data config missing. Distance metric not detected")
             else:
                 self.data_cfg = config
 
+    def attach_gallery(self, gallery):
+        """Uses a shared, memory-mapped gallery instead of a private copy of the database
+        :param gallery: SharedGallery (attached if it isn't already)
+        """
+
+        self.gallery = gallery if gallery.generation is not None else gallery.attach()
+        self._use_gallery()
+
+        if gallery.config is None:
+            warnings.warn("data config missing. Distance metric not detected")
+        else:
+            self.data_cfg = gallery.config
+
+    def _use_gallery(self):
+        """Points data and K-NN at the current gallery generation (no copies, no fitting)"""
+
+        names = self.gallery.names
+
+        rows = {}
+        for row, name in enumerate(names):
+            rows.setdefault(name, row)
+
+        with self._data_lock:
+            self._db = self.gallery.data
+            self._index = {"names": names, "embeds": self.gallery.embeds, "rows": rows,
+                           "knn": GalleryKNN(self.gallery)}
+
+    def reload_data(self, data_path=DATABASE, config=None):
+        """Loads and indexes a database, then swaps it in atomically-- recognition keeps running meanwhile and
+        frames that are already being analyzed finish against the old database
+        :param data_path: path to data (default: aisecurity.utils.paths.DATABASE)
+        :param config: data config dict (default: None, aisecurity.utils.paths.DATABASE_INFO)
+        :returns: number of people in the new database
+        """
+
+        config = config if config else DATABASE_INFO
+        assert config["metric"] == self.data_cfg["metric"], \
+            "database metric changed ({} -> {}), restart to reload".format(self.data_cfg["metric"], config["metric"])
+
+        data = retrieve_embeds(data_path)
+
+        if self.gallery:
+            shared.publish(data, self.gallery.directory, config=config)
+            with self._data_lock:
+                self.gallery.refresh()
+                self._use_gallery()
+            return len(self.data)
+
+        db = {}
+        for person, embeddings in data.items():
+            person, embeddings = self._screen_data(person, embeddings)
+            db[person] = [np.array(embed).reshape(-1, ) for embed in embeddings]
+
+        index = self._build_index(db)  # the slow part, done before taking the lock
+
+        with self._data_lock:
+            self._db, self._index = db, index
+
+        return len(db)
+
     def set_dist_metric(self, dist_metric):
         """Sets distance metric for FaceNet
         :param dist_metric: DistMetric object or str constructor, or "auto+{whatever}" to detect from self.data_cfg
@@ -270,24 +397,35 @@ class FaceNet:
 
     def _train_knn(self):
         """Trains K-Nearest-Neighbors"""
+        self._index = self._build_index(self.data)
+
+    @staticmethod
+    def _build_index(data):
+        """Builds K-Nearest-Neighbors and lookup tables for a database
+        :param data: data in form {name: [embedding, ...], ...}
+        :returns: dict with "names" and "embeds" (one per row), "rows" (first row of every name), and "knn"
+        """
+
         try:
-            self.expanded_names = []
-            self.expanded_embeds = []
+            names, embeds, rows = [], [], {}
 
-            for name, embeddings in self.data.items():
+            for name, embeddings in data.items():
                 for embed in embeddings:
-                    self.expanded_names.append(name)
-                    self.expanded_embeds.append(embed)
+                    rows.setdefault(name, len(names))
+                    names.append(name)
+                    embeds.append(embed)
 
             # always use minkowski distance, other metrics are just normalizing before minkowski to act
             # as the desired metric (ex: cosine)
-            n_neighbors = len(self.expanded_names) // len(set(self.expanded_names))
-            self._knn = neighbors.KNeighborsClassifier(n_neighbors=n_neighbors)
-            self._knn.fit(self.expanded_embeds, self.expanded_names)
+            n_neighbors = len(names) // len(set(names))
+            knn = neighbors.KNeighborsClassifier(n_neighbors=n_neighbors)
+            knn.fit(embeds, names)
 
         except (AttributeError, ValueError):
             raise ValueError("Current model incompatible with database")
 
+        return {"names": names, "embeds": embeds, "rows": rows, "knn": knn}
+
 
     # RETRIEVERS
     @property
@@ -298,6 +436,35 @@ class FaceNet:
 
         return self._db
 
+    @property
+    def expanded_names(self):
+        """Property for the name of every embedding in the K-NN index
+        :returns: list of names
+        """
+
+        return self._index["names"]
+
+    @property
+    def expanded_embeds(self):
+        """Property for every embedding in the K-NN index
+        :returns: list (or array) of embeddings
+        """
+
+        return self._index["embeds"]
+
+    @property
+    def tta_metrics(self):
+        """Property for test-time augmentation metrics
+        :returns: dict with augmentation trigger rate and average embeddings per frame
+        """
+
+        frames = max(self.tta_stats["frames"], 1)
+        return {
+            **self.tta_stats,
+            "trigger_rate": self.tta_stats["triggered"] / frames,
+            "embeds_per_frame": self.tta_stats["embeds"] / frames
+        }
+
     @staticmethod
     def get_frozen_graph(path):
         """Gets frozen graph from .pb file (TF only)
@@ -326,93 +493,221 @@ class FaceNet:
 
         return embeds.reshape(len(imgs), -1)
 
-    def predict(self, img, detector="both", margin=10, rotations=None):
+    def _crop(self, img, detector, margin, rotations, align, frame_num=None, gate=None):
+        """Detects, crops, and quality-checks a face
+        :param img: image to be cropped (BGR image)
+        :param detector: face detector (either mtcnn, haarcascade, or None)
+        :param margin: margin for MTCNN face cropping
+        :param rotations: array of rotations to be applied to face
+        :param align: align face to landmark template using MTCNN keypoints
+        :param frame_num: frame number of img, stamped on faces deferred by the quality gate (default: None)
+        :param gate: QualityGate of the caller's camera or session (default: None, quality.DEFAULT)
+        :returns: cropped faces (upright first), facial coordinates
+        """
+
+        start = timer()
+        cropped_faces, face_coords = crop_face(img, margin, detector, rotations=rotations, bgr=True, align=align)
+        self.timings["detection"] += timer() - start
+
+        assert cropped_faces.shape[1:] == (*IMG_SHAPE, 3), "no face detected"
+
+        gate = gate if gate else quality.DEFAULT
+        cropped_faces, face_coords = gate.gate(cropped_faces, face_coords, frame_num=frame_num)
+        assert cropped_faces is not None, "face quality too low"
+
+        return cropped_faces, face_coords
+
+    def predict(self, img, detector="both", margin=10, rotations=None, align=False, frame_num=None, gate=None):
         """Embeds and normalizes an image from path or array
         :param img: image to be predicted on (BGR image)
         :param detector: face detector (either mtcnn, haarcascade, or None) (default: "both")
         :param margin: margin for MTCNN face cropping (default: 10)
         :param rotations: array of rotations to be applied to face (default: None)
+        :param align: align face to landmark template using MTCNN keypoints (default: False)
+        :param frame_num: frame number of img, for the quality gate (default: None)
+        :param gate: QualityGate to use (default: None, quality.DEFAULT)
         :returns: normalized embeddings, facial coordinates
         """
 
-        cropped_faces, face_coords = crop_face(img[:, :, ::-1], margin, detector, rotations=rotations)
-        start = timer()
+        cropped_faces, face_coords = self._crop(img, detector, margin, rotations, align, frame_num, gate)
 
-        assert cropped_faces.shape[1:] == (*IMG_SHAPE, 3), "no face detected"
+        return self.embed_crops(cropped_faces), face_coords
+
+    def predict_adaptive(self, img, tta_band, detector="both", margin=10, rotations=None, align=False,
+                         frame_num=None, gate=None):
+        """Embeds the upright face and only embeds rotations if the upright match is ambiguous
+        :param img: image to be predicted on (BGR image)
+        :param tta_band: rotations are embedded only if |dist - FaceNet.ALPHA| <= tta_band
+        :param detector: face detector (either mtcnn, haarcascade, or None) (default: "both")
+        :param margin: margin for MTCNN face cropping (default: 10)
+        :param rotations: array of rotations to be applied to face (default: None)
+        :param align: align face to landmark template using MTCNN keypoints (default: False)
+        :param frame_num: frame number of img, for the quality gate (default: None)
+        :param gate: QualityGate to use (default: None, quality.DEFAULT)
+        :returns: normalized embeddings, facial coordinates, analysis dict
+        """
+
+        cropped_faces, face_coords = self._crop(img, detector, margin, rotations, align, frame_num, gate)
+
+        # crop_face always puts the upright face first
+        embeds = self.embed_crops(cropped_faces[:1])
+        analysis = self._analyze_embeds(embeds)
 
-        raw_embeddings = np.expand_dims(self.embed(normalize(cropped_faces, mode=self.img_norm)), axis=1)
+        if len(cropped_faces) > 1 and abs(analysis["dists"][0] - FaceNet.ALPHA) <= tta_band:
+            rotated_embeds = self.embed_crops(cropped_faces[1:])
+            for key, values in self._analyze_embeds(rotated_embeds).items():
+                analysis[key].extend(values)
+
+            embeds = np.concatenate([embeds, rotated_embeds])
+            self.tta_stats["triggered"] += 1
+
+        return embeds, face_coords, analysis
+
+    def embed_crops(self, cropped_faces):
+        """Normalizes (in-place) and embeds preprocessed faces
+        :param cropped_faces: float32 array of faces with shape (batch_size, h, w, 3)-- will be overwritten
+        :returns: normalized embeddings
+        """
+
+        start = timer()
+
+        normalize(cropped_faces, mode=self.img_norm, out=cropped_faces)  # in-place, cropped_faces is a float32 buffer
+        raw_embeddings = np.expand_dims(self.embed(cropped_faces), axis=1)
         normalized_embeddings = self.dist_metric.apply_norms(*raw_embeddings)
 
-        message = "{} rotation{}".format(len(normalized_embeddings), "s" if len(normalized_embeddings) > 1 else "")
-        print("Embedding time ({}): \033[1m{} ms\033[0m".format(message, round(1000. * (timer() - start), 2)))
+        elapsed = timer() - start
+        self.timings["embedding"] += elapsed
+        _EMBEDDING_TIME.observe(elapsed)
+        _EMBEDS.inc(len(normalized_embeddings))
 
-        return normalized_embeddings, face_coords
+        if not metrics.QUIET:
+            message = "{} rotation{}".format(len(normalized_embeddings), "s" if len(normalized_embeddings) > 1 else "")
+            print("Embedding time ({}): \033[1m{} ms\033[0m".format(message, round(1000. * elapsed, 2)))
+
+        return normalized_embeddings
 
 
     # FACIAL RECOGNITION HELPER
-    def recognize(self, img, **kwargs):
+    def _analyze_embeds(self, embeds):
+        """Finds best match and distance for each embedding
+        :param embeds: normalized embeddings
+        :returns: dict with "best_match", "dists", and "is_recognized" lists
+        """
+
+        start = timer()
+
+        if self.gallery and self.gallery.generation != shared.current_generation(self.gallery.directory):
+            # another process published a new generation
+            with self._data_lock:
+                if self.gallery.refresh():
+                    self._use_gallery()
+
+        index = self._index  # a reload swaps self._index, but this frame finishes against the index it started with
+
+        analysis = {"best_match": [], "dists": [], "is_recognized": []}
+        for embed in embeds:
+            analysis["best_match"].append(index["knn"].predict(embed)[0])
+            best_embed = index["embeds"][index["rows"][analysis["best_match"][-1]]]
+
+            analysis["dists"].append(self.dist_metric.distance(embed, best_embed, ignore_norms=self.ignore_norms))
+
+            if self.visitors:
+                # visitors are searched separately so that the static gallery and K-NN are never touched
+                visitor, visitor_dist = self.visitors.nearest(embed)
+                if visitor is not None and visitor_dist < analysis["dists"][-1]:
+                    analysis["best_match"][-1], analysis["dists"][-1] = visitor, visitor_dist
+                    if visitor_dist <= FaceNet.ALPHA:
+                        self.visitors.touch(visitor)
+
+            analysis["is_recognized"].append(analysis["dists"][-1] <= FaceNet.ALPHA)
+
+        _SEARCH_TIME.observe(timer() - start)
+
+        return analysis
+
+    @staticmethod
+    def _select_match(analysis):
+        """Picks the best match across rotations (majority vote, then minimum distance)
+        :param analysis: dict returned by _analyze_embeds
+        :returns: best match, index of the embedding to use
+        """
+
+        if len(analysis["best_match"]) > 1:
+            best_match = max(analysis["best_match"], key=analysis["best_match"].count)
+
+            best_match_idxs = [idx for idx, person in enumerate(analysis["best_match"]) if person == best_match]
+            min_index = min(best_match_idxs, key=lambda idx: analysis["dists"][idx])
+            # index associated with minimum distance best_match embedding
+
+        else:
+            best_match = analysis["best_match"][0]
+            min_index = 0
+
+        return best_match, min_index
+
+    def recognize(self, img, tta_band=None, **kwargs):
         """Facial recognition
         :param img: image array in BGR mode
+        :param tta_band: if provided, only embed rotations if the upright distance is within tta_band of FaceNet.ALPHA
         :param kwargs: named arguments to self.get_embeds (will be passed to self.predict)
         :returns: embedding, is recognized (bool), best match from database(s), distance
         """
 
-        def analyze_embeds(embeds):
-            analysis = {"best_match": [], "dists": [], "is_recognized": []}
-            for embed in embeds:
-                analysis["best_match"].append(self._knn.predict(embed)[0])
-                best_embed = self.expanded_embeds[self.expanded_names.index(analysis["best_match"][-1])]
-
-                analysis["dists"].append(self.dist_metric.distance(embed, best_embed, ignore_norms=self.ignore_norms))
-                analysis["is_recognized"].append(analysis["dists"][-1] <= FaceNet.ALPHA)
-
-            return analysis
-
         start = timer()
         embed, is_recognized, best_match, dist, face, elapsed = None, None, None, None, None, None
+        self.timings = {"detection": 0., "embedding": 0.}
+        result = "no_face"
 
         try:
-            embeds, face = self.predict(img, **kwargs)
-            analysis = analyze_embeds(embeds)
-
-            if len(embeds) > 1:
-                best_match = max(analysis["best_match"], key=analysis["best_match"].count)
+            if tta_band is not None:
+                embeds, face, analysis = self.predict_adaptive(img, tta_band, **kwargs)
+            else:
+                embeds, face = self.predict(img, **kwargs)
+                analysis = self._analyze_embeds(embeds)
 
-                best_match_idxs = [idx for idx, person in enumerate(analysis["best_match"]) if person == best_match]
-                min_index = min(best_match_idxs, key=lambda idx: analysis["dists"][idx])
-                # index associated with minimum distance best_match embedding
+            self.tta_stats["frames"] += 1
+            self.tta_stats["embeds"] += len(embeds)
 
-            else:
-                best_match = analysis["best_match"][0]
-                min_index = 0
+            best_match, min_index = self._select_match(analysis)
 
             embed = embeds[min_index]
             dist = analysis["dists"][min_index]
             is_recognized = analysis["is_recognized"][min_index]
 
-            print("%s: \033[1m%.4f (%s)%s\033[0m" % (self.dist_metric, dist, best_match, "" if is_recognized else " !"))
+            result = "recognized" if is_recognized else "unrecognized"
+            _DISTANCES.observe(dist)
+            if not metrics.QUIET:
+                print("%s: \033[1m%.4f (%s)%s\033[0m" % (self.dist_metric, dist, best_match,
+                                                          "" if is_recognized else " !"))
 
         except (ValueError, AssertionError, cv2.error) as error:
             if "query data dimension" in str(error):
                 raise ValueError("Current model incompatible with database")
             elif isinstance(error, cv2.error) and "resize" in str(error):
-                print("Frame capture failed")
+                result = "capture_failed"
+                if not metrics.QUIET:
+                    print("Frame capture failed")
             elif not isinstance(error, AssertionError):
                 raise error
 
-        elapsed = round(1000. * (timer() - start), 4)
+        elapsed = timer() - start
+        _RECOGNITION_TIME.observe(elapsed)
+        _FRAMES[result].inc()
+
+        elapsed = round(1000. * elapsed, 4)
         return embed, is_recognized, best_match, dist, face, elapsed
 
 
     # REAL-TIME FACIAL RECOGNITION
     def real_time_recognize(self, width=640, height=360, dist_metric=None, logging=None, dynamic_log=False, pbar=False,
                             resize=None, flip=0, detector="both", data_mutable=False, socket=None, rotations=None,
-                            device=0):
+                            device=0, align=False, tta_band=None, quality_gate=None, scheduler=None, snapshots=False,
+                            verify_port=None, capture_mode=None, render="window", watch_data=False):
         """Real-time facial recognition
         :param width: width of frame (only matters if use_graphics is True) (default: 640)
         :param height: height of frame (only matters if use_graphics is True) (default: 360)
         :param dist_metric: DistMetric object or str distance metric (default: this.dist_metric)
-        :param logging: logging type-- None, "firebase", or "mysql" (default: None)
+        :param logging: logging type-- None, "firebase", "mysql", or "sqlite" (default: None)
         :param dynamic_log: use dynamic database for visitors or not (default: False)
         :param pbar: use progress bar or not. If Pi isn't reachable, will default to LCD simulation (default: False)
         :param resize: resize scale (float between 0. and 1.) (default: None)
@@ -422,61 +717,166 @@ class FaceNet:
         :param socket: socket address (dev only)
         :param rotations: rotations to be applied to face (-1 is horizontal flip) (default: None)
         :param device: video file to read from (passing an int will use /dev/video{device}) (default: 0)
+        :param align: align faces using MTCNN keypoints-- usually replaces rotations (default: False)
+        :param tta_band: embed rotations only if upright distance is within tta_band of FaceNet.ALPHA (default: None)
+        :param quality_gate: skip or defer low-quality faces-- None, "skip", or "defer" (default: None)
+        :param scheduler: LatencyScheduler that overrides resize, detector, and rotations per frame (default: None)
+        :param snapshots: save face snapshots with unknown activity (default: False)
+        :param verify_port: if data_mutable, also accept verification answers over HTTP on this port (default: None)
+        :param capture_mode: "latest" (drop stale frames) or "ordered" (every frame) (default: None, "ordered" for
+                             video files and "latest" for cameras)
+        :param render: "window" (draw and show frames in the cam loop), "thread" (on a render thread), or None
+                       (headless) (default: "window")
+        :param watch_data: reload the database in the background whenever DATABASE changes (default: False)
         """
 
         # INITS
         assert self._db, "data must be provided"
-        log.init(logging, flush=True)
+        log.init(logging, flush=True, snapshots=snapshots)
         if dist_metric:
             self.set_dist_metric(dist_metric)
         if socket:
             connection.init(socket)
         if pbar:
             lcd.init()
+        if dynamic_log:
+            self.visitors = VisitorStore(
+                FaceNet.ALPHA, distance=lambda a, b: self.dist_metric.distance(a, b, ignore_norms=self.ignore_norms)
+            )
+        if data_mutable:
+            # answered from the websocket (or console) and over HTTP without blocking the cam loop
+            self.verifications = verification.init(client=connection.SOCKET, http_port=verify_port)
+        gate = quality.QualityGate(mode=quality_gate)  # per session, so that nothing is carried over from the last one
+        watcher = DatabaseWatcher(self) if watch_data else None
         if resize:
             assert 0. <= resize <= 1., "resize must be in [0., 1.]"
             face_width, face_height = width * resize, height * resize
         else:
             face_width, face_height = width, height
 
-        cap = get_video_cap(width, height, flip, device)
+        if capture_mode is None:
+            capture_mode = "ordered" if isinstance(device, str) else "latest"
+        cap = ThreadedCapture(get_video_cap(width, height, flip, device), mode=capture_mode)
+
+        assert render in ("window", "thread", None), "supported render modes are 'window', 'thread', and None"
+        renderer = Renderer("AI Security v0.9a", threaded=render == "thread") if render else None
         detector_init(min_face_size=0.5 * (face_width + face_height) / 2)
         # face needs to fill at least ~1/2 of the frame
 
         absent_frames = 0
         frames = 0
+        deferred_frame = None  # frame of the best face deferred by the quality gate
 
         # CAM LOOP
         while True:
-            _, frame = cap.read()
-            original_frame = frame.copy()
+            if scheduler:
+                resize, detector, rotations = self._apply_schedule(scheduler, resize, width, height)
+                scheduler.start_frame()
+
+            ret, frame = cap.read()
+            if not ret:
+                break
+            original_frame = frame  # capture returns a new array every frame and frame is only read until rendering
 
             if resize:
                 frame = cv2.resize(frame, (0, 0), fx=resize, fy=resize)
 
             # facial detection and recognition
             embed, is_recognized, best_match, dist, face, elapsed = self.recognize(
-                frame, detector=detector, rotations=rotations
+                frame, detector=detector, rotations=rotations, align=align, tta_band=tta_band, frame_num=frames,
+                gate=gate
             )
 
+            face_frame, drawn_face = original_frame, face
+            if gate.deferred_frame_num() == frames:
+                deferred_frame = original_frame
+            elif face is not None and face.get("frame_num", frames) != frames:
+                # released by the quality gate: the face was captured in an earlier frame, so its box doesn't belong
+                # on this one
+                face_frame, drawn_face = deferred_frame, None
+
+            cap.record_result()
+            if scheduler:
+                for stage, stage_elapsed in self.timings.items():
+                    scheduler.record(stage, stage_elapsed)
+
             # graphics, logging, lcd, etc.
-            absent_frames += self.log_activity(best_match, embed, dynamic_log, data_mutable, pbar, dist, absent_frames)
-            add_graphics(original_frame, face, width, height, is_recognized, best_match, resize, elapsed)
+            snapshot = None
+            if log.SNAPSHOTS and face is not None and not is_recognized:
+                snapshot = self._get_snapshot(face_frame, face, resize)
 
-            cv2.imshow("AI Security v0.9a", original_frame)
-            if cv2.waitKey(1) & 0xFF == ord("q"):
-                break
+            absent_frames += self.log_activity(best_match, embed, dynamic_log, data_mutable, pbar, dist, absent_frames,
+                                               snapshot=snapshot)
+
+            if renderer:
+                renderer.submit(original_frame, drawn_face, width, height, is_recognized, best_match, resize, elapsed)
+                if renderer.quit.is_set():
+                    break
 
             frames += 1
+            if scheduler:
+                scheduler.end_frame()
 
         cap.release()
-        cv2.destroyAllWindows()
+        self.capture_stats = cap.stats
+        self.quality_stats = gate.rejections
+
+        if watcher:
+            watcher.close()
+
+        if renderer:
+            renderer.close()
+            self.render_stats = renderer.stats
+        log.close()
+        lcd.close()
+
+        if self.verifications:
+            self.verifications.close()
+            self.apply_updates(self.verifications.drain(force=True))
+            self.verifications = None
+
+        connection.close()
 
         return frames
 
 
+    @staticmethod
+    def _apply_schedule(scheduler, resize, width, height):
+        """Applies scheduler settings, updating minimum face size if the resize scale changed
+        :param scheduler: LatencyScheduler object
+        :param resize: current resize scale
+        :param width: width of frame
+        :param height: height of frame
+        :returns: resize, detector, rotations
+        """
+
+        settings = scheduler.settings
+
+        if settings["resize"] != resize:
+            set_min_face_size(0.5 * settings["resize"] * (width + height) / 2)
+
+        return settings["resize"], settings["detector"], settings["rotations"]
+
+
+    @staticmethod
+    def _get_snapshot(frame, face, resize, margin=10):
+        """Crops a face from the full-size frame for unknown activity snapshots
+        :param frame: full-size BGR frame
+        :param face: face detected in the (possibly resized) frame
+        :param resize: resize scale of the frame used for detection
+        :param margin: margin around the face box in pixels (default: 10)
+        :returns: view into frame
+        """
+
+        scale = 1. / resize if resize else 1.
+        x, y, width, height = (int(round(coord * scale)) for coord in face["box"])
+
+        return frame[max(y - margin, 0):y + height + margin, max(x - margin, 0):x + width + margin]
+
+
     # LOGGING
-    def log_activity(self, best_match, embedding, dynamic_log, data_mutable, pbar, dist, absent_frames):
+    def log_activity(self, best_match, embedding, dynamic_log, data_mutable, pbar, dist, absent_frames,
+                     aggregator=None, snapshot=None):
         """Logs facial recognition activity
         :param best_match: best match from database
         :param mode: logging type: "firebase" or "mysql"
@@ -485,59 +885,50 @@ class FaceNet:
         :param data_mutable: static data mutability or not
         :param pbar: use pbar or not
         :param dist: distance between best match and current frame
+        :param aggregator: RecognitionAggregator for this camera (default: None, log.AGGREGATOR)
+        :param snapshot: BGR face crop saved with unknown activity (default: None)
         """
 
+        aggregator = aggregator if aggregator else log.AGGREGATOR
+
+        if self.verifications:
+            self.apply_updates(self.verifications.drain())
+
         if best_match is None:
             absent_frames += 1
-            if absent_frames > log.THRESHOLDS["missed_frames"]:
+            if absent_frames > aggregator.thresholds["missed_frames"]:
                 absent_frames = 0
-                log.flush_current(mode="known+unknown", flush_times=False)
+                aggregator.flush(mode="known+unknown", flush_times=False)
             return absent_frames
 
         is_recognized = dist <= FaceNet.ALPHA
-        update_progress, update_recognized, update_unrecognized = log.update(is_recognized, best_match)
+        update_progress, update_recognized, update_unrecognized = aggregator.update(
+            is_recognized, best_match, dist, snapshot=snapshot
+        )
 
         if pbar and update_progress:
             lcd.update_progress(update_recognized)
 
         if update_recognized and connection.SOCKET:
-            connection.send(best_match=best_match)
-            connection.receive()
+            if not data_mutable:
+                connection.send(best_match=best_match)
 
         elif update_unrecognized:
             if pbar:
                 lcd.PROGRESS_BAR.reset(message="Recognizing...")
 
             if dynamic_log:
-                visitor_num = len([person for person in self._db if "visitor" in person]) + 1
-                self.update_data("visitor_{}".format(visitor_num), [embedding])
+                visitor, created = self.visitors.add(embedding)
+                visitor = visitor.replace("_", " ").title()
 
-                lcd.PROGRESS_BAR.update(amt=np.inf, message="Visitor {} created".format(visitor_num))
-                cprint("Visitor {} activity logged".format(visitor_num), color="magenta", attrs=["bold"])
+                if pbar:
+                    message = "{} {}".format(visitor, "created" if created else "seen")
+                    lcd.PROGRESS_BAR.update(amt=np.inf, message=message)
+                cprint("{} activity logged".format(visitor), color="magenta", attrs=["bold"])
 
         if data_mutable and (update_recognized or update_unrecognized):
-            if connection.SOCKET:
-                is_correct = not bool(connection.RECV)
-            else:
-                user_input = input("Are you {}? ".format(best_match.replace("_", " ").title())).lower()
-                is_correct = bool(len(user_input) == 0 or user_input[0] == "y")
-
-            if is_correct:
-                self.update_data(best_match, [embedding])
-            else:
-                if connection.SOCKET:
-                    name, connection.RECV = connection.RECV, None
-                else:
-                    name = input("Who are you? ").lower().replace(" ", "_")
-
-                if name in self.data:
-                    self.update_data(name, [embedding])
-                    cprint("Static entry for '{}' updated".format(name), color="blue", attrs=["bold"])
-                else:
-                    cprint("'{}' is not in database".format(name), attrs=["bold"])
-
-        if pbar:
-            lcd.check_clear()
+            # with a websocket, the verification request for a recognized face doubles as the recognition message--
+            # unknown faces are sent as {"unknown": True, "nearest": best_match}
+            self.verifications.submit(best_match, embedding, recognized=update_recognized)
 
-        log.DISTS.append(dist)
         return absent_frames
@@ -0,0 +1,169 @@
+"""
+
+"aisecurity.optim.scheduler"
+
+Latency-budget scheduler for real-time recognition.
+
+"""
+
+import contextlib
+from timeit import default_timer as timer
+
+
+################################ Latency Scheduler ################################
+class LatencyScheduler:
+    """Picks resize scale, detector, and rotations per frame to hold a frame deadline"""
+
+    # CONSTANTS
+    STAGE_KNOBS = {
+        # which knobs to turn first when a given stage dominates frame latency
+        "detection": ("detector", "resize", "rotations"),
+        "embedding": ("rotations", "resize", "detector"),
+    }
+
+
+    # INITS
+    def __init__(self, target_fps=None, deadline=None, resize_scales=(1., 0.75, 0.5),
+                 detectors=("both", "mtcnn", "haarcascade"), rotations=None, smoothing=0.3, headroom=0.7,
+                 cooldown=10, clock=timer, on_decision=None):
+        """Initializes LatencyScheduler
+        :param target_fps: target frames per second (either this or deadline must be provided)
+        :param deadline: per-frame deadline in seconds
+        :param resize_scales: resize scales, from most to least expensive (default: (1., 0.75, 0.5))
+        :param detectors: detectors, from most to least expensive (default: ("both", "mtcnn", "haarcascade"))
+        :param rotations: rotations used at full quality (default: None)
+        :param smoothing: exponential moving average factor for latencies (default: 0.3)
+        :param headroom: upgrade only if smoothed latency < headroom * deadline (default: 0.7)
+        :param cooldown: minimum frames between decisions (default: 10)
+        :param clock: callable returning seconds-- pass a simulated clock for testing (default: timeit.default_timer)
+        :param on_decision: callback called with each decision dict (default: None)
+        """
+
+        assert target_fps or deadline, "target_fps or deadline must be provided"
+
+        self.deadline = deadline if deadline else 1. / target_fps
+        self.smoothing = smoothing
+        self.headroom = headroom
+        self.cooldown = cooldown
+        self.clock = clock
+        self.on_decision = on_decision
+
+        self.options = {
+            "resize": list(resize_scales),
+            "detector": list(detectors),
+            "rotations": [rotations, None] if rotations else [None]
+        }
+        self.levels = {knob: 0 for knob in self.options}
+
+        self.latencies = {}
+        self.frame_latency = None
+        self.frames = 0
+        self.decisions = []
+
+        self._downgrades = []
+        self._last_decision = -cooldown
+        self._frame_start = None
+        self._stage_totals = {}
+
+
+    # RETRIEVERS
+    @property
+    def settings(self):
+        """Property for current settings
+        :returns: dict with "resize", "detector", and "rotations" to use for the next frame
+        """
+
+        return {knob: self.options[knob][level] for knob, level in self.levels.items()}
+
+
+    # LATENCY TRACKING
+    def start_frame(self):
+        """Marks the start of a frame"""
+        self._frame_start = self.clock()
+        self._stage_totals = {}
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """Context manager that records the latency of a stage
+        :param name: stage name (ex: "capture", "detection", "embedding")
+        """
+
+        start = self.clock()
+        try:
+            yield
+        finally:
+            self.record(name, self.clock() - start)
+
+    def record(self, name, elapsed):
+        """Records a stage latency for the current frame
+        :param name: stage name
+        :param elapsed: stage latency in seconds
+        """
+
+        self._stage_totals[name] = self._stage_totals.get(name, 0.) + elapsed
+
+    def _smooth(self, previous, current):
+        return current if previous is None else self.smoothing * current + (1. - self.smoothing) * previous
+
+    def end_frame(self):
+        """Marks the end of a frame and possibly changes settings
+        :returns: settings for the next frame
+        """
+
+        if self._frame_start is not None:
+            elapsed = self.clock() - self._frame_start
+        else:
+            elapsed = sum(self._stage_totals.values())
+
+        self.frame_latency = self._smooth(self.frame_latency, elapsed)
+        for name, stage_elapsed in self._stage_totals.items():
+            self.latencies[name] = self._smooth(self.latencies.get(name), stage_elapsed)
+
+        self.frames += 1
+        self._frame_start = None
+
+        if self.frames - self._last_decision >= self.cooldown:
+            if self.frame_latency > self.deadline:
+                self._downgrade()
+            elif self.frame_latency < self.headroom * self.deadline:
+                self._upgrade()
+
+        return self.settings
+
+
+    # DECISIONS
+    def _dominant_stage(self):
+        stages = {name: latency for name, latency in self.latencies.items() if name in self.STAGE_KNOBS}
+        return max(stages, key=stages.get) if stages else "detection"
+
+    def _downgrade(self):
+        for knob in self.STAGE_KNOBS[self._dominant_stage()]:
+            if self.levels[knob] < len(self.options[knob]) - 1:
+                self.levels[knob] += 1
+                self._downgrades.append(knob)
+                self._decide("downgrade", knob)
+                return
+
+    def _upgrade(self):
+        if self._downgrades:
+            knob = self._downgrades.pop()
+            self.levels[knob] -= 1
+            self._decide("upgrade", knob)
+
+    def _decide(self, action, knob):
+        decision = {
+            "frame": self.frames,
+            "time": self.clock(),
+            "action": action,
+            "knob": knob,
+            "value": self.options[knob][self.levels[knob]],
+            "frame_latency": self.frame_latency,
+            "stage_latencies": dict(self.latencies),
+            "settings": self.settings
+        }
+
+        self.decisions.append(decision)
+        self._last_decision = self.frames
+
+        if self.on_decision:
+            self.on_decision(decision)
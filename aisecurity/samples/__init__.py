@@ -1 +1,4 @@
+from . import align_benchmark
+from . import benchmark
 from . import demo
+from . import replay
@@ -0,0 +1,116 @@
+"""
+
+"aisecurity.samples.align_benchmark"
+
+Landmark alignment vs. rotation test-time augmentation benchmark.
+
+"""
+
+import os
+
+import cv2
+from termcolor import cprint
+
+from aisecurity.face.detection import detector_init
+
+
+# HELPERS
+def load_labeled_imgs(img_dir):
+    # expects img_dir/<person_name>/<image files>, where person_name matches the FaceNet database keys
+    for person in sorted(os.listdir(img_dir)):
+        person_dir = os.path.join(img_dir, person)
+        if not os.path.isdir(person_dir):
+            continue
+
+        for img_name in sorted(os.listdir(person_dir)):
+            img = cv2.imread(os.path.join(person_dir, img_name))
+            if img is not None:
+                yield person, img
+
+
+def tilt(img, angle):
+    center = (img.shape[1] / 2., img.shape[0] / 2.)
+    return cv2.warpAffine(img, cv2.getRotationMatrix2D(center, angle, 1.), img.shape[1::-1])
+
+
+# BENCHMARK
+def benchmark_alignment(facenet, img_dir, rotations=(-15, 15), tilts=(-20, 0, 20), detector="mtcnn"):
+    """Compares landmark alignment with rotation test-time augmentation
+    :param facenet: FaceNet object with a database that contains the people in img_dir
+    :param img_dir: directory of labeled images (img_dir/<person_name>/<image>)
+    :param rotations: rotations used for the rotation approach (default: (-15, 15))
+    :param tilts: synthetic head tilts applied to each test image (default: (-20, 0, 20))
+    :param detector: face detector (must provide keypoints for alignment) (default: "mtcnn")
+    :returns: dict of {approach: {"accuracy", "embeds_per_frame", "ms_per_frame", "frames"}}
+    """
+
+    detector_init()
+
+    approaches = {
+        "rotations": {"rotations": list(rotations), "align": False},
+        "aligned": {"rotations": None, "align": True}
+    }
+    num_embeds = {"rotations": len(set(rotations) | {0.}), "aligned": 1}
+    stats = {approach: {"correct": 0, "embeds": 0, "elapsed": 0., "frames": 0} for approach in approaches}
+
+    for person, img in load_labeled_imgs(img_dir):
+        for angle in tilts:
+            tilted = tilt(img, angle) if angle else img
+
+            for approach, kwargs in approaches.items():
+                result = facenet.recognize(tilted, detector=detector, **kwargs)
+                __, is_recognized, best_match, __, face, elapsed = result
+
+                stats[approach]["frames"] += 1
+                stats[approach]["elapsed"] += elapsed
+                if face is not None:
+                    stats[approach]["embeds"] += num_embeds[approach]
+                    stats[approach]["correct"] += int(bool(is_recognized) and best_match == person)
+
+    results = {}
+    for approach, approach_stats in stats.items():
+        frames = max(approach_stats["frames"], 1)
+        results[approach] = {
+            "accuracy": approach_stats["correct"] / frames,
+            "embeds_per_frame": approach_stats["embeds"] / frames,
+            "ms_per_frame": approach_stats["elapsed"] / frames,
+            "frames": approach_stats["frames"]
+        }
+
+        cprint("{}: {}% accuracy, {} embeddings/frame, {} ms/frame".format(
+            approach, round(100. * results[approach]["accuracy"], 2),
+            round(results[approach]["embeds_per_frame"], 2), round(results[approach]["ms_per_frame"], 2)
+        ), attrs=["bold"])
+
+    return results
+
+
+if __name__ == "__main__":
+    import argparse
+
+    from aisecurity.facenet import FaceNet
+    from aisecurity.utils.paths import DEFAULT_MODEL
+
+
+    # TYPE CASTING
+    def list_of_floats(string):
+        try:
+            return [float(val) for val in string.split(",")]
+        except ValueError:
+            raise argparse.ArgumentTypeError("float list expected")
+
+
+    # ARG PARSE
+    parser = argparse.ArgumentParser()
+    parser.add_argument("img_dir", help="directory of labeled images (img_dir/<person_name>/<image>)", type=str)
+    parser.add_argument("--path_to_model", help="path to facenet model (default: DEFAULT_MODEL)", type=str,
+                        default=DEFAULT_MODEL)
+    parser.add_argument("--rotations", help="rotations for the rotation approach (default: -15,15)",
+                        type=list_of_floats, default=[-15., 15.])
+    parser.add_argument("--tilts", help="synthetic tilts applied to test images (default: -20,0,20)",
+                        type=list_of_floats, default=[-20., 0., 20.])
+    args = parser.parse_args()
+
+
+    # BENCHMARK
+    benchmark_alignment(FaceNet(args.path_to_model), args.img_dir, rotations=args.rotations, tilts=args.tilts)
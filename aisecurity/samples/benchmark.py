@@ -0,0 +1,485 @@
+"""
+
+"aisecurity.samples.benchmark"
+
+Micro-benchmarks for every hot-path stage, with JSON output and regression comparison.
+
+"""
+
+import contextlib
+import gc
+import json
+import os
+import platform
+import shutil
+import sqlite3
+import tempfile
+import time
+from timeit import default_timer as timer
+
+import numpy as np
+
+from aisecurity.dataflow.synthetic import SyntheticIdentities
+
+
+################################ Setup and helpers ###############################
+
+# SCALES
+SCALES = {
+    "small": {"people": 100, "embeds_per_person": 5, "batch_size": 4, "frame_shape": (360, 640)},
+    "medium": {"people": 2000, "embeds_per_person": 5, "batch_size": 8, "frame_shape": (720, 1280)},
+    "large": {"people": 20000, "embeds_per_person": 5, "batch_size": 16, "frame_shape": (1080, 1920)},
+}
+
+EMBED_DIM = 128
+FACE_BOX = (200, 80, 180, 200)  # x, y, width, height in a 360x640 frame, scaled with the frame
+
+# REGISTRY
+BENCHMARKS = {}  # name: setup(config) -> zero-argument callable to time (cleanups go in config["cleanups"])
+
+
+class Skip(Exception):
+    """Raised by a benchmark setup if the stage can't run here (missing dependency, model, ...)"""
+
+
+def benchmark(name):
+    def _register(setup):
+        BENCHMARKS[name] = setup
+        return setup
+
+    return _register
+
+
+# SYNTHETIC INPUTS
+def random_frame(config, rng):
+    return rng.randint(0, 256, (*config["frame_shape"], 3), dtype=np.uint8)
+
+
+def face_box(config):
+    scale = config["frame_shape"][0] / 360.
+    return tuple(int(coord * scale) for coord in FACE_BOX)
+
+
+def _require(module_name):
+    try:
+        return __import__(module_name, fromlist=["_"])
+    except ImportError as error:
+        raise Skip("{} not available: {}".format(module_name, error))
+
+
+################################ Benchmarks ###############################
+
+# DETECTION
+def _detection_setup(mode):
+    def setup(config):
+        detection = _require("aisecurity.face.detection")
+        try:
+            detection.detector_init(min_face_size=40)
+        except Exception as error:
+            raise Skip("detector_init failed: {}".format(error))
+
+        frame = random_frame(config, config["rng"])
+        return lambda: detection.detect_faces(frame, alpha=0.9, mode=mode)
+
+    return setup
+
+
+for _mode in ("mtcnn", "haarcascade", "both"):
+    benchmark("detect_faces[{}]".format(_mode))(_detection_setup(_mode))
+
+
+# PREPROCESSING
+def _crop_setup(rotations):
+    def setup(config):
+        preprocessing = _require("aisecurity.face.preprocessing")
+
+        img = preprocessing.to_rgb(random_frame(config, config["rng"])).copy()
+        box = face_box(config)
+        out = preprocessing.get_batch_buffer(len(rotations))
+
+        return lambda: preprocessing.write_crops(img, box, 10, rotations, out)
+
+    return setup
+
+
+benchmark("crop_face[upright]")(_crop_setup([0.]))
+benchmark("crop_face[rotations]")(_crop_setup([0., -1, -15., 15.]))
+
+
+def _normalize_setup(mode):
+    def setup(config):
+        preprocessing = _require("aisecurity.face.preprocessing")
+
+        shape = (config["batch_size"], *preprocessing.IMG_SHAPE, 3)
+        imgs = config["rng"].randint(0, 256, shape).astype(np.float32)
+        out = np.empty_like(imgs)
+
+        return lambda: preprocessing.normalize(imgs, mode=mode, out=out)
+
+    return setup
+
+
+benchmark("normalize[per_image]")(_normalize_setup("per_image"))
+benchmark("normalize[fixed]")(_normalize_setup("fixed"))
+
+
+# EMBEDDING
+def _embed_setup(backend):
+    def setup(config):
+        model_path = config["models"].get(backend)
+        if not model_path:
+            raise Skip("no {} model given (--{}_model)".format(backend, backend))
+
+        facenet_module = _require("aisecurity.facenet")
+        preprocessing = _require("aisecurity.face.preprocessing")
+
+        facenet = facenet_module.FaceNet(model_path)
+        shape = (config["batch_size"], *preprocessing.IMG_SHAPE, 3)
+        imgs = preprocessing.normalize(config["rng"].randint(0, 256, shape).astype(np.float32), mode=facenet.img_norm)
+
+        return lambda: facenet.embed(imgs)
+
+    return setup
+
+
+for _backend in ("keras", "tf", "trt"):
+    benchmark("embed[{}]".format(_backend))(_embed_setup(_backend))
+
+
+# GALLERY SEARCH
+@benchmark("search[sklearn]")
+def search_sklearn(config):
+    neighbors = _require("sklearn.neighbors")
+
+    names = [name for name, embeds in config["gallery"].items() for __ in embeds]
+    embeds = [embed for values in config["gallery"].values() for embed in values]
+    knn = neighbors.KNeighborsClassifier(n_neighbors=config["embeds_per_person"]).fit(embeds, names)
+    query = config["queries"][:1]
+
+    return lambda: knn.predict(query)
+
+
+@benchmark("search[shared]")
+def search_shared(config):
+    shared = _require("aisecurity.dataflow.shared")
+
+    directory = os.path.join(config["tmp_dir"], "gallery")
+    shared.publish(config["gallery"], directory)
+    knn = shared.GalleryKNN(shared.SharedGallery(directory).attach())
+    query = config["queries"][:1]
+
+    return lambda: knn.predict(query)
+
+
+# DISTANCE METRICS
+def _dist_metric_setup(constructor, stage):
+    def setup(config):
+        distance = _require("aisecurity.utils.distance")
+
+        data = [embed for embeds in config["gallery"].values() for embed in embeds]
+        dist_metric = distance.DistMetric(constructor, data=data, axis=0)
+        first, second = config["queries"][:1], config["queries"][1:2]  # (1, embed_dim), like FaceNet embeddings
+
+        if stage == "apply_norms":
+            return lambda: dist_metric.apply_norms(first)
+        return lambda: dist_metric.distance(first, second)
+
+    return setup
+
+
+for _constructor in ("euclidean", "cosine", "euclidean+l2_normalize+subtract_mean"):
+    for _stage in ("apply_norms", "distance"):
+        benchmark("{}[{}]".format(_stage, _constructor))(_dist_metric_setup(_constructor, _stage))
+
+
+# DATABASE IO
+@benchmark("dump_and_encrypt")
+def dump_setup(config):
+    loader = _require("aisecurity.dataflow.loader")
+
+    path = os.path.join(config["tmp_dir"], "dump.json")
+    gallery = config["gallery"]
+
+    # dump_and_encrypt converts values in place, so every call gets a fresh dict
+    return lambda: loader.dump_and_encrypt(dict(gallery), path, encrypt=config["encrypt"])
+
+
+@benchmark("retrieve_embeds")
+def retrieve_setup(config):
+    loader = _require("aisecurity.dataflow.loader")
+
+    path = os.path.join(config["tmp_dir"], "retrieve.json")
+    loader.dump_and_encrypt(dict(config["gallery"]), path, encrypt=config["encrypt"])
+
+    return lambda: loader.retrieve_embeds(path, encrypted=config["encrypt"])
+
+
+# LOGGING
+def _ticking_clock(step=0.05):
+    clock = {"now": 0.}
+
+    def tick():
+        clock["now"] += step
+        return clock["now"]
+
+    return tick
+
+
+@benchmark("aggregator.update")
+def aggregator_update_setup(config):
+    log = _require("aisecurity.db.log")
+
+    # no sink: only the voting and cooldown logic that runs on every recognized frame
+    aggregator = log.RecognitionAggregator(clock=_ticking_clock(), on_log=lambda *args: None)
+    names = ["person_{}".format(idx % 3) for idx in range(64)]
+    state = {"idx": 0}
+
+    def update():
+        state["idx"] = (state["idx"] + 1) % len(names)
+        aggregator.update(True, names[state["idx"]], dist=0.5)
+
+    return update
+
+
+@benchmark("log.update")
+def log_update_setup(config):
+    log = _require("aisecurity.db.log")
+    db_pool = _require("aisecurity.db.pool")
+    db_writer = _require("aisecurity.db.writer")
+
+    pool = db_pool.ConnectionPool(
+        lambda: sqlite3.connect(os.path.join(config["tmp_dir"], "log.db"), check_same_thread=False),
+        size=1, placeholder="?"
+    )
+    writer = db_writer.AsyncWriter(db_writer.SQLiteSink(pool))
+
+    # log.update() as the cam loop calls it: votes, and whenever someone is logged a row queued on an AsyncWriter
+    # that writes to SQLite
+    previous = log.BUFFER, log.WRITER, log.AGGREGATOR
+    log.BUFFER, log.WRITER, log.AGGREGATOR = None, writer, log.RecognitionAggregator(clock=_ticking_clock())
+    devnull = open(os.devnull, "w")
+
+    def cleanup():
+        log.BUFFER, log.WRITER, log.AGGREGATOR = previous
+        writer.close(timeout=5.)
+        devnull.close()
+
+    config["cleanups"].append(cleanup)
+
+    # people walk up for 8 frames each, so roughly every 8th update logs someone
+    names = ["person_{}".format(idx // 8 % 4) for idx in range(64)]
+    state = {"idx": 0}
+
+    def update():
+        state["idx"] = (state["idx"] + 1) % len(names)
+        with contextlib.redirect_stdout(devnull):  # log_person prints every logged event
+            log.update(True, names[state["idx"]], dist=0.5)
+
+    return update
+
+
+################################ Runner ###############################
+def time_callable(func, warmup, iterations):
+    """Times func with a fixed number of warm-up and timed calls (garbage collection paused while timing)
+    :param func: zero-argument callable
+    :param warmup: number of untimed calls
+    :param iterations: number of timed calls
+    :returns: array of per-call times in ms
+    """
+
+    for __ in range(warmup):
+        func()
+
+    gc.collect()
+    gc_was_enabled = gc.isenabled()
+    gc.disable()
+
+    try:
+        times = np.empty(iterations)
+        for idx in range(iterations):
+            start = timer()
+            func()
+            times[idx] = timer() - start
+    finally:
+        if gc_was_enabled:
+            gc.enable()
+
+    return 1000. * times
+
+
+def run(names=None, scale="small", warmup=10, iterations=100, seed=0, models=None, encrypt=(), overrides=None,
+        verbose=True):
+    """Runs benchmarks on synthetic inputs
+    :param names: benchmark names or prefixes, ex: ["search", "normalize[fixed]"] (default: None, all)
+    :param scale: key of SCALES (default: "small")
+    :param warmup: untimed calls per benchmark (default: 10)
+    :param iterations: timed calls per benchmark (default: 100)
+    :param seed: random seed for synthetic inputs (default: 0)
+    :param models: {"keras"/"tf"/"trt": model path} for the embedding benchmarks (default: None, skipped)
+    :param encrypt: database fields to encrypt, like DATABASE_INFO["encrypted"] (default: (), plain)
+    :param overrides: overrides for the SCALES config, ex: {"people": 50000} (default: None)
+    :param verbose: print results as they finish (default: True)
+    :returns: JSON-serializable dict with "meta" and "results"
+    """
+
+    config = {**SCALES[scale], **(overrides or {})}
+    meta = {"scale": scale, "config": dict(config), "warmup": warmup, "iterations": iterations, "seed": seed,
+            "time": time.strftime("%Y-%m-%d %H:%M:%S"), "python": platform.python_version(),
+            "numpy": np.__version__, "machine": platform.machine(), "node": platform.node()}
+    meta["config"]["frame_shape"] = list(config["frame_shape"])
+
+    rng = np.random.RandomState(seed)
+    encrypt = encrypt if isinstance(encrypt, str) else list(encrypt)  # DATABASE_INFO may say "all"
+    config.update(rng=rng, models=models or {}, encrypt=encrypt, tmp_dir=tempfile.mkdtemp(), cleanups=[])
+    # clustered identities, so that searches and distances see realistic neighborhoods
+    identities = SyntheticIdentities(config["people"], embed_dim=EMBED_DIM, seed=seed)
+    config["gallery"] = identities.gallery(config["embeds_per_person"])
+    config["queries"] = identities.queries(8)[0]
+
+    selected = [name for name in BENCHMARKS if not names or any(name.startswith(prefix) for prefix in names)]
+    results = {}
+
+    try:
+        for name in selected:
+            try:
+                func = BENCHMARKS[name](config)
+                times = time_callable(func, warmup, iterations)
+            except Skip as reason:
+                results[name] = {"skipped": str(reason)}
+                if verbose:
+                    print("{}: skipped ({})".format(name, reason))
+                continue
+            except Exception as error:
+                # one broken stage shouldn't throw away the rest of the run
+                results[name] = {"error": "{}: {}".format(type(error).__name__, error)}
+                if verbose:
+                    print("{}: failed ({})".format(name, results[name]["error"]))
+                continue
+            finally:
+                while config["cleanups"]:
+                    config["cleanups"].pop()()
+
+            results[name] = {
+                "median_ms": float(np.median(times)),
+                "mean_ms": float(np.mean(times)),
+                "p90_ms": float(np.percentile(times, 90)),
+                "min_ms": float(np.min(times)),
+                "std_ms": float(np.std(times)),
+                "iterations": iterations
+            }
+
+            if verbose:
+                print("{}: {} ms median, {} ms p90".format(
+                    name, round(results[name]["median_ms"], 4), round(results[name]["p90_ms"], 4)))
+    finally:
+        shutil.rmtree(config["tmp_dir"], ignore_errors=True)
+
+    return {"meta": meta, "results": results}
+
+
+def compare(baseline, current, threshold=0.1, min_ms=0.005):
+    """Compares two run() results by median time
+    :param baseline: run() result (or path to its JSON)
+    :param current: run() result (or path to its JSON)
+    :param threshold: relative slowdown flagged as a regression, ex: 0.1 = 10% (default: 0.1)
+    :param min_ms: absolute slowdown below which differences are treated as noise (default: 0.005)
+    :returns: {name: {"baseline_ms", "current_ms", "change", "status"}} where status is "regression", "improvement",
+              or "unchanged"
+    """
+
+    runs = []
+    for result in (baseline, current):
+        if isinstance(result, str):
+            with open(result, encoding="utf-8") as file:
+                result = json.load(file)
+        runs.append(result["results"])
+
+    comparison = {}
+    for name in runs[0]:
+        before, after = runs[0][name], runs[1].get(name, {})
+        if "median_ms" not in before or "median_ms" not in after:
+            continue
+
+        change = after["median_ms"] / before["median_ms"] - 1. if before["median_ms"] else 0.
+        diff = after["median_ms"] - before["median_ms"]
+
+        if change > threshold and diff > min_ms:
+            status = "regression"
+        elif change < -threshold and -diff > min_ms:
+            status = "improvement"
+        else:
+            status = "unchanged"
+
+        comparison[name] = {"baseline_ms": before["median_ms"], "current_ms": after["median_ms"], "change": change,
+                            "status": status}
+
+    return comparison
+
+
+################################ Benchmark suite ###############################
+if __name__ == "__main__":
+    import argparse
+    import sys
+
+
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="command")
+
+    run_parser = subparsers.add_parser("run", help="run benchmarks")
+    run_parser.add_argument("names", help="benchmark names or prefixes (default: all)", type=str, nargs="*")
+    run_parser.add_argument("--scale", help="small, medium, or large (default: small)", type=str, default="small")
+    run_parser.add_argument("--people", help="override gallery size (people)", type=int, default=None)
+    run_parser.add_argument("--warmup", help="untimed calls per benchmark (default: 10)", type=int, default=10)
+    run_parser.add_argument("--iterations", help="timed calls per benchmark (default: 100)", type=int, default=100)
+    run_parser.add_argument("--seed", help="random seed (default: 0)", type=int, default=0)
+    run_parser.add_argument("--keras_model", help="path to .h5 model for embed[keras]", type=str, default=None)
+    run_parser.add_argument("--tf_model", help="path to .pb model for embed[tf]", type=str, default=None)
+    run_parser.add_argument("--trt_model", help="path to .engine model for embed[trt]", type=str, default=None)
+    run_parser.add_argument("--encrypt", help="encrypt database fields like DATABASE_INFO", action="store_true")
+    run_parser.add_argument("--output", help="path to write JSON results", type=str, default=None)
+    run_parser.add_argument("--list", help="list benchmarks and exit", action="store_true")
+
+    compare_parser = subparsers.add_parser("compare", help="compare two JSON results")
+    compare_parser.add_argument("baseline", help="baseline JSON", type=str)
+    compare_parser.add_argument("current", help="current JSON", type=str)
+    compare_parser.add_argument("--threshold", help="relative slowdown flagged (default: 0.1)", type=float,
+                                default=0.1)
+
+    args = parser.parse_args()
+
+    if args.command == "run":
+        if args.list:
+            print("\n".join(BENCHMARKS))
+            sys.exit(0)
+
+        encrypt_fields = ()
+        if args.encrypt:
+            from aisecurity.utils.paths import DATABASE_INFO
+            encrypt_fields = DATABASE_INFO["encrypted"]
+
+        output = run(
+            args.names, scale=args.scale, warmup=args.warmup, iterations=args.iterations, seed=args.seed,
+            models={"keras": args.keras_model, "tf": args.tf_model, "trt": args.trt_model}, encrypt=encrypt_fields,
+            overrides={"people": args.people} if args.people else None
+        )
+
+        if args.output:
+            with open(args.output, "w", encoding="utf-8") as output_file:
+                json.dump(output, output_file, indent=4)
+        else:
+            print(json.dumps(output, indent=4))
+
+    elif args.command == "compare":
+        changes = compare(args.baseline, args.current, threshold=args.threshold)
+
+        for bench_name, change_info in changes.items():
+            print("{:<50} {:>10} -> {:>10} ms ({:+.1f}%) {}".format(
+                bench_name, round(change_info["baseline_ms"], 4), round(change_info["current_ms"], 4),
+                100. * change_info["change"], change_info["status"].upper() if change_info["status"] != "unchanged"
+                else ""
+            ))
+
+        sys.exit(1 if any(info["status"] == "regression" for info in changes.values()) else 0)
+
+    else:
+        parser.print_help()
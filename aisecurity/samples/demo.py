@@ -10,12 +10,15 @@ import tensorflow as tf
 from termcolor import cprint
 
 from aisecurity.facenet import FaceNet
+from aisecurity.utils import metrics
 from aisecurity.utils.paths import DEFAULT_MODEL
 
 
 def demo(path=DEFAULT_MODEL, dist_metric="zero", logging=None, dynamic_log=True,  pbar=False, resize=None, flip=0,
          detector="both", data_mutable=True, socket="ws://67.205.155.37:8000/v1/nano", rotations=None, device=0,
-         allow_gpu_growth=False):
+         allow_gpu_growth=False, align=False, tta_band=None, quality_gate=None,
+         snapshots=False, verify_port=None, render="window", watch_data=False, quiet=False, metrics_port=None,
+         metrics_file=None, summary_interval=None):
 
     if allow_gpu_growth:
         tf.Session(config=tf.ConfigProto(gpu_options=tf.GPUOptions(allow_growth=True))).__enter__()
@@ -28,10 +31,16 @@ def demo(path=DEFAULT_MODEL, dist_metric="zero", logging=None, dynamic_log=True,
 
     input("\nPress ENTER to continue:")
 
-    facenet.real_time_recognize(
-        dist_metric=dist_metric, logging=logging, dynamic_log=dynamic_log, resize=resize, pbar=pbar, flip=flip,
-        detector=detector, data_mutable=data_mutable, socket=socket, rotations=rotations, device=device
-    )
+    metrics.init(quiet=quiet, summary_interval=summary_interval, http_port=metrics_port, path=metrics_file)
+    try:
+        facenet.real_time_recognize(
+            dist_metric=dist_metric, logging=logging, dynamic_log=dynamic_log, resize=resize, pbar=pbar, flip=flip,
+            detector=detector, data_mutable=data_mutable, socket=socket, rotations=rotations, device=device,
+            align=align, tta_band=tta_band, quality_gate=quality_gate, snapshots=snapshots,
+            verify_port=verify_port, render=render, watch_data=watch_data
+        )
+    finally:
+        metrics.close()
 
 
 if __name__ == "__main__":
@@ -74,6 +83,26 @@ if __name__ == "__main__":
     parser.add_argument("--rotations", help="rotations to be applied to face (-1 is horizontal flip) (default: None)",
                         type=list_of_ints, default=None)
     parser.add_argument("--device", help="video file to read from (default: 0)", type=str_or_int, default=0)
+    parser.add_argument("--align", help="use this flag to align faces with MTCNN keypoints", action="store_true")
+    parser.add_argument("--tta_band", help="only embed rotations for ambiguous matches within this band of the "
+                                           "threshold (default: None)", type=float, default=None)
+    parser.add_argument("--quality_gate", help="low-quality face policy, skip or defer (default: None)", type=str,
+                        default=None)
+    parser.add_argument("--snapshots", help="use this flag to save face snapshots with unknown activity",
+                        action="store_true")
+    parser.add_argument("--verify_port", help="port for answering verification requests over HTTP (default: None)",
+                        type=int, default=None)
+    parser.add_argument("--render", help="window, thread, or none for headless (default: window)", type=str,
+                        default="window")
+    parser.add_argument("--watch_data", help="use this flag to reload the database when it changes",
+                        action="store_true")
+    parser.add_argument("--quiet", help="use this flag to disable per-frame printing", action="store_true")
+    parser.add_argument("--metrics_port", help="port for Prometheus metrics at /metrics (default: None)", type=int,
+                        default=None)
+    parser.add_argument("--metrics_file", help="file to write Prometheus metrics to (default: None)", type=str,
+                        default=None)
+    parser.add_argument("--summary_interval", help="seconds between metrics summaries (default: None)", type=float,
+                        default=None)
     parser.add_argument("--allow_gpu_growth", help="use this flag to use GPU growth", action="store_true", default=0)
     args = parser.parse_args()
 
@@ -82,5 +111,9 @@ if __name__ == "__main__":
     demo(
         path=args.path_to_model, dist_metric=args.dist_metric, logging=args.logging, dynamic_log=args.dynamic_log,
         pbar=args.pbar,  flip=args.flip, resize=args.resize, detector=args.detector, data_mutable=args.data_mutable,
-        socket=args.socket, rotations=args.rotations, device=args.device, allow_gpu_growth=args.allow_gpu_growth
+        socket=args.socket, rotations=args.rotations, device=args.device, allow_gpu_growth=args.allow_gpu_growth,
+        align=args.align, tta_band=args.tta_band, quality_gate=args.quality_gate, snapshots=args.snapshots,
+        verify_port=args.verify_port, render=None if args.render == "none" else args.render,
+        watch_data=args.watch_data, quiet=args.quiet, metrics_port=args.metrics_port, metrics_file=args.metrics_file,
+        summary_interval=args.summary_interval
     )
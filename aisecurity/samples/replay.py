@@ -0,0 +1,303 @@
+"""
+
+"aisecurity.samples.replay"
+
+Deterministic, headless replay of recorded clips through the real-time recognition pipeline.
+
+"""
+
+import contextlib
+import glob
+import hashlib
+import json
+import os
+from timeit import default_timer as timer
+
+import cv2
+import numpy as np
+
+from aisecurity.db.log import RecognitionAggregator
+from aisecurity.face import quality
+from aisecurity.face.detection import detector_init
+from aisecurity.utils import metrics
+from aisecurity.utils.capture import ThreadedCapture
+
+
+################################ Setup and helpers ###############################
+
+# GLOBALS
+STAGES = ("capture", "resize", "detection", "embedding", "search", "log", "total")
+
+IMG_EXTENSIONS = (".jpg", ".jpeg", ".png", ".bmp")
+
+
+# CLOCK
+class VirtualClock:
+    """Clock that only moves when the replay advances a frame, so that vote timing doesn't depend on machine speed"""
+
+    def __init__(self, fps):
+        """Initializes VirtualClock at 0 seconds
+        :param fps: frames per second of the recorded clip
+        """
+
+        self.fps = fps
+        self.frame_num = 0
+
+    def __call__(self):
+        return self.frame_num / self.fps
+
+    def advance(self):
+        self.frame_num += 1
+
+
+# SOURCES
+class ReplaySource:
+    """cv2.VideoCapture stand-in for a video file, a directory or glob of images, or a list of frames"""
+
+    def __init__(self, source, fps=None, max_frames=None):
+        """Initializes ReplaySource
+        :param source: path to a video file, directory of images, glob pattern, or list of BGR frames
+        :param fps: frames per second (default: None, from the video file or 30. for images)
+        :param max_frames: stop after this many frames (default: None, whole source)
+        """
+
+        self.max_frames = max_frames
+        self.frames_read = 0
+        self._cap = None
+
+        if isinstance(source, (list, tuple)):
+            self._frames = iter(source)
+        elif os.path.isfile(source) and not source.lower().endswith(IMG_EXTENSIONS):
+            self._cap = cv2.VideoCapture(source)
+            assert self._cap.isOpened(), "{} could not be opened".format(source)
+            fps = fps if fps else self._cap.get(cv2.CAP_PROP_FPS)
+            self._frames = None
+        else:
+            pattern = os.path.join(source, "*") if os.path.isdir(source) else source
+            paths = sorted(path for path in glob.glob(pattern) if path.lower().endswith(IMG_EXTENSIONS))
+            assert paths, "no images found at {}".format(source)
+            self._frames = (cv2.imread(path) for path in paths)
+
+        self.fps = fps if fps else 30.
+
+        # the first frame is read eagerly so that the frame shape is known before the pipeline starts
+        self._first = self._next()
+        assert self._first is not None, "{} has no frames".format(source)
+        self.shape = self._first.shape
+
+    def _next(self):
+        if self._cap is not None:
+            ret, frame = self._cap.read()
+            return frame if ret else None
+        return next(self._frames, None)
+
+    def read(self):
+        if self.max_frames is not None and self.frames_read >= self.max_frames:
+            return False, None
+
+        if self._first is not None:
+            frame, self._first = self._first, None
+        else:
+            frame = self._next()
+
+        if frame is None:
+            return False, None
+
+        self.frames_read += 1
+        return True, frame
+
+    def release(self):
+        if self._cap is not None:
+            self._cap.release()
+
+
+# STATS
+def summarize(times):
+    """Latency percentiles of one stage
+    :param times: per-frame times in seconds
+    :returns: dict with "p50_ms", "p95_ms", "p99_ms", "mean_ms", and "max_ms"
+    """
+
+    times_ms = 1000. * np.array(times or [0.])
+    return {
+        "p50_ms": float(np.percentile(times_ms, 50)),
+        "p95_ms": float(np.percentile(times_ms, 95)),
+        "p99_ms": float(np.percentile(times_ms, 99)),
+        "mean_ms": float(np.mean(times_ms)),
+        "max_ms": float(np.max(times_ms))
+    }
+
+
+def digest(events):
+    """Fingerprint of a list of recognition events
+    :param events: "events" list from replay()
+    :returns: hex digest-- equal for runs that logged the same people on the same frames
+    """
+
+    return hashlib.sha1(json.dumps(events, sort_keys=True).encode()).hexdigest()
+
+
+################################ Replay ###############################
+def replay(facenet, source, fps=None, resize=None, detector="both", rotations=None, align=False, tta_band=None,
+           quality_gate=None, thresholds=None, max_frames=None, quiet=True):
+    """Runs a recorded clip through capture, detection, recognition, and logging like FaceNet.real_time_recognize,
+    but headless and with a virtual clock, so that the same clip always produces the same recognition events
+    :param facenet: FaceNet object with data
+    :param source: video file, directory or glob of images, or list of BGR frames (see ReplaySource)
+    :param fps: frames per second of the virtual clock (default: None, from the source)
+    :param resize: resize scale (float between 0. and 1.) (default: None)
+    :param detector: face detector type ("mtcnn", "haarcascade", "both") (default: "both")
+    :param rotations: rotations to be applied to face (-1 is horizontal flip) (default: None)
+    :param align: align faces using MTCNN keypoints (default: False)
+    :param tta_band: embed rotations only if upright distance is within tta_band of FaceNet.ALPHA (default: None)
+    :param quality_gate: skip or defer low-quality faces-- None, "skip", or "defer" (default: None)
+    :param thresholds: overrides for log.THRESHOLDS (default: None)
+    :param max_frames: stop after this many frames (default: None, whole source)
+    :param quiet: silence per-frame printing, which would otherwise be part of the measured time (default: True)
+    :returns: dict with "frames", "faces", "wall_time", "throughput" (frames per second), "stages" ({stage:
+              summarize()}), "events" (logged activity), and "digest"
+    """
+
+    assert facenet.data, "data must be provided"
+    if resize:
+        assert 0. <= resize <= 1., "resize must be in [0., 1.]"
+
+    src = ReplaySource(source, fps=fps, max_frames=max_frames)
+    clock = VirtualClock(src.fps)
+
+    events = []
+
+    def on_log(name, seconds, snapshot):
+        # nothing is written anywhere-- the events themselves are the result
+        events.append({"frame": clock.frame_num, "name": str(name) if name else None, "time": round(seconds, 6)})
+
+    aggregator = RecognitionAggregator(thresholds=thresholds, clock=clock, on_log=on_log)
+    gate = quality.QualityGate(mode=quality_gate)  # private, so that no deferred face leaks in from another session
+
+    height, width = src.shape[:2]
+    if resize:
+        width, height = width * resize, height * resize
+    detector_init(min_face_size=0.5 * (width + height) / 2)  # same minimum face size as real_time_recognize
+
+    # "ordered" so that no frame is ever dropped, whatever the speed of this machine
+    cap = ThreadedCapture(src, mode="ordered")
+
+    times = {stage: [] for stage in STAGES}
+    frames, faces, absent_frames = 0, 0, 0
+
+    start = timer()
+    with contextlib.ExitStack() as stack:
+        if quiet:
+            stack.enter_context(metrics.quiet())
+
+        try:
+            while True:
+                frame_start = timer()
+                ret, frame = cap.read()
+                if not ret:
+                    break
+                captured = timer()
+
+                if resize:
+                    frame = cv2.resize(frame, (0, 0), fx=resize, fy=resize)
+                resized = timer()
+
+                embed, is_recognized, best_match, dist, face, elapsed = facenet.recognize(
+                    frame, detector=detector, rotations=rotations, align=align, tta_band=tta_band, frame_num=frames,
+                    gate=gate
+                )
+                recognized = timer()
+
+                absent_frames = facenet.log_activity(best_match, embed, False, False, False, dist, absent_frames,
+                                                     aggregator=aggregator)
+                logged = timer()
+
+                timings = facenet.timings
+                times["capture"].append(captured - frame_start)
+                times["resize"].append(resized - captured)
+                times["detection"].append(timings["detection"])
+                times["embedding"].append(timings["embedding"])
+                times["search"].append(max(recognized - resized - timings["detection"] - timings["embedding"], 0.))
+                times["log"].append(logged - recognized)
+                times["total"].append(logged - frame_start)
+
+                frames += 1
+                faces += face is not None
+                clock.advance()
+        finally:
+            cap.release()
+
+    wall_time = timer() - start
+
+    return {
+        "frames": frames,
+        "faces": faces,
+        "fps": src.fps,
+        "wall_time": wall_time,
+        "throughput": frames / wall_time if wall_time else None,
+        "stages": {stage: summarize(stage_times) for stage, stage_times in times.items()},
+        "events": events,
+        "digest": digest(events)
+    }
+
+
+def print_report(result):
+    print("{} frames ({} with faces) in {}s: \033[1m{} fps\033[0m".format(
+        result["frames"], result["faces"], round(result["wall_time"], 2), round(result["throughput"] or 0., 2)))
+
+    print("{:<12}{:>10}{:>10}{:>10}{:>10}".format("stage", "p50 ms", "p95 ms", "p99 ms", "mean ms"))
+    for stage, stats in result["stages"].items():
+        print("{:<12}{:>10}{:>10}{:>10}{:>10}".format(
+            stage, *(round(stats[key], 3) for key in ("p50_ms", "p95_ms", "p99_ms", "mean_ms"))))
+
+    print("{} events, digest {}".format(len(result["events"]), result["digest"]))
+
+
+################################ Replay harness ###############################
+if __name__ == "__main__":
+    import argparse
+    import sys
+
+    from aisecurity.facenet import FaceNet
+    from aisecurity.utils.paths import DEFAULT_MODEL
+
+
+    def list_of_floats(string):
+        return [float(value) for value in string.split(",")]
+
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("source", help="video file, directory of images, or glob pattern", type=str)
+    parser.add_argument("--path_to_model", help="path to model", type=str, default=DEFAULT_MODEL)
+    parser.add_argument("--fps", help="frames per second of the clip (default: from the source)", type=float,
+                        default=None)
+    parser.add_argument("--resize", help="resize scale for detection (default: None)", type=float, default=None)
+    parser.add_argument("--detector", help="mtcnn, haarcascade, or both (default: both)", type=str, default="both")
+    parser.add_argument("--rotations", help="comma-separated rotations (default: None)", type=list_of_floats,
+                        default=None)
+    parser.add_argument("--align", help="align faces using MTCNN keypoints", action="store_true")
+    parser.add_argument("--quality_gate", help="low-quality face policy, skip or defer (default: None)", type=str,
+                        default=None)
+    parser.add_argument("--max_frames", help="stop after this many frames", type=int, default=None)
+    parser.add_argument("--runs", help="number of replays-- events must match across runs", type=int, default=2)
+    parser.add_argument("--output", help="write the last run as JSON to this path", type=str, default=None)
+    args = parser.parse_args()
+
+    facenet = FaceNet(args.path_to_model)
+
+    results = []
+    for run in range(args.runs):
+        print("Run {}/{}".format(run + 1, args.runs))
+        results.append(replay(facenet, args.source, fps=args.fps, resize=args.resize, detector=args.detector,
+                              rotations=args.rotations, align=args.align, quality_gate=args.quality_gate,
+                              max_frames=args.max_frames))
+        print_report(results[-1])
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as file:
+            json.dump(results[-1], file, indent=4)
+
+    digests = {result["digest"] for result in results}
+    if len(digests) > 1:
+        print("Recognition events differ across runs: {}".format(sorted(digests)))
+        sys.exit(1)
@@ -0,0 +1,2 @@
+from . import streams
+from . import service
@@ -0,0 +1,565 @@
+"""
+
+"aisecurity.serving.service"
+
+Local HTTP (or Unix socket) recognition service with dynamic request batching and pre-forked workers.
+
+"""
+
+import concurrent.futures
+import http.client
+import http.server
+import json
+import os
+import queue
+import signal
+import socket
+import socketserver
+import threading
+from timeit import default_timer as timer
+from urllib.parse import urlparse, parse_qs
+
+import cv2
+import numpy as np
+import tensorflow as tf
+
+from aisecurity.face import preprocessing, quality
+from aisecurity.face.detection import detector_init
+from aisecurity.face.preprocessing import crop_face, to_rgb
+from aisecurity.utils import metrics
+
+
+################################ Batching ###############################
+class RecognitionService:
+    """Detects faces in a thread pool and embeds crops from concurrent requests in single forward passes"""
+
+    def __init__(self, facenet, max_batch_size=16, max_wait=0.005, max_queue=64, detect_workers=2, detector="both",
+                 margin=10, rotations=None, align=False, min_face_size=40):
+        """Initializes RecognitionService and starts the detection pool and batching thread
+        :param facenet: FaceNet object
+        :param max_batch_size: maximum number of crops per embedding call (default: 16)
+        :param max_wait: maximum seconds to wait for more requests once a batch has crops (default: 0.005)
+        :param max_queue: maximum number of requests in flight-- submit() raises queue.Full beyond this (default: 64)
+        :param detect_workers: number of detection threads (default: 2)
+        :param detector: face detector type ("mtcnn", "haarcascade", "both") (default: "both")
+        :param margin: margin for face cropping (default: 10)
+        :param rotations: rotations to be applied to face (-1 is horizontal flip) (default: None)
+        :param align: align faces using MTCNN keypoints (default: False)
+        :param min_face_size: minimum face size in pixels for detection (default: 40)
+        """
+
+        self.facenet = facenet
+        self.max_wait = max_wait
+        self.max_queue = max_queue
+        self.detector = detector
+        self.margin = margin
+        self.rotations = rotations
+        self.align = align
+
+        # every request contributes at most this many crops
+        self.crops_per_face = 1 + len(set(rotations or []) - {0.})
+        self.max_batch_size = max(max_batch_size, self.crops_per_face)
+
+        self.stats = {"requests": 0, "rejected": 0, "no_face": 0, "errors": 0, "in_flight": 0, "batches": 0,
+                      "crops": 0, "mean_batch_size": None, "latency": None}
+
+        # TF1 graphs are thread-local defaults, so worker threads have to enter the graph the model was loaded into
+        self._graph = tf.get_default_graph()
+
+        self._lock = threading.Lock()
+        self._batch = np.empty((self.max_batch_size, *preprocessing.IMG_SHAPE, 3), dtype=np.float32)
+        self._embed_queue = queue.Queue()
+
+        detector_init(min_face_size=min_face_size)
+
+        self._detect_pool = concurrent.futures.ThreadPoolExecutor(max_workers=detect_workers)
+        self._thread = threading.Thread(target=self._run, name="aisecurity-batcher", daemon=True)
+        self._thread.start()
+
+    # REQUESTS (thread-safe)
+    def submit(self, img, cropped=False, embed_only=False):
+        """Queues a request without blocking
+        :param img: encoded image (bytes, ex: JPEG) or BGR array
+        :param cropped: img is an already cropped face-- detection is skipped (default: False)
+        :param embed_only: return embeddings instead of a match (default: False)
+        :returns: concurrent.futures.Future resolved with the result dict (ValueError if img can't be decoded)
+        :raises queue.Full: if max_queue requests are already in flight
+        """
+
+        with self._lock:
+            if self.stats["in_flight"] >= self.max_queue:
+                self.stats["rejected"] += 1
+                raise queue.Full("{} requests in flight".format(self.stats["in_flight"]))
+            self.stats["in_flight"] += 1
+            self.stats["requests"] += 1
+
+        request = {"img": img, "cropped": cropped, "embed_only": embed_only, "time": timer(),
+                   "future": concurrent.futures.Future()}
+        request["future"].add_done_callback(self._finish)
+
+        self._detect_pool.submit(self._detect, request)
+
+        return request["future"]
+
+    def recognize(self, img, cropped=False, timeout=None):
+        """Blocking version of submit()
+        :param img: encoded image (bytes, ex: JPEG) or BGR array
+        :param cropped: img is an already cropped face-- detection is skipped (default: False)
+        :param timeout: seconds to wait for the result (default: None, wait forever)
+        :returns: result dict
+        """
+
+        return self.submit(img, cropped=cropped).result(timeout)
+
+    def _finish(self, future):
+        with self._lock:
+            self.stats["in_flight"] -= 1
+            if future.exception() is not None:
+                self.stats["errors"] += 1
+
+    # DETECTION (pool threads)
+    @staticmethod
+    def _passes_quality(cropped_faces, face):
+        # stateless version of quality.gate: requests are unrelated images, so nothing is deferred
+        if quality.POLICY["mode"] is None:
+            return True
+
+        keypoints = [face["keypoints"]] if face["keypoints"] else None
+        scores = quality.score_faces(cropped_faces[:1], boxes=[face["box"]], keypoints=keypoints)
+
+        return not any(mask[0] for mask in quality.get_rejections(scores).values())
+
+    def _detect(self, request):
+        try:
+            img = request["img"]
+            if isinstance(img, (bytes, bytearray)):
+                img = cv2.imdecode(np.frombuffer(img, dtype=np.uint8), cv2.IMREAD_COLOR)
+            if img is None or img.ndim != 3:
+                raise ValueError("image could not be decoded")
+
+            img_shape = preprocessing.IMG_SHAPE
+
+            if request["cropped"]:
+                cropped_faces, face = np.empty((1, *img_shape, 3), dtype=np.float32), None
+                np.copyto(cropped_faces[0], cv2.resize(to_rgb(img), img_shape[::-1]), casting="unsafe")
+
+            else:
+                with self._graph.as_default():
+                    cropped_faces, face = crop_face(img, self.margin, self.detector, rotations=self.rotations,
+                                                    bgr=True, align=self.align)
+
+                if cropped_faces.shape[1:] != (*img_shape, 3) or not self._passes_quality(cropped_faces, face):
+                    with self._lock:
+                        self.stats["no_face"] += 1
+                    request["future"].set_result({"best_match": None, "error": "no face detected"})
+                    return
+
+                # crops are a view into this thread's buffer, which is reused by the next request
+                cropped_faces = cropped_faces.copy()
+
+            self._embed_queue.put((request, cropped_faces, face))
+
+        except Exception as error:
+            request["future"].set_exception(error)
+
+    # EMBEDDING (batching thread)
+    def _run(self):
+        closing = False
+
+        while not closing:
+            item = self._embed_queue.get()
+            if item is None:
+                return
+
+            entries, fill = [], 0
+            deadline = timer() + self.max_wait
+
+            while True:
+                request, cropped_faces, face = item
+
+                self._batch[fill:fill + len(cropped_faces)] = cropped_faces
+                entries.append((request, face, fill, len(cropped_faces)))
+                fill += len(cropped_faces)
+
+                if fill + self.crops_per_face > self.max_batch_size:
+                    break
+                try:
+                    item = self._embed_queue.get(timeout=max(deadline - timer(), 0.))
+                except queue.Empty:
+                    break
+                if item is None:
+                    closing = True
+                    break
+
+            self._embed(entries, fill)
+
+    def _embed(self, entries, fill):
+        try:
+            with self._graph.as_default():
+                embeds = self.facenet.embed_crops(self._batch[:fill])
+        except Exception as error:
+            # a failed forward pass fails its requests, not the batching thread
+            for request, __, __, __ in entries:
+                request["future"].set_exception(error)
+            return
+
+        now = timer()
+        with self._lock:
+            self.stats["batches"] += 1
+            self.stats["crops"] += fill
+            self.stats["mean_batch_size"] = self.stats["crops"] / self.stats["batches"]
+
+        for request, face, offset, num_crops in entries:
+            try:
+                result = self._result(embeds[offset:offset + num_crops], face, request["embed_only"])
+            except Exception as error:
+                request["future"].set_exception(error)
+                continue
+
+            latency = now - request["time"]
+            with self._lock:
+                self.stats["latency"] = latency if self.stats["latency"] is None \
+                    else 0.1 * latency + 0.9 * self.stats["latency"]
+
+            request["future"].set_result(result)
+
+    def _result(self, embeds, face, embed_only):
+        result = {"box": [int(coord) for coord in face["box"]] if face else None}
+
+        if embed_only:
+            result["embeddings"] = [embed.reshape(-1).tolist() for embed in embeds]
+            return result
+
+        analysis = self.facenet._analyze_embeds(embeds)
+        best_match, min_index = self.facenet._select_match(analysis)
+
+        result.update({
+            "best_match": best_match,
+            "dist": float(analysis["dists"][min_index]),
+            "is_recognized": bool(analysis["is_recognized"][min_index])
+        })
+
+        return result
+
+    def close(self, timeout=None):
+        """Finishes queued requests and stops the detection pool and batching thread
+        :param timeout: seconds to wait for the batching thread (default: None, wait forever)
+        """
+
+        self._detect_pool.shutdown(wait=True)
+        self._embed_queue.put(None)
+        self._thread.join(timeout)
+
+
+################################ HTTP ###############################
+class _ThreadingHTTPServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+
+class _ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class _RecognitionHandler(http.server.BaseHTTPRequestHandler):
+    """POST /recognize and /embed take a raw encoded image (?cropped=1 for pre-cropped faces), GET /stats and
+    /metrics"""
+
+    service = None
+    request_timeout = 30.
+
+    def _reply(self, code, body, headers=None):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path == "/stats":
+            self._reply(200, {**self.service.stats, "pid": os.getpid()})
+        elif self.path == "/metrics":
+            data = metrics.render().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+        else:
+            self._reply(404, {"error": "not found"})
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        if url.path not in ("/recognize", "/embed"):
+            self._reply(404, {"error": "not found"})
+            return
+
+        cropped = parse_qs(url.query).get("cropped", ["0"])[0].lower() in ("1", "true")
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+        try:
+            future = self.service.submit(body, cropped=cropped, embed_only=url.path == "/embed")
+        except queue.Full as error:
+            # backpressure: clients should retry, possibly against another worker
+            self._reply(503, {"error": str(error)}, headers={"Retry-After": "1"})
+            return
+
+        try:
+            result = future.result(self.request_timeout)
+        except concurrent.futures.TimeoutError:
+            self._reply(504, {"error": "request timed out"})
+        except ValueError as error:
+            self._reply(400, {"error": str(error)})
+        except Exception as error:
+            self._reply(500, {"error": str(error)})
+        else:
+            self._reply(422 if "error" in result else 200, result)
+
+    def log_message(self, format, *args):
+        # keep the console free for recognition output
+        pass
+
+
+def make_listener(host="127.0.0.1", port=8080, unix_socket=None, backlog=128):
+    """Binds the listening socket (before forking, so that all workers accept from it)
+    :param host: host to bind to (default: "127.0.0.1", local only)
+    :param port: port to bind to (default: 8080)
+    :param unix_socket: path to a Unix socket, used instead of host and port (default: None)
+    :param backlog: listen backlog (default: 128)
+    :returns: listening socket
+    """
+
+    if unix_socket:
+        if os.path.exists(unix_socket):
+            os.unlink(unix_socket)
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        listener.bind(unix_socket)
+    else:
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        listener.bind((host, port))
+
+    listener.listen(backlog)
+    return listener
+
+
+def make_server(service, listener, request_timeout=30.):
+    """Creates an HTTP server for a service on an already bound socket
+    :param service: RecognitionService
+    :param listener: socket returned by make_listener()
+    :param request_timeout: seconds before a request fails with 504 (default: 30.)
+    :returns: server (call serve_forever())
+    """
+
+    handler = type("RecognitionHandler", (_RecognitionHandler,),
+                   {"service": service, "request_timeout": request_timeout})
+    server_type = _ThreadingUnixHTTPServer if listener.family == socket.AF_UNIX else _ThreadingHTTPServer
+
+    server = server_type(listener.getsockname(), handler, bind_and_activate=False)
+    server.socket.close()
+    server.socket = listener
+
+    return server
+
+
+################################ Pre-fork ###############################
+def _serve_worker(make_facenet, listener, request_timeout, service_kwargs):
+    # the model is loaded after the fork: TF sessions can't be shared between processes
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+
+    service = RecognitionService(make_facenet(), **service_kwargs)
+    server = make_server(service, listener, request_timeout)
+
+    print("[DEBUG] Worker {} serving on {}".format(os.getpid(), listener.getsockname()))
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
+
+
+def serve(make_facenet, workers=2, host="127.0.0.1", port=8080, unix_socket=None, request_timeout=30.,
+          **service_kwargs):
+    """Serves recognition requests from pre-forked workers, each with its own model
+    :param make_facenet: callable returning a FaceNet object, called once in every worker
+    :param workers: number of worker processes (default: 2)
+    :param host: host to bind to (default: "127.0.0.1", local only)
+    :param port: port to bind to (default: 8080)
+    :param unix_socket: path to a Unix socket, used instead of host and port (default: None)
+    :param request_timeout: seconds before a request fails with 504 (default: 30.)
+    :param service_kwargs: RecognitionService kwargs
+    """
+
+    assert hasattr(os, "fork"), "pre-fork workers are only supported on Unix"
+
+    listener = make_listener(host, port, unix_socket)
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+
+    children = []
+    for __ in range(workers):
+        pid = os.fork()
+        if pid == 0:
+            try:
+                _serve_worker(make_facenet, listener, request_timeout, service_kwargs)
+            finally:
+                os._exit(0)
+        children.append(pid)
+
+    try:
+        for pid in children:
+            os.waitpid(pid, 0)
+    except KeyboardInterrupt:
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        for pid in children:
+            try:
+                os.waitpid(pid, 0)
+            except ChildProcessError:
+                pass
+    finally:
+        listener.close()
+        if unix_socket and os.path.exists(unix_socket):
+            os.unlink(unix_socket)
+
+
+################################ Load test ###############################
+class _UnixHTTPConnection(http.client.HTTPConnection):
+
+    def __init__(self, path, timeout=30.):
+        super().__init__("localhost", timeout=timeout)
+        self.path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.path)
+
+
+def load_test(images, num_requests=200, concurrency=8, host="127.0.0.1", port=8080, unix_socket=None,
+              endpoint="/recognize", timeout=30.):
+    """Sends requests from concurrent clients and measures throughput and latency
+    :param images: list of encoded images (bytes), sent round-robin
+    :param num_requests: total number of requests (default: 200)
+    :param concurrency: number of concurrent clients (default: 8)
+    :param host: service host (default: "127.0.0.1")
+    :param port: service port (default: 8080)
+    :param unix_socket: path to the service's Unix socket, used instead of host and port (default: None)
+    :param endpoint: endpoint and query string (default: "/recognize")
+    :param timeout: client timeout in seconds (default: 30.)
+    :returns: dict with throughput (requests/s), latency percentiles (ms), and status code counts
+    """
+
+    counter = iter(range(num_requests))
+    lock = threading.Lock()
+    latencies, statuses = [], {}
+
+    def client():
+        while True:
+            with lock:
+                idx = next(counter, None)
+            if idx is None:
+                return
+
+            if unix_socket:
+                conn = _UnixHTTPConnection(unix_socket, timeout=timeout)
+            else:
+                conn = http.client.HTTPConnection(host, port, timeout=timeout)
+
+            start = timer()
+            try:
+                conn.request("POST", endpoint, body=images[idx % len(images)],
+                             headers={"Content-Type": "application/octet-stream"})
+                response = conn.getresponse()
+                response.read()
+                status = response.status
+            except OSError:
+                status = "connection error"
+            finally:
+                conn.close()
+
+            with lock:
+                latencies.append(timer() - start)
+                statuses[status] = statuses.get(status, 0) + 1
+
+    start = timer()
+    threads = [threading.Thread(target=client, daemon=True) for __ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = timer() - start
+
+    latencies = 1000. * np.array(latencies)
+    return {
+        "requests": num_requests,
+        "throughput": round(num_requests / elapsed, 2),
+        "p50": round(float(np.percentile(latencies, 50)), 2),
+        "p90": round(float(np.percentile(latencies, 90)), 2),
+        "p99": round(float(np.percentile(latencies, 99)), 2),
+        "statuses": statuses
+    }
+
+
+################################ Recognition service ###############################
+if __name__ == "__main__":
+    import argparse
+    import glob
+
+
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="command")
+
+    serve_parser = subparsers.add_parser("serve", help="start the service")
+    serve_parser.add_argument("--path_to_model", help="path to model (default: DEFAULT_MODEL)", type=str, default=None)
+    serve_parser.add_argument("--workers", help="number of worker processes", type=int, default=2)
+    serve_parser.add_argument("--detect_workers", help="detection threads per worker", type=int, default=2)
+    serve_parser.add_argument("--max_batch_size", help="maximum crops per embedding call", type=int, default=16)
+    serve_parser.add_argument("--max_wait", help="maximum seconds to wait to fill a batch", type=float, default=0.005)
+    serve_parser.add_argument("--max_queue", help="requests in flight per worker before 503", type=int, default=64)
+
+    load_parser = subparsers.add_parser("load", help="load test a running service")
+    load_parser.add_argument("images", help="image files or glob patterns", type=str, nargs="+")
+    load_parser.add_argument("--requests", help="total number of requests", type=int, default=200)
+    load_parser.add_argument("--concurrency", help="number of concurrent clients", type=int, default=8)
+    load_parser.add_argument("--cropped", help="images are pre-cropped faces", action="store_true")
+
+    for sub in (serve_parser, load_parser):
+        sub.add_argument("--host", help="host (default: 127.0.0.1)", type=str, default="127.0.0.1")
+        sub.add_argument("--port", help="port (default: 8080)", type=int, default=8080)
+        sub.add_argument("--unix_socket", help="Unix socket path, used instead of host and port", type=str,
+                         default=None)
+
+    args = parser.parse_args()
+
+    if args.command == "serve":
+        def make_facenet():
+            from aisecurity.facenet import FaceNet
+            return FaceNet(args.path_to_model) if args.path_to_model else FaceNet()
+
+        serve(make_facenet, workers=args.workers, host=args.host, port=args.port, unix_socket=args.unix_socket,
+              detect_workers=args.detect_workers, max_batch_size=args.max_batch_size, max_wait=args.max_wait,
+              max_queue=args.max_queue)
+
+    elif args.command == "load":
+        paths = [path for pattern in args.images for path in sorted(glob.glob(pattern))]
+        assert paths, "no images found"
+
+        test_images = []
+        for path in paths:
+            with open(path, "rb") as file:
+                test_images.append(file.read())
+
+        print(load_test(test_images, num_requests=args.requests, concurrency=args.concurrency, host=args.host,
+                        port=args.port, unix_socket=args.unix_socket,
+                        endpoint="/recognize?cropped=1" if args.cropped else "/recognize"))
+
+    else:
+        parser.print_help()
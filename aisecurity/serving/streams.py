@@ -0,0 +1,323 @@
+"""
+
+"aisecurity.serving.streams"
+
+Multi-camera recognition with one model and dynamically batched embedding.
+
+"""
+
+import time
+from timeit import default_timer as timer
+
+import cv2
+import numpy as np
+
+from aisecurity.db.log import RecognitionAggregator
+from aisecurity.face import preprocessing, quality
+from aisecurity.face.detection import detector_init
+from aisecurity.utils.capture import ThreadedCapture
+from aisecurity.utils.visuals import get_video_cap
+
+
+################################ Streams ###############################
+class Stream:
+    """One capture source with its own aggregator, quality gate, and stats"""
+
+    def __init__(self, name, cap, aggregator=None, resize=None, smoothing=0.1, gate=None):
+        """Initializes Stream
+        :param name: stream name (ex: "front_door")
+        :param cap: ThreadedCapture object
+        :param aggregator: RecognitionAggregator for this stream (default: None, a new one)
+        :param resize: resize scale for detection (default: None)
+        :param smoothing: exponential moving average factor for FPS (default: 0.1)
+        :param gate: QualityGate for this stream-- deferred faces must never be released on another stream (default:
+                     None, a new one configured like quality.init())
+        """
+
+        self.name = name
+        self.cap = cap
+        self.aggregator = aggregator if aggregator else RecognitionAggregator()
+        self.gate = gate if gate else quality.QualityGate(quality.POLICY["mode"], quality.THRESHOLDS,
+                                                          quality.POLICY["max_deferred"])
+        self.resize = resize
+        self.smoothing = smoothing
+
+        self.absent_frames = 0
+        self.last_result = None  # (best_match, dist, is_recognized) of the most recent face
+
+        self.stats = {"frames": 0, "faces": 0, "fps": None}
+        self._last_time = None
+
+    def record_frame(self, now):
+        self.stats["frames"] += 1
+        if self._last_time is not None and now > self._last_time:
+            fps = 1. / (now - self._last_time)
+            self.stats["fps"] = fps if self.stats["fps"] is None \
+                else self.smoothing * fps + (1. - self.smoothing) * self.stats["fps"]
+        self._last_time = now
+
+
+def open_streams(devices, width=640, height=360, flip=0, resize=None, capture_mode=None):
+    """Opens one stream per device
+    :param devices: list of devices (ints for /dev/video{device}, strs for video files) or {name: device}
+    :param width: width of frame (default: 640)
+    :param height: height of frame (default: 360)
+    :param flip: flip method: +1 = +90º rotation (default: 0)
+    :param resize: resize scale for detection (default: None)
+    :param capture_mode: "latest" or "ordered" (default: None, "ordered" for video files and "latest" for cameras)
+    :returns: list of Stream objects
+    """
+
+    if not isinstance(devices, dict):
+        devices = {"stream_{}".format(idx): device for idx, device in enumerate(devices)}
+
+    streams = []
+    for name, device in devices.items():
+        mode = capture_mode if capture_mode else ("ordered" if isinstance(device, str) else "latest")
+        cap = ThreadedCapture(get_video_cap(width, height, flip, device), mode=mode)
+        streams.append(Stream(name, cap, resize=resize))
+
+    return streams
+
+
+################################ Runner ###############################
+class MultiStreamRunner:
+    """Runs detection for every stream and embeds crops from all streams in shared, dynamically sized batches"""
+
+    def __init__(self, facenet, streams, max_batch_size=16, max_wait=0.02, detector="both", margin=10,
+                 rotations=None, align=False, min_face_size=40, clock=timer):
+        """Initializes MultiStreamRunner
+        :param facenet: FaceNet object (one model and gallery shared by all streams)
+        :param streams: list of Stream objects
+        :param max_batch_size: maximum number of crops per embedding call (default: 16)
+        :param max_wait: maximum seconds to wait for more streams once a batch has crops (default: 0.02)
+        :param detector: face detector type ("mtcnn", "haarcascade", "both") (default: "both")
+        :param margin: margin for face cropping (default: 10)
+        :param rotations: rotations to be applied to face (-1 is horizontal flip) (default: None)
+        :param align: align faces using MTCNN keypoints (default: False)
+        :param min_face_size: minimum face size in pixels for detection (default: 40)
+        :param clock: callable returning seconds (default: timeit.default_timer)
+        """
+
+        self.facenet = facenet
+        self.streams = list(streams)
+        self.max_wait = max_wait
+        self.detector = detector
+        self.margin = margin
+        self.rotations = rotations
+        self.align = align
+        self.clock = clock
+
+        # every face contributes at most this many crops
+        self.crops_per_face = 1 + len(set(rotations or []) - {0.})
+        self.max_batch_size = max(max_batch_size, self.crops_per_face)
+
+        self.stats = {"batches": 0, "crops": 0, "mean_batch_size": None, "mean_wait": None}
+
+        self._batch = np.empty((self.max_batch_size, *preprocessing.IMG_SHAPE, 3), dtype=np.float32)
+        self._next_stream = 0
+        self._stopped = False
+
+        detector_init(min_face_size=min_face_size)
+
+    # BATCH COLLECTION
+    def _detect(self, stream, frame):
+        if stream.resize:
+            frame = cv2.resize(frame, (0, 0), fx=stream.resize, fy=stream.resize)
+
+        try:
+            return self.facenet._crop(frame, self.detector, self.margin, self.rotations, self.align,
+                                      frame_num=stream.cap.frame_num, gate=stream.gate)
+        except AssertionError:
+            # no face or face quality too low
+            return None, None
+
+    def _collect(self):
+        # each stream contributes at most one (latest) frame per batch-- streams are visited round-robin so that
+        # none of them is starved when batches fill up
+        entries, fill = [], 0
+        visited, deadline = set(), None
+
+        order = self.streams[self._next_stream:] + self.streams[:self._next_stream]
+        self._next_stream = (self._next_stream + 1) % max(len(self.streams), 1)
+
+        while not self._stopped:
+            read_any = False
+            for stream in order:
+                if stream in visited or stream.cap.finished:
+                    continue
+                if fill + self.crops_per_face > self.max_batch_size:
+                    break
+
+                ret, frame = stream.cap.read(timeout=0)
+                if not ret:
+                    continue
+
+                visited.add(stream)
+                read_any = True
+
+                cropped_faces, face = self._detect(stream, frame)
+                if cropped_faces is None:
+                    entries.append((stream, None, fill, 0))
+                    continue
+
+                # crops are views into a buffer reused by crop_face, so they have to be copied out now
+                self._batch[fill:fill + len(cropped_faces)] = cropped_faces
+                entries.append((stream, face, fill, len(cropped_faces)))
+                fill += len(cropped_faces)
+
+                if deadline is None:
+                    deadline = self.clock() + self.max_wait
+
+            remaining = [stream for stream in self.streams if stream not in visited and not stream.cap.finished]
+            if not remaining or fill + self.crops_per_face > self.max_batch_size:
+                break
+            if entries and (deadline is None or self.clock() >= deadline):
+                break
+            if not read_any:
+                time.sleep(0.001)
+
+        return entries, fill
+
+    # PROCESSING
+    def step(self):
+        """Collects one batch across streams, embeds it with one FaceNet call, and logs per-stream results
+        :returns: list of (stream, best_match, dist, is_recognized) for streams that had a frame
+        """
+
+        start = self.clock()
+        entries, fill = self._collect()
+        collected = self.clock()
+
+        embeds = self.facenet.embed_crops(self._batch[:fill]) if fill else []
+
+        results = []
+        for stream, face, offset, num_crops in entries:
+            best_match, dist, is_recognized, embed = None, None, None, None
+
+            if face is not None:
+                analysis = self.facenet._analyze_embeds(embeds[offset:offset + num_crops])
+                best_match, min_index = self.facenet._select_match(analysis)
+
+                embed = embeds[offset + min_index]
+                dist = analysis["dists"][min_index]
+                is_recognized = analysis["is_recognized"][min_index]
+
+                stream.stats["faces"] += 1
+                stream.last_result = (best_match, dist, is_recognized)
+
+            stream.absent_frames = self.facenet.log_activity(
+                best_match, embed, dynamic_log=False, data_mutable=False, pbar=False, dist=dist,
+                absent_frames=stream.absent_frames, aggregator=stream.aggregator
+            )
+
+            stream.cap.record_result()
+            stream.record_frame(self.clock())
+            results.append((stream, best_match, dist, is_recognized))
+
+        if fill:
+            self.stats["batches"] += 1
+            self.stats["crops"] += fill
+            self.stats["mean_batch_size"] = self.stats["crops"] / self.stats["batches"]
+            wait = collected - start
+            self.stats["mean_wait"] = wait if self.stats["mean_wait"] is None \
+                else 0.1 * wait + 0.9 * self.stats["mean_wait"]
+
+        return results
+
+    def run(self, max_steps=None, report_interval=None):
+        """Processes batches until every stream ends, stop() is called, or max_steps batches are processed
+        :param max_steps: maximum number of steps (default: None, no limit)
+        :param report_interval: print a report every this many seconds (default: None, never)
+        :returns: report()
+        """
+
+        steps, last_report = 0, self.clock()
+
+        while not self._stopped and not all(stream.cap.finished for stream in self.streams):
+            self.step()
+            steps += 1
+
+            if max_steps is not None and steps >= max_steps:
+                break
+
+            if report_interval and self.clock() - last_report >= report_interval:
+                self.print_report()
+                last_report = self.clock()
+
+        return self.report()
+
+    def stop(self):
+        self._stopped = True
+
+    def release(self):
+        for stream in self.streams:
+            stream.cap.release()
+
+    # REPORTING
+    def report(self):
+        """Per-stream FPS and capture-to-result latency, and batching stats
+        :returns: dict with "streams" ({name: stats}) and "batching" entries
+        """
+
+        streams = {}
+        for stream in self.streams:
+            streams[stream.name] = {
+                **stream.stats,
+                "latency": stream.cap.stats["latency"],
+                "max_latency": stream.cap.stats["max_latency"],
+                "dropped": stream.cap.stats["dropped"]
+            }
+
+        return {"streams": streams, "batching": dict(self.stats)}
+
+    def print_report(self):
+        report = self.report()
+        for name, stats in report["streams"].items():
+            print("[{}] {} fps, {} ms latency, {} frames ({} faces), {} dropped".format(
+                name,
+                round(stats["fps"], 2) if stats["fps"] else None,
+                round(1000. * stats["latency"], 2) if stats["latency"] is not None else None,
+                stats["frames"], stats["faces"], stats["dropped"]
+            ))
+        print("[batching] {}".format(report["batching"]))
+
+
+################################ Multi-stream recognition ###############################
+if __name__ == "__main__":
+    import argparse
+
+    from aisecurity.db import log
+    from aisecurity.facenet import FaceNet
+    from aisecurity.utils.paths import DEFAULT_MODEL
+
+
+    def device(arg):
+        try:
+            return int(arg)
+        except ValueError:
+            return arg
+
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("devices", help="cameras (ints) or video files", type=device, nargs="+")
+    parser.add_argument("--path_to_model", help="path to model", type=str, default=DEFAULT_MODEL)
+    parser.add_argument("--logging", help="None, firebase, mysql, or sqlite (default: None)", type=str, default=None)
+    parser.add_argument("--resize", help="resize scale for detection (default: None)", type=float, default=None)
+    parser.add_argument("--max_batch_size", help="maximum crops per embedding call", type=int, default=16)
+    parser.add_argument("--max_wait", help="maximum seconds to wait to fill a batch", type=float, default=0.02)
+    args = parser.parse_args()
+
+    facenet = FaceNet(args.path_to_model)
+    log.init(args.logging)
+
+    runner = MultiStreamRunner(facenet, open_streams(args.devices, resize=args.resize),
+                               max_batch_size=args.max_batch_size, max_wait=args.max_wait)
+    try:
+        runner.run(report_interval=5.)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        runner.release()
+        log.close()
+        runner.print_report()
@@ -1,4 +1,5 @@
 from . import distance
 from . import lcd
+from . import metrics
 from . import paths
 from . import visuals
@@ -0,0 +1,140 @@
+"""
+
+"aisecurity.utils.capture"
+
+Threaded video capture.
+
+"""
+
+import collections
+import threading
+from timeit import default_timer as timer
+
+
+################################ Threaded capture ###############################
+class ThreadedCapture:
+    """Decodes frames on a dedicated thread into a small ring buffer so that readers never get stale frames"""
+
+    def __init__(self, cap, mode="latest", buffer_size=2, smoothing=0.1, clock=timer):
+        """Initializes ThreadedCapture and starts the capture thread
+        :param cap: cv2.VideoCapture object (or anything with read() and release())
+        :param mode: "latest" (newest frame wins, older frames are dropped-- for cameras) or "ordered" (every frame
+                     in order, capture waits for the reader-- for video files) (default: "latest")
+        :param buffer_size: number of buffered frames (default: 2)
+        :param smoothing: exponential moving average factor for latency stats (default: 0.1)
+        :param clock: callable returning seconds (default: timeit.default_timer)
+        """
+
+        assert mode in ("latest", "ordered"), "supported capture modes are 'latest' and 'ordered'"
+
+        self.cap = cap
+        self.mode = mode
+        self.smoothing = smoothing
+        self.clock = clock
+
+        self.frames = collections.deque(maxlen=buffer_size)  # (frame number, capture time, frame)
+        self.timestamp = None  # capture time of the last frame returned by read()
+        self.frame_num = None
+
+        self.stats = {"captured": 0, "delivered": 0, "dropped": 0, "latency": None, "max_latency": 0.}
+
+        self._cond = threading.Condition()
+        self._eof = False
+        self._stopped = False
+
+        self._thread = threading.Thread(target=self._run, name="aisecurity-capture", daemon=True)
+        self._thread.start()
+
+    # CAPTURE THREAD
+    def _run(self):
+        try:
+            self._capture()
+        finally:
+            # released here, not in release(): cap must never be released while this thread is inside cap.read()
+            self.cap.release()
+
+    def _capture(self):
+        while True:
+            ret, frame = self.cap.read()
+            now = self.clock()
+
+            with self._cond:
+                if not ret:
+                    self._eof = True
+                    self._cond.notify_all()
+                    return
+
+                if self.mode == "ordered":
+                    self._cond.wait_for(lambda: len(self.frames) < self.frames.maxlen or self._stopped)
+                elif len(self.frames) == self.frames.maxlen:
+                    self.stats["dropped"] += 1  # oldest buffered frame is overwritten
+
+                if self._stopped:
+                    return
+
+                self.frames.append((self.stats["captured"], now, frame))
+                self.stats["captured"] += 1
+                self._cond.notify_all()
+
+    # READER
+    @property
+    def finished(self):
+        """Property for end of stream
+        :returns: whether or not the source is exhausted and every buffered frame has been read
+        """
+
+        with self._cond:
+            return (self._eof or self._stopped) and not self.frames
+
+    def read(self, timeout=None):
+        """Returns the next frame: the newest one in "latest" mode, the next one in "ordered" mode
+        :param timeout: seconds to wait for a frame (default: None, wait forever)
+        :returns: ret, frame (False, None at end of stream or on timeout), like cv2.VideoCapture.read
+        """
+
+        with self._cond:
+            if not self._cond.wait_for(lambda: self.frames or self._eof or self._stopped, timeout):
+                return False, None
+
+            if not self.frames:
+                return False, None
+
+            if self.mode == "latest":
+                self.frame_num, self.timestamp, frame = self.frames.pop()
+                self.stats["dropped"] += len(self.frames)
+                self.frames.clear()
+            else:
+                self.frame_num, self.timestamp, frame = self.frames.popleft()
+
+            self.stats["delivered"] += 1
+            self._cond.notify_all()
+
+        return True, frame
+
+    def record_result(self):
+        """Records capture-to-result latency of the last frame returned by read()
+        :returns: latency in seconds
+        """
+
+        latency = self.clock() - self.timestamp
+
+        if self.stats["latency"] is None:
+            self.stats["latency"] = latency
+        else:
+            self.stats["latency"] = self.smoothing * latency + (1. - self.smoothing) * self.stats["latency"]
+        self.stats["max_latency"] = max(self.stats["max_latency"], latency)
+
+        return latency
+
+    def release(self, timeout=1.):
+        """Stops the capture thread, which releases the capture once its current read() returns
+        :param timeout: seconds to wait for the capture thread (default: 1.)
+        :returns: whether or not the capture was released within timeout
+        """
+
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+
+        self._thread.join(timeout)
+        return not self._thread.is_alive()
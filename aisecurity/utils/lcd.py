@@ -6,7 +6,8 @@ LCD utils.
 
 """
 
-from timeit import default_timer as timer
+import threading
+import time
 import warnings
 
 from termcolor import cprint
@@ -20,19 +21,106 @@ PROGRESS_BAR = None
 
 
 # LCD INIT
-def init():
+def init(max_fps=4., aggregator=None):
     global PROGRESS_BAR
 
-    PROGRESS_BAR = LCDProgressBar(mode="pi" if connection.SOCKET else "sim", total=log.THRESHOLDS["num_recognized"])
+    close()
+
+    # the display is cleared from the refresh thread, so the cam loop doesn't have to check for it every frame
+    PROGRESS_BAR = LCDProgressBar(mode="pi" if connection.SOCKET else "sim", total=log.THRESHOLDS["num_recognized"],
+                                  max_fps=max_fps, on_refresh=lambda: check_clear(aggregator))
     PROGRESS_BAR.set_message("Loading...\n[ Initializing ]")
 
 
+def close(timeout=None):
+    global PROGRESS_BAR
+
+    if PROGRESS_BAR:
+        PROGRESS_BAR.output.close(timeout)
+        PROGRESS_BAR = None
+
+
 ################################ Classes ################################
 
+# LCD OUTPUT
+class LCDOutput:
+    """Display state holder that sends only the latest, changed message at a capped refresh rate"""
+
+    def __init__(self, mode, max_fps=4., on_refresh=None):
+        """Initializes LCDOutput and starts the refresh thread
+        :param mode: "pi" (send to the Pi over the websocket) or "sim" (print to the console)
+        :param max_fps: maximum display refreshes per second (default: 4.)
+        :param on_refresh: callable run by the refresh thread at most max_fps times per second, even if nothing was
+                           set-- it may set a new message (default: None)
+        """
+
+        self.mode = mode
+        self.interval = 1. / max_fps
+        self.on_refresh = on_refresh
+
+        self.message = None  # desired display state
+        self.displayed = None  # last message actually shown
+
+        self.stats = {"requested": 0, "sent": 0}
+
+        self._changed = threading.Condition()
+        self._closing = False
+        self._thread = threading.Thread(target=self._run, name="aisecurity-lcd", daemon=True)
+        self._thread.start()
+
+    def set(self, message):
+        """Sets the desired display state without blocking
+        :param message: LCD message
+        """
+
+        with self._changed:
+            self.stats["requested"] += 1
+            self.message = message
+            self._changed.notify()
+
+    def _show(self, message):
+        if self.mode == "pi":
+            connection.send(coalesce="lcd", lcd=message)
+        elif self.mode == "sim":
+            cprint(message, attrs=["bold"])
+
+        self.displayed = message
+        self.stats["sent"] += 1
+
+    def _run(self):
+        while True:
+            if self.on_refresh:
+                self.on_refresh()
+
+            with self._changed:
+                self._changed.wait_for(lambda: self.message != self.displayed or self._closing,
+                                       self.interval if self.on_refresh else None)
+                message, closing = self.message, self._closing
+
+            if message != self.displayed:
+                self._show(message)
+
+            if closing:
+                break
+
+            # states set during this interval are skipped except for the latest one
+            time.sleep(self.interval)
+
+    def close(self, timeout=None):
+        """Shows the latest message and stops the refresh thread
+        :param timeout: seconds to wait for the refresh thread (default: None, wait forever)
+        """
+
+        with self._changed:
+            self._closing = True
+            self._changed.notify()
+        self._thread.join(timeout)
+
+
 # LCD PROGRESS BAR
 class LCDProgressBar:
 
-    def __init__(self, mode, total, length=16, marker="#"):
+    def __init__(self, mode, total, length=16, marker="#", max_fps=4., on_refresh=None):
         assert mode in ("pi", "sim"), "supported modes are physical (physical LCD) and dev (testing)"
 
         try:
@@ -50,12 +138,12 @@ class LCDProgressBar:
         self.marker = marker
         self.progress = 0.
         self.blank = " " * self.bar_length
+        self.cleared = None  # log time that the display was last cleared after
+
+        self.output = LCDOutput(self.mode, max_fps=max_fps, on_refresh=on_refresh)
 
     def set_message(self, message):
-        if self.mode == "pi":
-            connection.send(lcd=message)
-        elif self.mode == "sim":
-            cprint(message, attrs=["bold"])
+        self.output.set(message)
 
     def reset(self, message=None):
         self.progress = 0.
@@ -77,12 +165,19 @@ class LCDProgressBar:
 ################################ Functions ################################
 
 # PERIODIC LCD CLEAR
-def check_clear():
-    global PROGRESS_BAR
-
-    lcd_clear = log.THRESHOLDS["num_recognized"] / log.THRESHOLDS["missed_frames"]
-    if log.LAST_LOGGED - timer() > lcd_clear or log.UNK_LAST_LOGGED - timer() > lcd_clear:
-        PROGRESS_BAR.reset()
+def check_clear(aggregator=None):
+    # clears the display once, lcd_clear seconds after the last log-- run by the LCD refresh thread
+    aggregator = aggregator if aggregator else log.AGGREGATOR
+    progress_bar = PROGRESS_BAR
+    if not aggregator or not progress_bar:
+        return
+
+    lcd_clear = aggregator.thresholds["num_recognized"] / aggregator.thresholds["missed_frames"]
+    last_logged = max(aggregator.last_logged, aggregator.unk_last_logged)
+
+    if last_logged != progress_bar.cleared and aggregator.clock() - last_logged > lcd_clear:
+        progress_bar.cleared = last_logged
+        progress_bar.reset(message="Recognizing...")
 
 
 # PBAR UPDATE
@@ -0,0 +1,486 @@
+"""
+
+"aisecurity.utils.metrics"
+
+Counters, gauges, and fixed-bucket latency histograms for the recognition pipeline, with periodic summaries and
+Prometheus text export.
+
+"""
+
+import bisect
+import contextlib
+import http.server
+import os
+import socketserver
+import threading
+import warnings
+from timeit import default_timer as timer
+
+
+################################ Setup and helpers ###############################
+
+# GLOBALS
+PREFIX = "aisecurity_"
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1., 2.5, 5., 10.)  # seconds
+
+QUIET = False  # no per-frame printing-- stages still record metrics
+
+SUMMARIZER = None
+HTTP_EXPORTER = None
+FILE_EXPORTER = None
+
+_REGISTRY = {}  # (name, sorted label items): metric
+_REGISTRY_LOCK = threading.Lock()
+
+
+# HELPERS
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(key, str(value).replace('"', '\\"')) for key, value in labels) + "}"
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value))
+
+
+################################ Metrics ###############################
+class _Metric:
+    TYPE = None
+
+    def __init__(self, name, description="", labels=()):
+        self.name = name
+        self.description = description
+        self.labels = labels  # sorted (key, value) tuples
+
+        self._lock = threading.Lock()
+
+    def samples(self):
+        """Prometheus samples
+        :returns: list of (name suffix, extra labels, value)
+        """
+        raise NotImplementedError()
+
+
+class Counter(_Metric):
+    """Monotonically increasing count, ex: frames processed"""
+
+    TYPE = "counter"
+
+    def __init__(self, name, description="", labels=()):
+        super().__init__(name, description, labels)
+        self.value = 0.
+
+    def inc(self, amount=1.):
+        with self._lock:
+            self.value += amount
+
+    def samples(self):
+        return [("", (), self.value)]
+
+
+class Gauge(_Metric):
+    """Value that goes up and down, ex: people in the database"""
+
+    TYPE = "gauge"
+
+    def __init__(self, name, description="", labels=()):
+        super().__init__(name, description, labels)
+        self.value = 0.
+
+    def set(self, value):
+        self.value = value
+
+    def inc(self, amount=1.):
+        with self._lock:
+            self.value += amount
+
+    def samples(self):
+        return [("", (), self.value)]
+
+
+class Histogram(_Metric):
+    """Distribution in fixed buckets-- observe() is a bisect and two additions, so it is cheap enough for every frame"""
+
+    TYPE = "histogram"
+
+    def __init__(self, name, description="", labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, description, labels)
+        self.buckets = tuple(sorted(buckets))
+
+        self.counts = [0] * (len(self.buckets) + 1)  # last bucket is +Inf
+        self.count = 0
+        self.sum = 0.
+
+    def observe(self, value):
+        idx = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[idx] += 1
+            self.count += 1
+            self.sum += value
+
+    @contextlib.contextmanager
+    def time(self):
+        start = timer()
+        try:
+            yield
+        finally:
+            self.observe(timer() - start)
+
+    def snapshot(self):
+        """Consistent copy of the histogram state
+        :returns: counts per bucket, count, sum
+        """
+
+        with self._lock:
+            return list(self.counts), self.count, self.sum
+
+    def quantile(self, q, snapshot=None):
+        """Estimates a quantile by interpolating within its bucket, like Prometheus' histogram_quantile
+        :param q: quantile between 0. and 1.
+        :param snapshot: result of snapshot() (or a difference of two) (default: None, current state)
+        :returns: estimated value, None if nothing was observed
+        """
+
+        counts, count, __ = snapshot if snapshot else self.snapshot()
+        if not count:
+            return None
+
+        rank, cumulative = q * count, 0
+        for idx, bucket_count in enumerate(counts):
+            if bucket_count and cumulative + bucket_count >= rank:
+                if idx == len(self.buckets):
+                    return self.buckets[-1]  # +Inf bucket: the largest finite bound is the best estimate
+                lower = self.buckets[idx - 1] if idx else 0.
+                return lower + (self.buckets[idx] - lower) * (rank - cumulative) / bucket_count
+            cumulative += bucket_count
+
+        return self.buckets[-1]
+
+    def samples(self):
+        counts, count, total = self.snapshot()
+
+        samples, cumulative = [], 0
+        for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+            cumulative += bucket_count
+            samples.append(("_bucket", (("le", _format_value(bound)),), cumulative))
+
+        samples.append(("_sum", (), total))
+        samples.append(("_count", (), count))
+
+        return samples
+
+
+################################ Registry ###############################
+def _get(cls, name, description, labels, **kwargs):
+    key = (name, tuple(sorted(labels.items())) if labels else ())
+
+    metric = _REGISTRY.get(key)
+    if metric is None:
+        with _REGISTRY_LOCK:
+            metric = _REGISTRY.get(key)
+            if metric is None:
+                metric = _REGISTRY[key] = cls(name, description, key[1], **kwargs)
+
+    assert isinstance(metric, cls), "{} is already registered as a {}".format(name, metric.TYPE)
+    return metric
+
+
+def counter(name, description="", labels=None):
+    """Gets or creates a counter (keep the returned object in hot paths instead of looking it up every frame)
+    :param name: metric name without prefix, ex: "frames_total"
+    :param description: HELP text (default: "")
+    :param labels: dict of labels, ex: {"result": "recognized"} (default: None)
+    :returns: Counter
+    """
+
+    return _get(Counter, name, description, labels)
+
+
+def gauge(name, description="", labels=None):
+    """Gets or creates a gauge
+    :param name: metric name without prefix, ex: "database_people"
+    :param description: HELP text (default: "")
+    :param labels: dict of labels (default: None)
+    :returns: Gauge
+    """
+
+    return _get(Gauge, name, description, labels)
+
+
+def histogram(name, description="", labels=None, buckets=LATENCY_BUCKETS):
+    """Gets or creates a histogram
+    :param name: metric name without prefix, ex: "detection_seconds"
+    :param description: HELP text (default: "")
+    :param labels: dict of labels, ex: {"detector": "mtcnn"} (default: None)
+    :param buckets: upper bounds of the buckets, only used on creation (default: LATENCY_BUCKETS)
+    :returns: Histogram
+    """
+
+    return _get(Histogram, name, description, labels, buckets=buckets)
+
+
+def registered():
+    """All registered metrics, grouped by name
+    :returns: {name: [metric, ...]}
+    """
+
+    grouped = {}
+    for (name, __), metric in sorted(_REGISTRY.copy().items()):
+        grouped.setdefault(name, []).append(metric)
+    return grouped
+
+
+@contextlib.contextmanager
+def quiet():
+    """Silences per-frame printing within the block"""
+    global QUIET
+
+    previous, QUIET = QUIET, True
+    try:
+        yield
+    finally:
+        QUIET = previous
+
+
+################################ Exporting ###############################
+def render():
+    """Prometheus text exposition of every metric
+    :returns: str
+    """
+
+    lines = []
+    for name, group in registered().items():
+        full_name = PREFIX + name
+        if group[0].description:
+            lines.append("# HELP {} {}".format(full_name, group[0].description))
+        lines.append("# TYPE {} {}".format(full_name, group[0].TYPE))
+
+        for metric in group:
+            for suffix, labels, value in metric.samples():
+                lines.append("{}{}{} {}".format(full_name, suffix, _format_labels(metric.labels + labels),
+                                                _format_value(value)))
+
+    return "\n".join(lines) + "\n"
+
+
+def summary(previous=None):
+    """Human-readable summary of every metric
+    :param previous: state returned by an earlier call-- histograms then only cover the interval since (default: None)
+    :returns: summary str, state for the next call
+    """
+
+    previous = previous if previous else {}
+    state, lines = {}, []
+
+    for name, group in registered().items():
+        for metric in group:
+            key = name + _format_labels(metric.labels)
+
+            if isinstance(metric, Histogram):
+                counts, count, total = state[key] = metric.snapshot()
+                if key in previous:
+                    old_counts, old_count, old_total = previous[key]
+                    counts = [new - old for new, old in zip(counts, old_counts)]
+                    count, total = count - old_count, total - old_total
+                if not count:
+                    continue
+
+                snapshot = (counts, count, total)
+                lines.append("{}: {} obs, mean {} ms, p50 {} ms, p95 {} ms, p99 {} ms".format(
+                    key, count, round(1000. * total / count, 2),
+                    *(round(1000. * metric.quantile(q, snapshot), 2) for q in (0.5, 0.95, 0.99))
+                ))
+
+            else:
+                lines.append("{}: {}".format(key, round(metric.value, 4)))
+
+    return "\n".join(lines), state
+
+
+class Summarizer:
+    """Prints a summary every interval, covering only what was observed since the previous summary"""
+
+    def __init__(self, interval=30., printer=print):
+        """Initializes Summarizer and starts the summary thread
+        :param interval: seconds between summaries (default: 30.)
+        :param printer: callable that takes the summary str (default: print)
+        """
+
+        self.interval = interval
+        self.printer = printer
+
+        self._state = None
+        self._stopped = threading.Event()
+
+        self._thread = threading.Thread(target=self._run, name="aisecurity-metrics-summary", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            self.print_summary()
+
+    def print_summary(self):
+        text, self._state = summary(self._state)
+        if text:
+            self.printer("[METRICS]\n{}".format(text))
+
+    def close(self, timeout=None):
+        self._stopped.set()
+        self._thread.join(timeout)
+
+
+class _ThreadingHTTPServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+
+class _MetricsHandler(http.server.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+
+        data = render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        # scrapes shouldn't print to the console
+        pass
+
+
+class HTTPExporter:
+    """Local Prometheus scrape endpoint: GET /metrics"""
+
+    def __init__(self, host="127.0.0.1", port=9464):
+        """Initializes HTTPExporter and starts serving
+        :param host: host to bind to (default: "127.0.0.1", local only)
+        :param port: port to bind to (default: 9464)
+        """
+
+        self.server = _ThreadingHTTPServer((host, port), _MetricsHandler)
+
+        self._thread = threading.Thread(target=self.server.serve_forever, name="aisecurity-metrics-http", daemon=True)
+        self._thread.start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class FileExporter:
+    """Writes the Prometheus text to a file every interval (ex: for node_exporter's textfile collector)"""
+
+    def __init__(self, path, interval=15.):
+        """Initializes FileExporter and starts the writer thread
+        :param path: output path, ex: /var/lib/node_exporter/aisecurity.prom
+        :param interval: seconds between writes (default: 15.)
+        """
+
+        self.path = path
+        self.interval = interval
+
+        self._stopped = threading.Event()
+
+        self._thread = threading.Thread(target=self._run, name="aisecurity-metrics-file", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            self.write()
+
+    def write(self):
+        # written to a temporary file and renamed, so scrapers never read a partial file
+        try:
+            with open(self.path + ".tmp", "w", encoding="utf-8") as file:
+                file.write(render())
+            os.replace(self.path + ".tmp", self.path)
+        except OSError as error:
+            warnings.warn("metrics not written to {}: {}".format(self.path, error))
+
+    def close(self, timeout=None):
+        self._stopped.set()
+        self._thread.join(timeout)
+        self.write()
+
+
+# INIT AND CLOSE
+def init(quiet=None, summary_interval=None, http_port=None, path=None, export_interval=15.):
+    """Configures metrics output (metrics are always recorded, this only decides where they go)
+    :param quiet: disable per-frame printing (default: None, unchanged)
+    :param summary_interval: print a summary every this many seconds (default: None, never)
+    :param http_port: serve Prometheus text at http://127.0.0.1:<http_port>/metrics (default: None, no endpoint)
+    :param path: write Prometheus text to this file every export_interval seconds (default: None, no file)
+    :param export_interval: seconds between file writes (default: 15.)
+    """
+
+    global QUIET, SUMMARIZER, HTTP_EXPORTER, FILE_EXPORTER
+
+    close()
+
+    if quiet is not None:
+        QUIET = quiet
+
+    if summary_interval:
+        SUMMARIZER = Summarizer(summary_interval)
+
+    if http_port:
+        try:
+            HTTP_EXPORTER = HTTPExporter(port=http_port)
+        except OSError as error:
+            warnings.warn("metrics endpoint not started: {}".format(error))
+
+    if path:
+        FILE_EXPORTER = FileExporter(path, interval=export_interval)
+
+
+def close(timeout=None):
+    """Stops exporters and summaries, printing a last summary and writing the file one last time"""
+    global SUMMARIZER, HTTP_EXPORTER, FILE_EXPORTER
+
+    if SUMMARIZER:
+        SUMMARIZER.close(timeout)
+        SUMMARIZER.print_summary()
+        SUMMARIZER = None
+
+    if HTTP_EXPORTER:
+        HTTP_EXPORTER.close()
+        HTTP_EXPORTER = None
+
+    if FILE_EXPORTER:
+        FILE_EXPORTER.close(timeout)
+        FILE_EXPORTER = None
+
+
+################################ Overhead benchmark ###############################
+if __name__ == "__main__":
+    import io
+    import sys
+
+    num_observations = 100000
+    bench_histogram = histogram("bench_seconds", "benchmark", labels={"stage": "detection"})
+
+    start = timer()
+    for obs_idx in range(num_observations):
+        bench_histogram.observe(obs_idx * 1e-7)
+    observe_time = (timer() - start) / num_observations
+
+    stdout, sys.stdout = sys.stdout, io.StringIO()
+    start = timer()
+    for obs_idx in range(num_observations):
+        print("Detection time ({}): \033[1m{} ms\033[0m".format("mtcnn", round(1000. * obs_idx * 1e-7, 2)))
+    print_time = (timer() - start) / num_observations
+    sys.stdout = stdout
+
+    print("observe(): {} us, print() to a buffer: {} us".format(round(1e6 * observe_time, 3),
+                                                                round(1e6 * print_time, 3)))
+    print("p50 estimate: {} ms (true: {} ms)".format(round(1000. * bench_histogram.quantile(0.5), 3),
+                                                     round(1000. * num_observations * 1e-7 / 2., 3)))
+    print(render())
@@ -6,10 +6,17 @@ Graphics utils.
 
 """
 
+import threading
+from timeit import default_timer as timer
+
 import cv2
 import numpy as np
 
 
+# GLOBALS
+_LOCAL = threading.local()  # reused landmark overlay per thread, so that renderers on different threads don't race
+
+
 ################################ Camera ###############################
 def get_video_cap(width, height, flip, device):
     """Initializes cv2.VideoCapture object
@@ -47,6 +54,67 @@ def get_video_cap(width, height, flip, device):
 
 
 ################################ Graphics ###############################
+def _get_overlay(roi):
+    # grown to the largest region drawn so far on this thread
+    buffer = getattr(_LOCAL, "overlay", None)
+
+    if buffer is None or buffer.dtype != roi.dtype or buffer.shape[0] < roi.shape[0] \
+            or buffer.shape[1] < roi.shape[1]:
+        shape = roi.shape if buffer is None else np.maximum(roi.shape, buffer.shape)
+        buffer = _LOCAL.overlay = np.empty(shape, dtype=roi.dtype)
+
+    overlay = buffer[:roi.shape[0], :roi.shape[1]]
+    np.copyto(overlay, roi)
+    return overlay
+
+
+def _add_features(overlay, features, radius, color, line_thickness):
+    cv2.circle(overlay, (features["left_eye"]), radius, color, line_thickness)
+    cv2.circle(overlay, (features["right_eye"]), radius, color, line_thickness)
+    cv2.circle(overlay, (features["nose"]), radius, color, line_thickness)
+    cv2.circle(overlay, (features["mouth_left"]), radius, color, line_thickness)
+    cv2.circle(overlay, (features["mouth_right"]), radius, color, line_thickness)
+
+    cv2.line(overlay, features["left_eye"], features["nose"], color, radius)
+    cv2.line(overlay, features["right_eye"], features["nose"], color, radius)
+    cv2.line(overlay, features["mouth_left"], features["nose"], color, radius)
+    cv2.line(overlay, features["mouth_right"], features["nose"], color, radius)
+
+
+def blend_features(frame, features, radius, color, line_thickness, full_frame=False):
+    """Draws translucent facial landmarks (in-place)
+
+    :param frame: frame as array
+    :param features: MTCNN keypoints, in frame coordinates
+    :param radius: landmark radius
+    :param color: BGR color
+    :param line_thickness: line thickness
+    :param full_frame: blend over the whole frame instead of the landmark region only (default: False)
+
+    """
+
+    if full_frame:
+        overlay = frame.copy()
+        _add_features(overlay, features, radius, color, line_thickness)
+        cv2.addWeighted(overlay, 0.5, frame, 0.5, 0, frame)
+        return
+
+    # pixels outside of the landmarks are blended with themselves, so blending only the landmark region gives the
+    # same result as blending the whole frame
+    pad = radius + line_thickness + 1
+    xs, ys = [point[0] for point in features.values()], [point[1] for point in features.values()]
+    x0, y0 = max(min(xs) - pad, 0), max(min(ys) - pad, 0)
+    x1, y1 = min(max(xs) + pad + 1, frame.shape[1]), min(max(ys) + pad + 1, frame.shape[0])
+
+    if x0 < x1 and y0 < y1:
+        roi = frame[y0:y1, x0:x1]
+        overlay = _get_overlay(roi)
+
+        shifted = {feature: (point[0] - x0, point[1] - y0) for feature, point in features.items()}
+        _add_features(overlay, shifted, radius, color, line_thickness)
+        cv2.addWeighted(overlay, 0.5, roi, 0.5, 0, roi)
+
+
 def add_graphics(frame, person, width, height, is_recognized, best_match, resize, elapsed, margin=10):
     """Adds graphics to a frame
 
@@ -92,18 +160,6 @@ def add_graphics(frame, person, width, height, is_recognized, best_match, resize
         cv2.putText(frame, label, (origin[0] + 6, corner[1] - 6), font, font_size, (255, 255, 255), thickness)
 
 
-    def add_features(overlay, features, radius, color, line_thickness):
-        cv2.circle(overlay, (features["left_eye"]), radius, color, line_thickness)
-        cv2.circle(overlay, (features["right_eye"]), radius, color, line_thickness)
-        cv2.circle(overlay, (features["nose"]), radius, color, line_thickness)
-        cv2.circle(overlay, (features["mouth_left"]), radius, color, line_thickness)
-        cv2.circle(overlay, (features["mouth_right"]), radius, color, line_thickness)
-
-        cv2.line(overlay, features["left_eye"], features["nose"], color, radius)
-        cv2.line(overlay, features["right_eye"], features["nose"], color, radius)
-        cv2.line(overlay, features["mouth_left"], features["nose"], color, radius)
-        cv2.line(overlay, features["mouth_right"], features["nose"], color, radius)
-
     def add_fps(frame, elapsed, font_size, thickness):
         text = "FPS: {}".format(round(1000. / elapsed, 2))  # elapsed is in ms, so *1000.
 
@@ -132,11 +188,138 @@ def add_graphics(frame, person, width, height, is_recognized, best_match, resize
         corner = (x + height + margin // 2, y + width + margin // 2)
 
         if features:
-            overlay = frame.copy()
-            add_features(overlay, features, radius, color, line_thickness)
-            cv2.addWeighted(overlay, 0.5, frame, 0.5, 0, frame)
+            blend_features(frame, features, radius, color, line_thickness)
 
         text = best_match if is_recognized else ""
         add_box_and_label(frame, origin, corner, color, line_thickness, text, font_size, thickness=1)
 
     add_fps(frame, elapsed, font_size, thickness=2)
+
+
+################################ Rendering ###############################
+class Renderer:
+    """Adds graphics to and shows frames, either inline or on a render thread (where newer frames replace older)"""
+
+    def __init__(self, title, threaded=False):
+        """Initializes Renderer
+        :param title: window title
+        :param threaded: render on a separate thread so that the cam loop never waits on drawing (default: False)
+        """
+
+        self.title = title
+        self.threaded = threaded
+
+        self.quit = threading.Event()  # set when "q" is pressed
+        self.stats = {"submitted": 0, "rendered": 0, "skipped": 0, "render_time": None}
+
+        self._next = None
+        self._cond = threading.Condition()
+        self._closing = False
+
+        if threaded:
+            self._thread = threading.Thread(target=self._run, name="aisecurity-render", daemon=True)
+            self._thread.start()
+
+    def submit(self, frame, *args, **kwargs):
+        """Renders a frame (inline) or hands it to the render thread
+        :param frame: frame as array-- must not be modified afterwards
+        :param args: add_graphics args, after frame
+        :param kwargs: add_graphics kwargs
+        """
+
+        self.stats["submitted"] += 1
+
+        if not self.threaded:
+            self._render(frame, args, kwargs)
+            return
+
+        with self._cond:
+            if self._next is not None:
+                self.stats["skipped"] += 1
+            self._next = (frame, args, kwargs)
+            self._cond.notify()
+
+    def _render(self, frame, args, kwargs):
+        start = timer()
+
+        add_graphics(frame, *args, **kwargs)
+        cv2.imshow(self.title, frame)
+        if cv2.waitKey(1) & 0xFF == ord("q"):
+            self.quit.set()
+
+        elapsed = timer() - start
+        self.stats["rendered"] += 1
+        self.stats["render_time"] = elapsed if self.stats["render_time"] is None \
+            else 0.1 * elapsed + 0.9 * self.stats["render_time"]
+
+    def _run(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._next is not None or self._closing)
+                if self._closing:
+                    break
+                (frame, args, kwargs), self._next = self._next, None
+
+            self._render(frame, args, kwargs)
+
+        cv2.destroyAllWindows()
+
+    def close(self, timeout=1.):
+        """Stops the render thread and closes the window
+        :param timeout: seconds to wait for the render thread (default: 1.)
+        """
+
+        if self.threaded:
+            with self._cond:
+                self._closing = True
+                self._cond.notify()
+            self._thread.join(timeout)
+        else:
+            cv2.destroyAllWindows()
+
+
+################################ Benchmark ###############################
+if __name__ == "__main__":
+    import argparse
+
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--width", help="width of frame", type=int, default=1280)
+    parser.add_argument("--height", help="height of frame", type=int, default=720)
+    parser.add_argument("--frames", help="number of frames", type=int, default=200)
+    args = parser.parse_args()
+
+    np.random.seed(0)
+    frame = np.random.randint(0, 256, (args.height, args.width, 3), dtype=np.uint8)
+
+    cx, cy = args.width // 2, args.height // 2
+    features = {
+        "left_eye": (cx - 35, cy - 30), "right_eye": (cx + 35, cy - 30), "nose": (cx, cy + 5),
+        "mouth_left": (cx - 30, cy + 45), "mouth_right": (cx + 30, cy + 45)
+    }
+    person = {"box": [cx - 80, cy - 100, 160, 200], "keypoints": features}
+
+    line_thickness = round(1e-6 * args.width * args.height + 1.5)
+    radius = round((1e-6 * args.width * args.height + 1.5) / 2.)
+
+    # correctness
+    full, roi_only = frame.copy(), frame.copy()
+    blend_features(full, features, radius, (0, 255, 0), line_thickness, full_frame=True)
+    blend_features(roi_only, features, radius, (0, 255, 0), line_thickness)
+    print("ROI blend identical to full-frame blend: {}".format(np.array_equal(full, roi_only)))
+
+    # per-frame cost
+    for full_frame in (True, False):
+        img = frame.copy()
+
+        start = timer()
+        for __ in range(args.frames):
+            blend_features(img, features, radius, (0, 255, 0), line_thickness, full_frame=full_frame)
+        blend_time = 1000. * (timer() - start) / args.frames
+
+        print("{} landmark blend: {}ms/frame".format("full-frame" if full_frame else "ROI", round(blend_time, 3)))
+
+    start = timer()
+    for __ in range(args.frames):
+        add_graphics(frame.copy(), person, args.width, args.height, True, "benchmark", None, 50.)
+    print("add_graphics (ROI, incl. frame copy): {}ms/frame".format(round(1000. * (timer() - start) / args.frames, 3)))
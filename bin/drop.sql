@@ -4,6 +4,8 @@
 DROP DATABASE IF EXISTS LOG;
 CREATE DATABASE LOG;
 USE LOG;
-CREATE TABLE Activity (id VARCHAR(5), name VARCHAR(200), date DATE, time TIME);
-/* student_id is VARCHAR(5) for cases like 00001-- can't be represented in python */
-CREATE TABLE Unknown (path_to_img VARCHAR(200), date DATE, time TIME);
+CREATE TABLE People (id VARCHAR(16) PRIMARY KEY, name VARCHAR(200));
+/* id is "P" or "V" (visitor) + the first 15 hex chars of SHA1(name), see aisecurity.db.log.get_id */
+CREATE TABLE Activity (event_id CHAR(32) PRIMARY KEY, ts DATETIME(3) NOT NULL, id VARCHAR(16) NOT NULL, name VARCHAR(200), INDEX idx_activity_ts (ts), INDEX idx_activity_id_ts (id, ts), FOREIGN KEY (id) REFERENCES People (id));
+/* event_id makes retried and store-and-forward inserts idempotent */
+CREATE TABLE Unknown (event_id CHAR(32) PRIMARY KEY, ts DATETIME(3) NOT NULL, path_to_img VARCHAR(200), INDEX idx_unknown_ts (ts));
@@ -0,0 +1,15 @@
+/* "migrate.sql"
+   Migrates LOG tables with separate date and time columns to the indexed timestamp schema in drop.sql.
+   Run through aisecurity.db.log.migrate(), which first renames the old tables to Activity_old and Unknown_old.
+   Not atomic (DDL commits implicitly), so every statement is idempotent: a migration that failed halfway is finished by running it again.
+   */
+USE LOG;
+CREATE TABLE IF NOT EXISTS People (id VARCHAR(16) PRIMARY KEY, name VARCHAR(200));
+/* old rows all have placeholder ids, so ids are recomputed from names like aisecurity.db.log.get_id */
+INSERT IGNORE INTO People (id, name) SELECT DISTINCT CONCAT(IF(LOWER(name) LIKE '%visitor%', 'V', 'P'), LEFT(SHA1(name), 15)), name FROM Activity_old WHERE name IS NOT NULL;
+CREATE TABLE IF NOT EXISTS Activity (event_id CHAR(32) PRIMARY KEY, ts DATETIME(3) NOT NULL, id VARCHAR(16) NOT NULL, name VARCHAR(200), INDEX idx_activity_ts (ts), INDEX idx_activity_id_ts (id, ts), FOREIGN KEY (id) REFERENCES People (id));
+CREATE TABLE IF NOT EXISTS Unknown (event_id CHAR(32) PRIMARY KEY, ts DATETIME(3) NOT NULL, path_to_img VARCHAR(200), INDEX idx_unknown_ts (ts));
+/* old rows get fresh event ids-- only in-flight events are deduplicated by event_id. Each copy is one statement (all or nothing) and is skipped if it already happened */
+INSERT INTO Activity (event_id, ts, id, name) SELECT REPLACE(UUID(), '-', ''), TIMESTAMP(date, time), CONCAT(IF(LOWER(name) LIKE '%visitor%', 'V', 'P'), LEFT(SHA1(name), 15)), name FROM Activity_old WHERE name IS NOT NULL AND NOT EXISTS (SELECT 1 FROM Activity);
+INSERT INTO Unknown (event_id, ts, path_to_img) SELECT REPLACE(UUID(), '-', ''), TIMESTAMP(date, time), path_to_img FROM Unknown_old WHERE NOT EXISTS (SELECT 1 FROM Unknown);
+DROP TABLE IF EXISTS Activity_old, Unknown_old;
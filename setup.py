@@ -11,7 +11,7 @@ from setuptools import setup, find_packages
 # TENSORFLOW INSTALL
 SUPPORTED_TF_VERSIONS = ["1.12", "1.14", "1.15"]
 
-INSTALL_REQUIRES = ["keras", "matplotlib", "pycryptodome", "scikit-learn", "opencv-python", "mtcnn", "websocket-client"]
+INSTALL_REQUIRES = ["keras", "matplotlib", "pycryptodome", "scikit-learn", "opencv-python", "mtcnn", "websockets"]
 
 try:
     import tensorflow as tf
@@ -32,7 +32,7 @@ setup(
     license=None,
     python_requires=">=3.5.0",
     install_requires=INSTALL_REQUIRES,
-    scripts=["bin/drop.sql", "bin/make_config.sh"],
+    scripts=["bin/drop.sql", "bin/migrate.sql", "bin/make_config.sh"],
     packages=find_packages(),
     zip_safe=False
 )
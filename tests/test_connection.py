@@ -0,0 +1,259 @@
+"""
+
+"tests.test_connection"
+
+AsyncClient requests, coalescing, and reconnect backoff against a local websockets server.
+
+"""
+
+import asyncio
+import concurrent.futures
+import json
+import socket
+import threading
+import time
+
+import pytest
+import websockets
+
+from aisecurity.db import connection
+from aisecurity.db.connection import AsyncClient
+
+
+################################ Setup and helpers ###############################
+
+# reconnect warnings are expected whenever the stand-in server is down
+pytestmark = pytest.mark.filterwarnings("ignore:websocket connection")
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("localhost", 0))
+        return sock.getsockname()[1]
+
+
+class StandInServer:
+    """Websocket server on a background thread that records messages, answers requests in reverse order, and pushes
+    {"pushed": ...} when sent {"push": ...}"""
+
+    def __init__(self, port):
+        self.port = port
+        self.address = "ws://localhost:{}".format(port)
+        self.received = []
+        self.batch = 1  # requests are answered once this many are waiting
+        self.echo_ids = True  # False: answers without request_id, like servers written for the old blocking client
+
+        self._stop = None
+        self._thread = None
+
+    async def _handler(self, ws, *args):
+        waiting = []
+        async for raw in ws:
+            message = json.loads(raw)
+            self.received.append(message)
+
+            if "push" in message:
+                await ws.send(json.dumps({"pushed": message["push"]}))
+
+            elif "request_id" in message:
+                waiting.append(message)
+                if len(waiting) >= self.batch:
+                    for request in reversed(waiting):
+                        answer = {"echo": request["query"]}
+                        if self.echo_ids:
+                            answer["request_id"] = request["request_id"]
+                        await ws.send(json.dumps(answer))
+                    waiting = []
+
+    def _serve(self, started):
+        loop = asyncio.new_event_loop()
+
+        async def main():
+            async with websockets.serve(self._handler, "localhost", self.port):
+                started.set()
+                while not self._stop.is_set():
+                    await asyncio.sleep(0.01)
+
+        loop.run_until_complete(main())
+        loop.close()
+
+    def start(self):
+        started, self._stop = threading.Event(), threading.Event()
+        self._thread = threading.Thread(target=self._serve, args=(started,), daemon=True)
+        self._thread.start()
+        assert started.wait(5.), "stand-in server did not start"
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join(5.)
+
+
+def wait_for(condition, timeout=5.):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.01)
+
+
+@pytest.fixture
+def server():
+    server = StandInServer(free_port())
+    server.start()
+    yield server
+    server.stop()
+
+
+@pytest.fixture
+def client(server):
+    client = AsyncClient(server.address, hello={"id": "1"}, backoff=0.05, max_backoff=0.2, request_timeout=2.)
+    assert client.connected.wait(5.)
+    yield client
+    client.close(5.)
+
+
+################################ Tests ###############################
+def test_sends_hello(server, client):
+    wait_for(lambda: server.received)
+    assert server.received[0] == {"id": "1"}
+
+
+def test_requests_are_correlated(server, client):
+    server.batch = 5
+    futures = [client.request({"query": idx}) for idx in range(5)]
+
+    # answered in reverse order, but every future gets its own response
+    assert [future.result(timeout=5.)["echo"] for future in futures] == list(range(5))
+    assert client.stats["requested"] == 5
+
+
+def test_unsolicited_message_while_request_pending(server):
+    pushed = []
+    client = AsyncClient(server.address, backoff=0.05, max_backoff=0.2, on_message=pushed.append)
+    assert client.connected.wait(5.)
+
+    server.batch = 2
+    future = client.request({"query": 0}, kind="best_match")
+    client.send({"push": "lcd"})
+    wait_for(lambda: pushed)
+
+    # without request_id, the push can't be an answer: it goes to on_message and the request stays pending
+    assert pushed == [{"pushed": "lcd"}]
+    assert not future.done()
+
+    second = client.request({"query": 1})
+    assert future.result(timeout=5.)["echo"] == 0 and second.result(timeout=5.)["echo"] == 1
+    client.close(5.)
+
+
+def test_unechoed_answers_only_resolve_ordered_kind(server):
+    pushed = []
+    client = AsyncClient(server.address, backoff=0.05, max_backoff=0.2, on_message=pushed.append,
+                         ordered_kind="best_match")
+    assert client.connected.wait(5.)
+
+    server.echo_ids, server.batch = False, 2
+    other = client.request({"query": "other"}, timeout=0.5)
+    best_match = client.request({"query": "best_match"}, kind="best_match")
+
+    # both answers come back without request_id: only the best_match request can be resolved by one, even though the
+    # other request is older
+    assert best_match.result(timeout=5.)["echo"] == "best_match"
+    wait_for(lambda: pushed)
+    assert pushed == [{"echo": "other"}]
+
+    with pytest.raises(concurrent.futures.TimeoutError):
+        other.result(timeout=5.)
+    client.close(5.)
+
+
+def test_request_times_out(server, client):
+    server.batch = 100
+    future = client.request({"query": 0}, timeout=0.1)
+
+    with pytest.raises(concurrent.futures.TimeoutError):
+        future.result(timeout=5.)
+    assert client.stats["timeouts"] == 1
+
+
+def test_coalesces_while_disconnected(server):
+    server.stop()
+    client = AsyncClient(server.address, backoff=0.05, max_backoff=0.1)
+
+    for idx in range(100):
+        client.send({"lcd": idx}, coalesce="lcd")
+    client.send({"event": "not coalesced"})
+
+    server.start()
+    wait_for(lambda: len(server.received) >= 2)
+    client.close(5.)
+
+    assert server.received == [{"lcd": 99}, {"event": "not coalesced"}]
+    assert client.stats["coalesced"] == 99
+
+
+def test_drops_when_queue_full(server):
+    server.stop()
+    client = AsyncClient(server.address, max_queue=3, backoff=0.05, max_backoff=0.1)
+
+    for idx in range(5):
+        client.send({"event": idx})
+    future = client.request({"query": 0})
+
+    with pytest.raises(ConnectionError):
+        future.result(timeout=5.)
+    client.close(5.)
+
+    assert client.stats["dropped"] == 3
+
+
+def test_redelivers_after_reconnect(server, client):
+    server.stop()
+    wait_for(lambda: not client.connected.is_set())
+
+    client.send({"event": "sent while down"})
+    server.start()
+    assert client.connected.wait(5.)
+    wait_for(lambda: {"event": "sent while down"} in server.received)
+
+    # hello is sent again on every reconnect
+    assert server.received.count({"id": "1"}) == 2
+
+
+def test_reconnect_backoff(monkeypatch):
+    attempts = []
+
+    class Unreachable:
+        def __init__(self, address):
+            attempts.append(time.monotonic())
+
+        async def __aenter__(self):
+            raise ConnectionRefusedError("stand-in: connection refused")
+
+        async def __aexit__(self, *args):
+            return False
+
+    monkeypatch.setattr(connection.websockets, "connect", Unreachable)
+
+    with pytest.warns(UserWarning):
+        client = AsyncClient("ws://unreachable", backoff=0.05, max_backoff=0.2)
+        wait_for(lambda: len(attempts) >= 6)
+        client.close(5.)
+
+    delays = [later - earlier for earlier, later in zip(attempts, attempts[1:])]
+
+    # 0.05, 0.1, 0.2, then capped at 0.2
+    assert delays[0] == pytest.approx(0.05, abs=0.04)
+    assert delays[1] == pytest.approx(0.1, abs=0.04)
+    assert all(delay == pytest.approx(0.2, abs=0.05) for delay in delays[2:5])
+    assert not client.connected.is_set()
+
+
+def test_close_fails_outstanding_requests(server, client):
+    server.batch = 100
+    future = client.request({"query": 0}, timeout=60.)
+    wait_for(lambda: server.received[-1:] and "request_id" in server.received[-1])
+
+    client.close(5.)
+
+    with pytest.raises(ConnectionError):
+        future.result(timeout=5.)
@@ -0,0 +1,184 @@
+"""
+
+"tests.test_pool"
+
+ConnectionPool reconnects, transaction rollback, and schema scripts against SQLite.
+
+"""
+
+import sqlite3
+import threading
+
+import pytest
+
+from aisecurity.db.pool import ConnectionPool
+
+
+################################ Setup and helpers ###############################
+class ConnectionLost(Exception):
+    """Stand-in for mysql.connector.errors.OperationalError"""
+
+
+class FlakyConnection:
+    """SQLite connection that can be "lost" like a MySQL connection after a server restart"""
+
+    def __init__(self, path):
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.lost = False
+        self.closed = False
+
+    def cursor(self, **kwargs):
+        if self.lost:
+            raise ConnectionLost("MySQL server has gone away")
+        return self.conn.cursor()
+
+    def commit(self):
+        self.conn.commit()
+
+    def rollback(self):
+        self.conn.rollback()
+
+    def close(self):
+        self.closed = True
+        self.conn.close()
+
+
+class Database:
+    """Connection factory that keeps track of the connections it opened"""
+
+    def __init__(self, tmp_path):
+        self.path = str(tmp_path / "pool.db")
+        self.connections = []
+        self.down = False
+
+    def connect(self):
+        if self.down:
+            raise ConnectionLost("can't connect")
+        self.connections.append(FlakyConnection(self.path))
+        return self.connections[-1]
+
+
+@pytest.fixture
+def database(tmp_path):
+    return Database(tmp_path)
+
+
+def new_pool(database, **kwargs):
+    pool = ConnectionPool(database.connect, placeholder="?", reconnect_errors=(ConnectionLost,), **kwargs)
+    pool.execute_script(["CREATE TABLE People (id TEXT PRIMARY KEY, name TEXT);"])
+    return pool
+
+
+################################ Tests ###############################
+def test_parameterized_query(database):
+    pool = new_pool(database)
+
+    name = "Robert'); DROP TABLE People;--"
+    pool.transaction([("INSERT INTO People (id, name) VALUES (?, ?);", [("00001", name)])])
+
+    assert pool.query("SELECT name FROM People WHERE id = ?;", ("00001",)) == [(name,)]
+
+
+def test_reconnects_after_lost_connection(database):
+    pool = new_pool(database)
+    database.connections[0].lost = True
+
+    pool.transaction([("INSERT INTO People (id, name) VALUES (?, ?);", [("00001", "a")])])
+
+    assert database.connections[0].closed
+    assert len(database.connections) == 2
+    assert pool.stats["reconnects"] == 1
+    assert pool.query("SELECT COUNT(*) FROM People;") == [(1,)]
+
+
+def test_gives_up_after_reconnect_attempts(database):
+    pool = new_pool(database, reconnect_attempts=2)
+    database.connections[0].lost = True
+    database.down = True
+
+    with pytest.raises(ConnectionLost):
+        pool.query("SELECT 1;")
+
+    # the pool works again once the database is back
+    database.down = False
+    assert pool.query("SELECT 1;") == [(1,)]
+    assert pool._open == 1
+
+
+def test_raises_if_unreachable(database):
+    database.down = True
+    with pytest.raises(ConnectionLost):
+        new_pool(database)
+
+
+def test_rolls_back_failed_transaction(database):
+    pool = new_pool(database)
+
+    with pytest.raises(sqlite3.IntegrityError):
+        pool.transaction([
+            ("INSERT INTO People (id, name) VALUES (?, ?);", [("00001", "a"), ("00002", "b")]),
+            ("INSERT INTO People (id, name) VALUES (?, ?);", [("00001", "duplicate")])
+        ])
+
+    assert pool.query("SELECT COUNT(*) FROM People;") == [(0,)]
+
+    # not a reconnect error: the connection goes back to the pool instead of being replaced
+    assert len(database.connections) == 1
+    assert pool.stats["reconnects"] == 0
+
+
+def test_limits_open_connections(database):
+    pool = new_pool(database, size=2)
+    barrier = threading.Barrier(4)
+
+    def insert(idx):
+        barrier.wait()
+        for row in range(20):
+            pool.transaction([("INSERT INTO People (id, name) VALUES (?, ?);", [("{}-{}".format(idx, row), "x")])])
+
+    threads = [threading.Thread(target=insert, args=(idx,)) for idx in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(database.connections) <= 2
+    assert pool.query("SELECT COUNT(*) FROM People;") == [(80,)]
+
+
+def test_clear_closes_idle_connections(database):
+    pool = new_pool(database)
+    pool.clear()
+
+    assert database.connections[0].closed
+    assert pool.query("SELECT COUNT(*) FROM People;") == [(0,)]
+    assert len(database.connections) == 2
+
+
+def test_script_is_not_retried(database):
+    pool = new_pool(database)
+    database.connections[0].lost = True
+
+    with pytest.raises(ConnectionLost):
+        pool.execute_script(["CREATE TABLE Unknown (event_id TEXT PRIMARY KEY);"])
+
+    # the dead connection is closed and the script isn't run again on a new one
+    assert database.connections[0].closed
+    assert len(database.connections) == 1
+    assert pool.stats["reconnects"] == 0
+
+
+def test_script_commits_each_statement(database):
+    pool = new_pool(database)
+
+    with pytest.raises(sqlite3.OperationalError):
+        pool.execute_script([
+            "CREATE TABLE Unknown (event_id TEXT PRIMARY KEY);",
+            "INSERT INTO People (id, name) VALUES ('00001', 'a');",
+            "INSERT INTO Missing (id) VALUES ('00001');"
+        ])
+
+    # no rollback across statements: everything before the failure stays applied
+    assert pool.query("SELECT COUNT(*) FROM Unknown;") == [(0,)]
+    assert pool.query("SELECT COUNT(*) FROM People;") == [(1,)]
+    assert pool.stats["scripts"] == 1  # only the one from new_pool
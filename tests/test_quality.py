@@ -0,0 +1,123 @@
+"""
+
+"tests.test_quality"
+
+QualityGate skip and defer policies.
+
+"""
+
+import numpy as np
+
+from aisecurity.face.quality import QualityGate
+
+
+################################ Setup and helpers ###############################
+RNG = np.random.RandomState(0)
+
+
+def sharp_crop():
+    # noise has a high Laplacian variance and a mid-range brightness
+    return RNG.uniform(60., 200., size=(1, 160, 160, 3)).astype(np.float32)
+
+
+def blurry_crop(brightness=128.):
+    # a flat crop has no edges at all
+    return np.full((1, 160, 160, 3), brightness, dtype=np.float32)
+
+
+def face(frame_num=None):
+    return {"box": [0, 0, 100, 100], "keypoints": None, "frame": frame_num}
+
+
+################################ Tests ###############################
+def test_disabled_gate_passes_everything():
+    gate = QualityGate(mode=None)
+    crops = blurry_crop()
+
+    faces, coords = gate.gate(crops, face())
+    assert faces is crops and coords == face()
+    assert gate.rejections["accepted"] == 0
+
+
+def test_skip_rejects_blurry_faces():
+    gate = QualityGate(mode="skip")
+
+    assert gate.gate(blurry_crop(), face()) == (None, None)
+    assert gate.rejections["sharpness"] == 1
+
+    faces, __ = gate.gate(sharp_crop(), face())
+    assert faces is not None
+    assert gate.rejections["accepted"] == 1
+
+
+def test_skip_never_releases():
+    gate = QualityGate(mode="skip", max_deferred=2)
+
+    for frame_num in range(5):
+        assert gate.gate(blurry_crop(), face(), frame_num=frame_num) == (None, None)
+    assert gate.rejections["released"] == 0
+    assert gate.deferred_frame_num() is None
+
+
+def test_defer_releases_best_face_after_max_deferred():
+    gate = QualityGate(mode="defer", max_deferred=3, thresholds={"sharpness": 1e6})
+
+    # all rejected (threshold is out of reach), the noisiest one is the best of them
+    crops = [blurry_crop(), sharp_crop(), blurry_crop(100.)]
+    assert gate.gate(crops[0], face(10), frame_num=10) == (None, None)
+    assert gate.gate(crops[1], face(11), frame_num=11) == (None, None)
+    assert gate.deferred_frame_num() == 11
+
+    faces, coords = gate.gate(crops[2], face(12), frame_num=12)
+    np.testing.assert_array_equal(faces, crops[1])
+    assert coords["frame_num"] == 11 and coords["frame"] == 11
+    assert gate.rejections["released"] == 1
+    assert gate.deferred_frame_num() is None
+
+
+def test_deferred_face_is_copied():
+    gate = QualityGate(mode="defer", max_deferred=2, thresholds={"sharpness": 1e6})
+
+    crops = sharp_crop()
+    expected = crops.copy()
+    gate.gate(crops, face(0), frame_num=0)
+    crops[:] = 0.  # crop_face reuses its buffer
+
+    faces, __ = gate.gate(blurry_crop(), face(1), frame_num=1)
+    np.testing.assert_array_equal(faces, expected)
+
+
+def test_accepted_face_clears_deferral():
+    gate = QualityGate(mode="defer", max_deferred=2)
+
+    gate.gate(blurry_crop(), face(0), frame_num=0)
+    assert gate.deferred_frame_num() == 0
+
+    faces, coords = gate.gate(sharp_crop(), face(1), frame_num=1)
+    assert faces is not None and "frame_num" not in coords
+    assert gate.deferred_frame_num() is None
+
+    # the deferral count started over, so one more rejection doesn't release anything
+    assert gate.gate(blurry_crop(), face(2), frame_num=2) == (None, None)
+
+
+def test_gates_are_independent():
+    front, back = QualityGate(mode="defer", max_deferred=2), QualityGate(mode="defer", max_deferred=2)
+
+    # an accepted face on one camera doesn't clear the other camera's deferral...
+    front.gate(blurry_crop(), face(0), frame_num=0)
+    back.gate(sharp_crop(), face(0), frame_num=0)
+    assert front.deferred_frame_num() == 0
+
+    # ...and a rejection on one camera doesn't release the other camera's deferred face
+    assert back.gate(blurry_crop(), face(1), frame_num=1) == (None, None)
+    assert back.rejections["released"] == 0 and front.deferred_frame_num() == 0
+
+
+def test_reset_clears_state():
+    gate = QualityGate(mode="defer", max_deferred=5)
+    gate.gate(blurry_crop(), face(0), frame_num=0)
+
+    gate.reset()
+    assert gate.deferred_frame_num() is None
+    assert not any(gate.rejections.values())
@@ -0,0 +1,108 @@
+"""
+
+"tests.test_scheduler"
+
+LatencyScheduler decisions against a simulated clock.
+
+"""
+
+from aisecurity.optim.scheduler import LatencyScheduler
+
+
+################################ Setup and helpers ###############################
+class FakeClock:
+    """Clock that only moves when told to"""
+
+    def __init__(self):
+        self.now = 0.
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+def run_frames(scheduler, clock, num_frames, detection, embedding):
+    for __ in range(num_frames):
+        scheduler.start_frame()
+        with scheduler.stage("detection"):
+            clock.sleep(detection)
+        with scheduler.stage("embedding"):
+            clock.sleep(embedding)
+        scheduler.end_frame()
+
+
+def new_scheduler(clock, **kwargs):
+    return LatencyScheduler(target_fps=10, rotations=[-1], smoothing=1., cooldown=5, clock=clock, **kwargs)
+
+
+################################ Tests ###############################
+def test_starts_at_full_quality():
+    scheduler = new_scheduler(FakeClock())
+    assert scheduler.settings == {"resize": 1., "detector": "both", "rotations": [-1]}
+
+
+def test_stage_latencies_use_clock():
+    clock = FakeClock()
+    scheduler = new_scheduler(clock)
+
+    run_frames(scheduler, clock, 1, detection=0.02, embedding=0.03)
+
+    assert abs(scheduler.latencies["detection"] - 0.02) < 1e-9
+    assert abs(scheduler.latencies["embedding"] - 0.03) < 1e-9
+    assert abs(scheduler.frame_latency - 0.05) < 1e-9
+
+
+def test_downgrades_dominant_stage_first():
+    clock = FakeClock()
+    scheduler = new_scheduler(clock)
+
+    # detection blows the 100 ms deadline, so the detector is the first knob to turn
+    run_frames(scheduler, clock, 5, detection=0.15, embedding=0.01)
+    assert [(d["action"], d["knob"]) for d in scheduler.decisions] == [("downgrade", "detector")]
+    assert scheduler.settings["detector"] == "mtcnn"
+
+    clock_before = clock.now
+    scheduler.decisions.clear()
+
+    # embedding dominates next: rotations are dropped first
+    run_frames(scheduler, clock, 5, detection=0.01, embedding=0.15)
+    assert [(d["action"], d["knob"]) for d in scheduler.decisions] == [("downgrade", "rotations")]
+    assert scheduler.settings["rotations"] is None
+    assert scheduler.decisions[0]["time"] > clock_before
+
+
+def test_cooldown_limits_decisions():
+    clock = FakeClock()
+    scheduler = new_scheduler(clock)
+
+    run_frames(scheduler, clock, 12, detection=0.5, embedding=0.5)
+
+    # the first decision can happen right away, after that one every cooldown frames
+    assert [d["frame"] for d in scheduler.decisions] == [1, 6, 11]
+
+
+def test_upgrades_in_reverse_order_with_headroom():
+    clock = FakeClock()
+    decisions = []
+    scheduler = new_scheduler(clock, on_decision=decisions.append)
+
+    run_frames(scheduler, clock, 10, detection=0.15, embedding=0.01)
+    downgraded = [d["knob"] for d in decisions]
+    assert len(downgraded) == 2
+
+    # well within 0.7 * deadline: knobs come back last in, first out
+    run_frames(scheduler, clock, 10, detection=0.01, embedding=0.01)
+    upgraded = [d["knob"] for d in decisions if d["action"] == "upgrade"]
+    assert upgraded == downgraded[::-1]
+    assert scheduler.settings == {"resize": 1., "detector": "both", "rotations": [-1]}
+
+
+def test_holds_settings_between_headroom_and_deadline():
+    clock = FakeClock()
+    scheduler = new_scheduler(clock)
+
+    run_frames(scheduler, clock, 20, detection=0.05, embedding=0.03)
+
+    assert scheduler.decisions == []
@@ -0,0 +1,139 @@
+"""
+
+"tests.test_shared"
+
+GalleryKNN against sklearn, and SharedGallery publish/attach/refresh in a temporary directory.
+
+"""
+
+import os
+
+import numpy as np
+import pytest
+from sklearn import neighbors
+
+from aisecurity.dataflow import shared
+from aisecurity.dataflow.shared import GalleryKNN, SharedGallery, publish
+
+
+################################ Setup and helpers ###############################
+def random_gallery(num_people=20, embeds_per_person=5, embed_dim=16, seed=0):
+    rng = np.random.RandomState(seed)
+    centers = rng.randn(num_people, embed_dim)
+    return {"person_{:02d}".format(idx): list((center + 0.8 * rng.randn(embeds_per_person, embed_dim))
+                                              .astype(np.float32))
+            for idx, center in enumerate(centers)}
+
+
+def sklearn_knn(data):
+    # same as FaceNet._train_knn
+    names = [name for name, embeds in data.items() for __ in embeds]
+    embeds = [embed for values in data.values() for embed in values]
+    return neighbors.KNeighborsClassifier(n_neighbors=len(names) // len(set(names))).fit(embeds, names)
+
+
+def gallery_knn(data, directory):
+    publish(data, str(directory))
+    return GalleryKNN(SharedGallery(str(directory)).attach())
+
+
+################################ GalleryKNN ###############################
+def test_matches_sklearn(tmp_path):
+    data = random_gallery()
+    rng = np.random.RandomState(1)
+
+    embeds = np.concatenate([np.stack(values) for values in data.values()])
+    queries = np.concatenate([
+        embeds + 0.3 * rng.randn(*embeds.shape),  # near a gallery embedding
+        1.5 * rng.randn(200, embeds.shape[1])  # anywhere, so that many votes are split
+    ]).astype(np.float32)
+
+    expected = sklearn_knn(data).predict(queries)
+    np.testing.assert_array_equal(gallery_knn(data, tmp_path).predict(queries), expected)
+
+
+def test_vote_ties_go_to_first_name(tmp_path):
+    # k = 2: the query's neighbors are one of bob's and one of alice's-- bob's is nearer, but a tied vote goes to the
+    # first name, like sklearn
+    data = {
+        "alice": [np.array([1., 0.], dtype=np.float32), np.array([-9., -9.], dtype=np.float32)],
+        "bob": [np.array([0., 0.5], dtype=np.float32), np.array([9., 9.], dtype=np.float32)],
+        "carol": [np.array([-9., 9.], dtype=np.float32), np.array([9., -9.], dtype=np.float32)]
+    }
+    query = np.zeros((1, 2), dtype=np.float32)
+
+    assert sklearn_knn(data).predict(query)[0] == "alice"
+    assert gallery_knn(data, tmp_path).predict(query)[0] == "alice"
+
+
+def test_n_neighbors_defaults_to_embeds_per_person(tmp_path):
+    knn = gallery_knn(random_gallery(num_people=4, embeds_per_person=3), tmp_path)
+    assert knn.n_neighbors == 3
+
+
+################################ SharedGallery ###############################
+def test_publish_and_attach(tmp_path):
+    data = random_gallery(num_people=3, embeds_per_person=2)
+    assert publish(data, str(tmp_path), config={"metric": "euclidean"}) == 0
+
+    gallery = SharedGallery(str(tmp_path)).attach()
+
+    assert gallery.generation == 0 and len(gallery) == 6
+    assert gallery.config == {"metric": "euclidean"}
+    assert gallery.names == [name for name in sorted(data) for __ in range(2)]
+    for name, embeds in data.items():
+        np.testing.assert_array_equal(gallery.data[name], np.stack(embeds))
+
+    # mapped read-only
+    with pytest.raises(ValueError):
+        gallery.embeds[0, 0] = 0.
+
+
+def test_refresh_attaches_new_generation(tmp_path):
+    publish(random_gallery(num_people=2), str(tmp_path))
+    gallery = SharedGallery(str(tmp_path)).attach()
+    assert not gallery.refresh()
+
+    publish(random_gallery(num_people=3), str(tmp_path))
+    assert gallery.refresh()
+    assert gallery.generation == 1 and len(gallery.classes) == 3
+
+
+def test_old_generations_are_unlinked_but_stay_mapped(tmp_path):
+    publish(random_gallery(num_people=2, seed=0), str(tmp_path))
+    gallery = SharedGallery(str(tmp_path)).attach()
+    knn = GalleryKNN(gallery)
+    expected = knn.predict(gallery.embeds)
+
+    for seed in range(1, 4):
+        publish(random_gallery(num_people=2, seed=seed), str(tmp_path))
+
+    # only the last KEEP_GENERATIONS generations are left on disk...
+    tables = sorted(name for name in os.listdir(str(tmp_path)) if name.endswith(".json") and name != "current.json")
+    assert tables == ["gallery.{}.json".format(generation) for generation in range(4 - shared.KEEP_GENERATIONS, 4)]
+
+    # ...but the unlinked generation is still readable through the existing mapping
+    np.testing.assert_array_equal(knn.predict(gallery.embeds), expected)
+
+
+def test_refresh_keeps_mapping_if_generation_vanished(tmp_path):
+    publish(random_gallery(num_people=2), str(tmp_path))
+    gallery = SharedGallery(str(tmp_path)).attach()
+    embeds = np.array(gallery.embeds)
+
+    # a refresh that loses the race with later publishes: the pointer names a generation that was already unlinked
+    publish(random_gallery(num_people=3), str(tmp_path))
+    os.unlink(shared._paths(str(tmp_path), 1)["embeds"])
+
+    assert not gallery.refresh()
+    assert gallery.generation == 0 and len(gallery.classes) == 2
+    np.testing.assert_array_equal(gallery.embeds, embeds)
+
+
+def test_update_adds_embeddings(tmp_path):
+    publish({"alice": [np.ones(4, dtype=np.float32)]}, str(tmp_path))
+    gallery = SharedGallery(str(tmp_path)).attach()
+
+    assert gallery.update({"alice": [np.zeros(4)], "bob": [np.full(4, 2.)]}) == 1
+    assert gallery.generation == 1
+    assert [len(gallery.data[name]) for name in gallery.classes] == [2, 1]
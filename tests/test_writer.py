@@ -0,0 +1,169 @@
+"""
+
+"tests.test_writer"
+
+AsyncWriter batching, retries, and drops against an SQLite stand-in for the log database.
+
+"""
+
+import sqlite3
+import threading
+import warnings
+from timeit import default_timer as timer
+
+from aisecurity.db.pool import ConnectionPool
+from aisecurity.db.writer import AsyncWriter, SQLiteSink
+
+
+################################ Setup and helpers ###############################
+def new_sink(tmp_path):
+    pool = ConnectionPool(lambda: sqlite3.connect(str(tmp_path / "log.db"), check_same_thread=False), size=1,
+                          placeholder="?")
+    return SQLiteSink(pool)
+
+
+def count(sink, table):
+    return sink.pool.query("SELECT COUNT(*) FROM {};".format(table))[0][0]
+
+
+def activity(idx):
+    return {"event_id": "{:032d}".format(idx), "ts": "2020-01-01 00:00:{:02d}.000".format(idx % 60), "id": "00000",
+            "name": "Person {}".format(idx)}
+
+
+class RecordingSink:
+    """Sink that records batch sizes and fails on demand"""
+
+    def __init__(self, failures=0, gate=None):
+        self.batches = []
+        self.failures = failures
+        self.gate = gate  # threading.Event that write() waits on, to back up the queue
+
+    def write(self, events):
+        if self.gate:
+            self.gate.wait()
+        if self.failures:
+            self.failures -= 1
+            raise ConnectionError("database down")
+        self.batches.append(len(events))
+
+
+################################ Tests ###############################
+def test_batches_by_size():
+    gate = threading.Event()
+    sink = RecordingSink(gate=gate)
+    writer = AsyncWriter(sink, batch_size=10, flush_interval=60.)
+
+    for idx in range(25):
+        writer.put("Activity", activity(idx))
+    gate.set()
+    writer.close(timeout=5.)
+
+    assert sum(sink.batches) == 25
+    assert max(sink.batches) == 10
+    assert writer.stats["written"] == 25 and writer.stats["queued"] == 25
+
+
+def test_flushes_on_interval():
+    sink = RecordingSink()
+    writer = AsyncWriter(sink, batch_size=100, flush_interval=0.05)
+
+    writer.put("Activity", activity(0))
+    for __ in range(100):
+        if sink.batches:
+            break
+        threading.Event().wait(0.01)
+
+    assert sink.batches == [1]
+    writer.close(timeout=5.)
+
+
+def test_writes_rows_and_parents(tmp_path):
+    sink = new_sink(tmp_path)
+    writer = AsyncWriter(sink, batch_size=8, flush_interval=0.05)
+
+    for idx in range(20):
+        writer.put("Activity", activity(idx))
+    writer.put("Unknown", {"event_id": "f" * 32, "ts": "2020-01-01 00:00:00.000", "path_to_img": None})
+    writer.close(timeout=5.)
+
+    assert count(sink, "Activity") == 20
+    assert count(sink, "Unknown") == 1
+    assert count(sink, "People") == 1  # every row above has id 00000
+
+
+def test_retries_are_idempotent(tmp_path):
+    sink = new_sink(tmp_path)
+    writer = AsyncWriter(sink, batch_size=5, flush_interval=0.05)
+
+    for idx in range(5):
+        writer.put("Activity", activity(idx))
+        writer.put("Activity", activity(idx))  # same event_id, as after a retried write
+    writer.close(timeout=5.)
+
+    assert count(sink, "Activity") == 5
+
+
+def test_retries_with_backoff():
+    sink = RecordingSink(failures=2)
+    writer = AsyncWriter(sink, batch_size=3, flush_interval=0.05, backoff=0.01)
+
+    for idx in range(3):
+        writer.put("Activity", activity(idx))
+    for __ in range(200):
+        if sink.batches:
+            break
+        threading.Event().wait(0.01)
+    writer.close(timeout=5.)
+
+    assert sink.batches == [3]
+    assert writer.stats["retries"] == 2
+    assert writer.stats["failed"] == 0
+
+
+def test_drops_batch_after_max_retries():
+    sink = RecordingSink(failures=100)
+    writer = AsyncWriter(sink, batch_size=2, flush_interval=0.05, max_retries=2, backoff=0.01)
+
+    with warnings.catch_warnings(record=True) as caught:
+        warnings.simplefilter("always")
+        writer.put("Activity", activity(0))
+        writer.put("Activity", activity(1))
+        for __ in range(200):
+            if writer.stats["failed"]:
+                break
+            threading.Event().wait(0.01)
+        writer.close(timeout=5.)
+
+    assert writer.stats["failed"] == 2
+    assert writer.stats["retries"] == 2
+    assert any("after 2 retries" in str(warning.message) for warning in caught)
+
+
+def test_drops_new_events_when_full():
+    gate = threading.Event()
+    writer = AsyncWriter(RecordingSink(gate=gate), max_queue=4, batch_size=1, flush_interval=60.)
+
+    queued = [writer.put("Activity", activity(idx)) for idx in range(10)]
+    gate.set()
+    writer.close(timeout=5.)
+
+    # one event may already be in the writer thread, blocked on the sink
+    assert queued.count(False) in (5, 6)
+    assert writer.stats["dropped"] == queued.count(False)
+
+
+def test_close_skips_backoff():
+    writer = AsyncWriter(RecordingSink(failures=10 ** 6), batch_size=64, flush_interval=0.01, backoff=30.)
+    for idx in range(500):
+        writer.put("Activity", activity(idx))
+
+    start = timer()
+    with warnings.catch_warnings(record=True) as caught:
+        warnings.simplefilter("always")
+        writer.close(timeout=5.)
+
+    # the first batch may be sleeping through a 30 s backoff when close() is called
+    assert timer() - start < 5.
+    assert writer.stats["failed"] == 500
+    assert any("on close" in str(warning.message) for warning in caught)